@@ -0,0 +1,70 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import argparse
+import asyncio
+import os
+import random
+
+from aiohttp import web
+
+from droombot.api import CORE_TEXT_TO_IMAGE_PATH, SD3_TEXT_TO_IMAGE_PATH
+
+
+def create_app(
+    latency: float = 1.0,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    image_size: int = 1024**2,
+) -> web.Application:
+    """Local stand-in for the text to image endpoints of Stability AI
+
+    :param latency: mean number of seconds a generation takes
+    :param jitter: the latency varies uniformly by up to this many seconds
+    :param error_rate: fraction of calls that fail with a 500
+    :param image_size: number of bytes of the generated images
+    :return: the aiohttp application
+    """
+    # the content of the image does not matter, so every call returns the same one.
+    image = os.urandom(image_size)
+
+    async def generate(request: web.Request) -> web.Response:
+        fields = await request.post()
+        await asyncio.sleep(max(latency + random.uniform(-jitter, jitter), 0))
+        if random.random() < error_rate:
+            return web.json_response({"errors": ["internal error"]}, status=500)
+        return web.Response(
+            body=image,
+            content_type="image/png",
+            headers={"finish-reason": "SUCCESS", "seed": str(fields.get("seed", 0))},
+        )
+
+    app = web.Application(client_max_size=1024**2)
+    app.router.add_post(CORE_TEXT_TO_IMAGE_PATH, generate)
+    app.router.add_post(SD3_TEXT_TO_IMAGE_PATH, generate)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=create_app.__doc__)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--image-size", type=int, default=1024**2)
+    args = parser.parse_args()
+    web.run_app(
+        create_app(args.latency, args.jitter, args.error_rate, args.image_size),
+        port=args.port,
+    )
@@ -0,0 +1,212 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import argparse
+import asyncio
+import dataclasses
+import random
+import resource
+import statistics
+import time
+import uuid
+
+import redis.asyncio as redis
+from aiohttp.test_utils import TestServer
+from fake_stability import create_app
+
+from droombot.api import StabilityClient
+from droombot.bot import QUEUE_POSITION_LIMIT, STATUS_INTERVAL
+from droombot.job_queue import JobQueue
+from droombot.models import FinishReason, PubSubMessage, parse_prompt
+from droombot.results import Progress, ResultListener, fetch_progress
+from droombot.worker import Worker
+
+
+@dataclasses.dataclass
+class Report:
+    prompts: int = 0
+    failed: int = 0
+    duration: float = 0.0
+    # end-to-end latencies of successful prompts, in seconds.
+    latencies: list[float] = dataclasses.field(default_factory=list)
+    # None if the redis server does not report it.
+    redis_ops: int | None = None
+    peak_rss_kib: int = 0
+
+    def print(self) -> None:
+        succeeded = self.prompts - self.failed
+        print(f"prompts:        {self.prompts} ({self.failed} failed)")
+        print(f"duration:       {self.duration:.2f} s")
+        print(f"throughput:     {succeeded / self.duration:.2f} prompts/s")
+        if len(self.latencies) >= 2:
+            percentiles = statistics.quantiles(
+                self.latencies, n=100, method="inclusive"
+            )
+            print(
+                f"latency:        p50 {percentiles[49]:.3f} s, "
+                f"p95 {percentiles[94]:.3f} s, p99 {percentiles[98]:.3f} s"
+            )
+        if self.redis_ops is not None:
+            print(f"redis ops:      {self.redis_ops / self.prompts:.1f} per prompt")
+        print(f"peak memory:    {self.peak_rss_kib / 1024:.1f} MiB")
+
+
+async def redis_ops(connection: redis.Redis) -> int | None:
+    try:
+        info = await connection.info("stats")
+    except redis.ResponseError:
+        # fakeredis does not implement INFO
+        return None
+    return info["total_commands_processed"]
+
+
+async def send_prompt(
+    connection: redis.Redis,
+    job_queue: JobQueue,
+    listener: ResultListener,
+    interaction_id: str,
+    user_id: str,
+    text: str,
+    timeout: float,
+) -> float | None:
+    """Send a prompt the way the bot does, and wait for the result
+
+    :return: seconds until the result was available, or None if it failed
+    """
+    start = time.monotonic()
+    message = PubSubMessage(
+        interaction_id=interaction_id,
+        text_prompt=text,
+        guild_id="benchmark",
+        user_id=user_id,
+        requests=parse_prompt(text),
+    )
+    await listener.register(interaction_id)
+    entry_id = await job_queue.enqueue(message)
+    # follow the progress of the prompt, and its position while it is queued
+    progress = Progress()
+    deadline = start + timeout
+    try:
+        while not progress.complete:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if await listener.next_update(
+                interaction_id, min(STATUS_INTERVAL, remaining)
+            ):
+                progress = await fetch_progress(connection, interaction_id, progress)
+            elif not progress.started:
+                await job_queue.position(entry_id, QUEUE_POSITION_LIMIT)
+    finally:
+        listener.unregister(interaction_id)
+    if any(
+        r.finish_reason is not FinishReason.SUCCESS for r in progress.responses.values()
+    ):
+        return None
+    return time.monotonic() - start
+
+
+async def run(args: argparse.Namespace) -> Report:
+    if args.fake_redis:
+        import fakeredis.aioredis
+
+        server = fakeredis.FakeServer()
+        bot_connection = fakeredis.aioredis.FakeRedis(server=server)
+        worker_connection = fakeredis.aioredis.FakeRedis(server=server)
+    else:
+        bot_connection = redis.Redis(host=args.redis_host, port=args.redis_port)
+        worker_connection = redis.Redis(host=args.redis_host, port=args.redis_port)
+
+    app = create_app(args.latency, args.jitter, args.error_rate, args.image_size)
+    async with TestServer(app) as stability:
+        client = StabilityClient(
+            api_key="benchmark", base_url=str(stability.make_url(""))
+        )
+        worker = Worker(worker_connection, args.concurrency, client)
+        worker_task = asyncio.create_task(worker.loop())
+
+        job_queue = JobQueue(bot_connection)
+        listener = ResultListener(bot_connection)
+        await listener.start()
+
+        # prompts must be unique, or the worker would serve them from its cache.
+        run_id = uuid.uuid4().hex
+        ops_before = await redis_ops(bot_connection)
+        start = time.monotonic()
+        tasks = []
+        for i in range(args.prompts):
+            tasks.append(
+                asyncio.create_task(
+                    send_prompt(
+                        bot_connection,
+                        job_queue,
+                        listener,
+                        f"benchmark-{run_id}-{i}",
+                        str(random.randrange(args.users)),
+                        f"benchmark {run_id} {i} -n {args.images}",
+                        args.timeout,
+                    )
+                )
+            )
+            # prompts arrive as a poisson process
+            await asyncio.sleep(random.expovariate(args.rate))
+        latencies = await asyncio.gather(*tasks)
+        duration = time.monotonic() - start
+        ops_after = await redis_ops(bot_connection)
+
+        worker.stop()
+        await worker_task
+        await listener.stop()
+
+    return Report(
+        prompts=args.prompts,
+        failed=sum(latency is None for latency in latencies),
+        duration=duration,
+        latencies=[latency for latency in latencies if latency is not None],
+        redis_ops=(
+            ops_after - ops_before
+            if ops_before is not None and ops_after is not None
+            else None
+        ),
+        peak_rss_kib=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Drive a worker and the result listener of the bot at a target prompt "
+            "rate, against a local stand-in of Stability AI."
+        )
+    )
+    parser.add_argument("--prompts", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=10, help="prompts per second")
+    parser.add_argument("--images", type=int, default=1, help="images per prompt")
+    parser.add_argument(
+        "--users", type=int, default=100, help="number of users sending prompts"
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--image-size", type=int, default=512 * 1024)
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument(
+        "--fake-redis",
+        action="store_true",
+        help="use an in-process fakeredis server instead of a redis instance",
+    )
+    asyncio.run(run(parser.parse_args())).print()
@@ -0,0 +1,86 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import argparse
+import os
+import shlex
+import timeit
+from typing import Callable
+
+from droombot.models import (
+    FinishReason,
+    PubSubMessage,
+    TextToImageRequestV2Core,
+    TextToImageRequestV2SD3,
+    TextToImageResponse,
+    pubsub_to_t2i,
+)
+from droombot.results import decode_responses, encode_responses
+from droombot.utils import text_to_image_result_to_buffer
+
+
+def argparse_pubsub_to_t2i(message: PubSubMessage) -> object:
+    """The argparse based parser of droombot 0.2, as a baseline
+
+    It does not fan out to multiple requests, so it does less work than
+    pubsub_to_t2i for a count above 1.
+    """
+    parser = argparse.ArgumentParser(exit_on_error=False)
+    parser.add_argument(
+        "-m", "--model", choices=["core", "sd3", "sd3-turbo"], default="core"
+    )
+    parser.add_argument("-n", "--count", type=int, default=1)
+    prompt, maybe_dash, options = message.text_prompt.partition("-")
+    args, _ = parser.parse_known_args(shlex.split(maybe_dash + options), None)
+    if args.model == "core":
+        return [TextToImageRequestV2Core(prompt=prompt.strip())]
+    return [TextToImageRequestV2SD3(prompt=prompt.strip(), model=args.model)]
+
+
+def benchmarks(image_size: int) -> dict[str, Callable[[], object]]:
+    message = PubSubMessage(
+        interaction_id="1",
+        text_prompt="A table with (red:0.5) raspberries and (purple:0.5) blueberries "
+        "-m sd3-turbo -n 4 -a 16:9",
+    )
+    responses = [
+        TextToImageResponse(
+            image=os.urandom(image_size), finish_reason=FinishReason.SUCCESS, seed=i
+        )
+        for i in range(4)
+    ]
+    encoded = encode_responses(responses)
+    return {
+        "pubsub_to_t2i": lambda: pubsub_to_t2i(message),
+        "pubsub_to_t2i (argparse baseline)": lambda: argparse_pubsub_to_t2i(message),
+        "encode_responses": lambda: encode_responses(responses),
+        "decode_responses": lambda: decode_responses(encoded),
+        "text_to_image_result_to_buffer": lambda: text_to_image_result_to_buffer(
+            responses[0]
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of hot paths")
+    parser.add_argument("--image-size", type=int, default=512 * 1024)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, func in benchmarks(args.image_size).items():
+        timer = timeit.Timer(func)
+        number, _ = timer.autorange()
+        # the minimum is the least disturbed by other processes.
+        best = min(timer.repeat(repeat=args.repeat, number=number)) / number
+        print(f"{name:<36} {best * 1e6:10.1f} µs per call")
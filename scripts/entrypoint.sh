@@ -1,4 +1,3 @@
 #!/usr/bin/env bash
 
-POETRY=${POETRY_HOME}/venv/bin/poetry
-exec "${POETRY}" run droombot "${1}"
+exec droombot "$@"
@@ -13,80 +13,369 @@
 #    limitations under the License.
 
 import asyncio
+import dataclasses
+import email.utils
 import logging
+import random
+import time
+import types
 
 import aiohttp
 
-from .config import STABILITY_API_KEY
+from .config import (
+    STABILITY_API_KEY,
+    STABILITY_BASE_URL,
+    STABILITY_CONNECT_TIMEOUT,
+    STABILITY_MAX_ATTEMPTS,
+    STABILITY_MAX_CONNECTIONS,
+    STABILITY_MAX_IMAGE_BYTES,
+    STABILITY_READ_TIMEOUT,
+    STABILITY_RETRY_DEADLINE,
+)
+from .metrics import STABILITY_LATENCY
 from .models import (
     TextToImageRequestV2Core,
     TextToImageRequestV2SD3,
     TextToImageResponse,
 )
-from .version import VERSION
+from .ratelimit import RedisTokenBucket
+from .tracing import annotate, span
+from .version import get_version
 
 logger = logging.getLogger(__name__)
 
-CORE_TEXT_TO_IMAGE_BASE_URL = (
-    "https://api.stability.ai/v2beta/stable-image/generate/core"
-)
-SD3_TEXT_TO_IMAGE_BASE_URL = "https://api.stability.ai/v2beta/stable-image/generate/sd3"
-
-
-async def text_to_image(
-    session: aiohttp.ClientSession,
-    request: TextToImageRequestV2Core | TextToImageRequestV2SD3,
-    timeout: int = 300,
-) -> list[TextToImageResponse]:
-    """Call Stability with a text to image request
-
-    :param session: AIOhttp session
-    :param request: the incoming request
-    :param timeout: timeout in seconds, defaults to 300. Don't set too low, as
-        image generation takes some time.
-    :return: list of responses, one for each text prompt
-    :raises: timeout
+CORE_TEXT_TO_IMAGE_PATH = "/v2beta/stable-image/generate/core"
+SD3_TEXT_TO_IMAGE_PATH = "/v2beta/stable-image/generate/sd3"
+
+# Seconds to keep idle connections open for reuse.
+KEEPALIVE_TIMEOUT = 60
+# Seconds to cache DNS lookups.
+DNS_CACHE_TTL = 300
+# Images are read from responses in chunks of this many bytes.
+CHUNK_SIZE = 64 * 1024
+
+
+class StabilityError(Exception):
+    """A call to Stability failed
+
+    :param message: description of the failure
+    :param status: http status of the response, None if there was no response
+    :param retry_after: seconds after which to retry, as indicated by Stability
+    :param retryable: whether the call may be retried, None to derive it from the
+        status
+    """
+
+    def __init__(
+        self,
+        message: str,
+        status: int | None = None,
+        retry_after: float | None = None,
+        retryable: bool | None = None,
+    ):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self._retryable = retryable
+
+    @property
+    def retryable(self) -> bool:
+        """Whether the call may succeed if it is retried
+
+        That is the case when Stability could not be reached or timed out, when it
+        is rate limiting us, or when it had an internal error.
+        """
+        if self._retryable is not None:
+            return self._retryable
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse the value of a Retry-After header
+
+    :param value: number of seconds, or a http date
+    :return: number of seconds to wait, or None if the value could not be parsed
     """
-    match request:
-        case TextToImageRequestV2Core():
-            logger.info("Incoming call for text-to-image generation for Core")
-            url = CORE_TEXT_TO_IMAGE_BASE_URL
-        case TextToImageRequestV2SD3():
-            logger.info("Incoming call for text-to-image generation for SD3")
-            url = SD3_TEXT_TO_IMAGE_BASE_URL
-        case _:
-            raise ValueError(f"Unsupported request: {type(request)}")
-
-    user_agent = f"droombot/{VERSION}"
-    headers = {
-        "Authorization": f"Bearer {STABILITY_API_KEY}",
-        "User-Agent": user_agent,
-        "accept": "application/json",
-    }
-
-    raw_post_data = request.model_dump(mode="json")
-    writer = aiohttp.MultipartWriter("form-data")
-    # filter out values that are None
-    for k, v in raw_post_data.items():
-        if v is None:
-            continue
-        writer.append(
-            aiohttp.StringPayload(value=str(v)),
-            headers={aiohttp.hdrs.CONTENT_DISPOSITION: f'form-data; name="{k}"'},
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+@dataclasses.dataclass
+class RetryPolicy:
+    """When to retry failed calls to Stability
+
+    Retries back off exponentially with full jitter, unless Stability tells us when
+    to retry. No attempt is made after the deadline, counted from the first attempt.
+    """
+
+    max_attempts: int = STABILITY_MAX_ATTEMPTS
+    # seconds
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    deadline: float = STABILITY_RETRY_DEADLINE
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float:
+        """Number of seconds to wait before the next attempt
+
+        :param attempt: number of the attempt that failed, starting at 1
+        :param retry_after: seconds after which to retry, as indicated by Stability
+        :return: number of seconds
+        """
+        if retry_after is not None:
+            # spread the retries of concurrent calls a little
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+
+
+@dataclasses.dataclass
+class ConnectionStats:
+    """Counters of connections made by a StabilityClient"""
+
+    # new connections; over https, each of these needs a TLS handshake.
+    created: int = 0
+    # requests that reused an open connection.
+    reused: int = 0
+
+
+class StabilityClient:
+    """Client for the Stability AI API
+
+    Owns a connection pool that keeps connections to Stability open between calls,
+    and caches DNS lookups. Use it as an async context manager, or call start and
+    close. When given a rate limiter, every attempt waits for it, and the limiter is
+    slowed down whenever Stability responds that we are making too many requests.
+
+    Images are requested as binary, rather than base64 encoded in json, and read in
+    chunks into a single buffer of at most max_image_bytes.
+    """
+
+    def __init__(
+        self,
+        api_key: str | None = STABILITY_API_KEY,
+        base_url: str = STABILITY_BASE_URL,
+        max_connections: int = STABILITY_MAX_CONNECTIONS,
+        connect_timeout: float = STABILITY_CONNECT_TIMEOUT,
+        read_timeout: float = STABILITY_READ_TIMEOUT,
+        retry_policy: RetryPolicy | None = None,
+        rate_limiter: RedisTokenBucket | None = None,
+        max_image_bytes: int = STABILITY_MAX_IMAGE_BYTES,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.max_connections = max_connections
+        # Don't set the read timeout too low, as image generation takes some time.
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "User-Agent": f"droombot/{get_version()}",
+            "accept": "image/*",
+        }
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.max_image_bytes = max_image_bytes
+        self.stats = ConnectionStats()
+        self._session: aiohttp.ClientSession | None = None
+
+    async def start(self) -> None:
+        if self._session is not None:
+            return
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_create)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=DNS_CACHE_TTL,
+        )
+        self._session = aiohttp.ClientSession(
+            base_url=self.base_url,
+            connector=connector,
+            headers=self.headers,
+            timeout=self.timeout,
+            trace_configs=[trace_config],
+        )
+
+    async def close(self) -> None:
+        if self._session is None:
+            return
+        await self._session.close()
+        self._session = None
+        logger.info(
+            f"Closed Stability client, created {self.stats.created} connections and "
+            f"reused connections {self.stats.reused} times"
+        )
+
+    async def __aenter__(self) -> "StabilityClient":
+        await self.start()
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: types.TracebackType | None,
+    ) -> None:
+        await self.close()
+
+    async def _on_connection_create(self, session, context, params) -> None:
+        self.stats.created += 1
+
+    async def _on_connection_reuse(self, session, context, params) -> None:
+        self.stats.reused += 1
+
+    async def text_to_image(
+        self, request: TextToImageRequestV2Core | TextToImageRequestV2SD3
+    ) -> list[TextToImageResponse]:
+        """Call Stability with a text to image request
+
+        Calls that fail with a retryable error are retried according to the retry
+        policy of the client.
+
+        :param request: the incoming request
+        :return: list of responses, one for each text prompt
+        :raises: StabilityError
+        """
+        match request:
+            case TextToImageRequestV2Core():
+                logger.info("Incoming call for text-to-image generation for Core")
+                path = CORE_TEXT_TO_IMAGE_PATH
+                model = "core"
+            case TextToImageRequestV2SD3():
+                logger.info("Incoming call for text-to-image generation for SD3")
+                path = SD3_TEXT_TO_IMAGE_PATH
+                model = request.model
+            case _:
+                raise ValueError(f"Unsupported request: {type(request)}")
+
+        annotate(model=model)
+        start = time.monotonic()
+        try:
+            responses = await self._retry_text_to_image(path, request)
+        except StabilityError:
+            STABILITY_LATENCY.labels(model, "error").observe(time.monotonic() - start)
+            raise
+        duration = time.monotonic() - start
+        STABILITY_LATENCY.labels(model, "success").observe(duration)
+        logger.info(
+            "Call to Stability with model %s took %.2f seconds",
+            model,
+            duration,
+            extra={"model": model, "duration": duration},
+        )
+        return responses
+
+    async def _retry_text_to_image(
+        self,
+        path: str,
+        request: TextToImageRequestV2Core | TextToImageRequestV2SD3,
+    ) -> list[TextToImageResponse]:
+        deadline = time.monotonic() + self.retry_policy.deadline
+        attempt = 1
+        while True:
+            if self.rate_limiter is not None:
+                with span("rate_limit"):
+                    await self.rate_limiter.acquire()
+            try:
+                with span("stability_request", attempt=attempt):
+                    return await self._post_text_to_image(path, request, deadline)
+            except StabilityError as e:
+                if e.status == 429 and self.rate_limiter is not None:
+                    await self.rate_limiter.penalize(e.retry_after)
+                if not e.retryable or attempt >= self.retry_policy.max_attempts:
+                    raise
+                delay = self.retry_policy.delay(attempt, e.retry_after)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                logger.warning(
+                    "Call to Stability failed on attempt %d due to: %s. "
+                    "Retrying in %.1f seconds",
+                    attempt,
+                    e,
+                    delay,
+                    extra={"attempt": attempt, "status": e.status},
+                )
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _post_text_to_image(
+        self,
+        path: str,
+        request: TextToImageRequestV2Core | TextToImageRequestV2SD3,
+        deadline: float,
+    ) -> list[TextToImageResponse]:
+        if self._session is None:
+            raise RuntimeError("Client is not started")
+
+        raw_post_data = request.model_dump(mode="json", exclude_none=True)
+        writer = aiohttp.MultipartWriter("form-data")
+        for k, v in raw_post_data.items():
+            part = writer.append(str(v))
+            part.set_content_disposition("form-data", name=k)
+
+        # a single attempt may not run past the deadline of all attempts. A total
+        # timeout of 0 would mean no timeout at all.
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise StabilityError(
+                "Deadline passed before calling Stability", retryable=False
+            )
+        timeout = aiohttp.ClientTimeout(
+            total=remaining,
+            sock_connect=self.timeout.sock_connect,
+            sock_read=self.timeout.sock_read,
         )
+        try:
+            async with self._session.post(path, data=writer, timeout=timeout) as resp:
+                annotate(status=resp.status)
+                if resp.status >= 400:
+                    body = await resp.text()
+                    logger.error("Call to Stability errored. Response: %s", body)
+                    raise StabilityError(
+                        f"Stability responded with status {resp.status}",
+                        status=resp.status,
+                        retry_after=parse_retry_after(
+                            resp.headers.get(aiohttp.hdrs.RETRY_AFTER)
+                        ),
+                    )
+                image = await self._read_image(resp)
+                headers = resp.headers
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+            raise StabilityError(f"Could not reach Stability: {e!r}") from e
 
-    async with session.post(
-        url=url, data=writer, timeout=timeout, headers=headers
-    ) as resp:
-        results = await resp.json()
-        if resp.status >= 400:
-            logger.error(f"Call to Stability errored. Response: {results}")
-            raise ValueError("An error occurred")
+        logger.info("Received a successful response from text-to-image generation.")
+        return [TextToImageResponse.from_raw_api(headers, image, request.output_format)]
 
-    # responses are encoded in an 'artifacts' item, but this is NOT
-    # mentioned in the docs.
-    logger.info("Received a successful response from text-to-image generation.")
-    return [TextToImageResponse.from_raw_api(results)]
+    async def _read_image(self, resp: aiohttp.ClientResponse) -> bytearray:
+        if (
+            resp.content_length is not None
+            and resp.content_length > self.max_image_bytes
+        ):
+            raise StabilityError(
+                f"Image of {resp.content_length} bytes is larger than the maximum of "
+                f"{self.max_image_bytes} bytes",
+                status=resp.status,
+            )
+        buffer = bytearray()
+        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+            buffer += chunk
+            if len(buffer) > self.max_image_bytes:
+                raise StabilityError(
+                    f"Image is larger than the maximum of {self.max_image_bytes} bytes",
+                    status=resp.status,
+                )
+        # not copied to bytes, so the image is held in memory only once
+        return buffer
 
 
 if __name__ == "__main__":
@@ -95,8 +384,8 @@ if __name__ == "__main__":
         request = TextToImageRequestV2Core(
             prompt="Green trees in a forest with ferns, oil painting"
         )
-        async with aiohttp.ClientSession() as session:
-            results = await text_to_image(session, request)
+        async with StabilityClient() as client:
+            results = await client.text_to_image(request)
 
         print(results[0].model_dump_json())
 
@@ -0,0 +1,81 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import logging
+import types
+from typing import Protocol
+
+import redis.asyncio as redis
+
+from .config import MAX_REQUESTS_PER_MINUTE
+from .models import (
+    TextToImageRequestV2Core,
+    TextToImageRequestV2SD3,
+    TextToImageResponse,
+)
+from .ratelimit import RedisTokenBucket
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("stability", "local")
+
+
+class TextToImageBackend(Protocol):
+    """Something that generates images for text to image requests
+
+    Backends are used as async context managers, which start and stop whatever
+    resources they need, such as connection or process pools.
+    """
+
+    async def __aenter__(self) -> "TextToImageBackend": ...
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: types.TracebackType | None,
+    ) -> None: ...
+
+    async def text_to_image(
+        self, request: TextToImageRequestV2Core | TextToImageRequestV2SD3
+    ) -> list[TextToImageResponse]: ...
+
+
+def create_backend(name: str, redis_connection: redis.Redis) -> TextToImageBackend:
+    """Create a text to image backend by name
+
+    :param name: "stability" for the Stability AI api, or "local" to run Stable
+        Diffusion on the CPUs of the worker
+    :param redis_connection: redis instance, for the rate limit of Stability
+    :return: the backend
+    """
+    # backends are imported when they are used, so a worker only imports what its
+    # backend needs, e.g. no aiohttp for the local backend.
+    match name:
+        case "stability":
+            from .api import StabilityClient
+
+            return StabilityClient(
+                rate_limiter=RedisTokenBucket(
+                    redis_connection, "stability", MAX_REQUESTS_PER_MINUTE
+                )
+            )
+        case "local":
+            from .local import LocalDiffusionBackend
+
+            return LocalDiffusionBackend()
+        case _:
+            raise ValueError(
+                f"Unknown backend: {name}. Choose from {', '.join(BACKENDS)}"
+            )
@@ -12,52 +12,87 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import asyncio
+import io
 import logging
+import sqlite3
 import time
 
-import aiolimiter
 import discord
-import pydantic
 import redis.asyncio as redis
 
-from .config import DISCORD_GUILD_IDS, MAX_REQUESTS_PER_MINUTE, REDIS_HOST, REDIS_PORT
-from .models import FinishReason, PubSubMessage, TextToImageResponse
+from .cancellation import cancel
+from .config import (
+    DISCORD_GUILD_IDS,
+    IMAGE_STORE_PATH,
+    MAX_REDIS_REQUESTS_PER_MINUTE,
+    REDIS_HOST,
+    REDIS_PORT,
+)
+from .job_queue import JobQueue
+from .log import bind_log_fields
+from .metrics import PROMPT_DURATION, RESULT_WAIT_ITERATIONS
+from .models import (
+    FinishReason,
+    PromptError,
+    PubSubMessage,
+    TextToImageRequestV2Core,
+    TextToImageRequestV2SD3,
+    TextToImageResponse,
+    parse_prompt,
+)
+from .postprocess import THUMBNAIL_FORMAT
+from .ratelimit import RedisTokenBucket
+from .results import Progress, ResultListener, delete_results, fetch_progress
+from .store import ImageStore
+from .tracing import annotate, span, trace_context
 from .utils import text_to_image_result_to_buffer
 
 logger = logging.getLogger(__name__)
 
+# Number of previous prompts of a user that can be sent again with /history.
+HISTORY_LENGTH = 25
+# Seconds to wait for the results of a prompt.
+RESULT_TIMEOUT = 900
+# How often to update the queue position of a waiting prompt, in seconds.
+STATUS_INTERVAL = 5
+# Prompts further back in the queue are not counted exactly.
+QUEUE_POSITION_LIMIT = 100
 
-LIMITER = aiolimiter.AsyncLimiter(MAX_REQUESTS_PER_MINUTE)
 
+def queue_status(position: int | None) -> str:
+    """Status of a queued prompt
+
+    :param position: number of prompts ahead in the queue, None if a worker has
+        picked up the prompt
+    :return: the status, to show to the user
+    """
+    if position is None:
+        return "Waiting for a free worker..."
+    if position == 0:
+        return "Your prompt is next in the queue..."
+    more = "+" if position >= QUEUE_POSITION_LIMIT else ""
+    return f"Your prompt is queued behind {position}{more} other prompts..."
+
+
+def image_filename(user_name: str, text: str, index: int, output_format: str) -> str:
+    return f"{user_name}_{text[:10]}_{index}.{output_format}"
 
-async def poll_interaction_result(
-    redis_connection: redis.Redis, interaction_id: str, timeout: int = 900
-) -> list[TextToImageResponse]:
-    """Poll the interaction result from redis
 
-    :param redis_connection: Redis instance to poll from
-    :param interaction_id: interaction id to retrieve
-    :param timeout: timeout in seconds, after which we bail
-    :return: list of text to image responses
-    :raises: TimeOutError
+def thumbnails(progress: Progress) -> list[discord.File]:
+    """Thumbnails of the images generated so far, to show while generating the others
+
+    :param progress: progress of the prompt
+    :return: the thumbnails as files, empty if thumbnails are disabled
     """
-    interaction_key = f"interaction:{interaction_id}"
-    start = time.monotonic()
-    while True:
-        now = time.monotonic()
-        if (now - start) >= timeout:
-            raise TimeoutError("Waited for too long, no result found")
-        async with LIMITER:
-            logger.debug(f"Polling for {interaction_key}")
-            raw_results = await redis_connection.get(interaction_key)
-        if raw_results is None:
-            logger.debug(f"Interaction {interaction_key} not found, trying again")
-            continue
-
-        logger.debug("Found results, parsing to response")
-        return pydantic.TypeAdapter(list[TextToImageResponse]).validate_json(
-            raw_results
+    return [
+        discord.File(
+            io.BytesIO(response.thumbnail),
+            filename=f"thumbnail_{index}.{THUMBNAIL_FORMAT}",
         )
+        for index, response in sorted(progress.responses.items())
+        if response.thumbnail is not None
+    ]
 
 
 def create_bot() -> discord.Bot:
@@ -67,79 +102,286 @@ def create_bot() -> discord.Bot:
     """
     bot = discord.Bot()
     redis_connection: redis.Redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    job_queue = JobQueue(redis_connection)
+    redis_limiter = RedisTokenBucket(
+        redis_connection, "redis", MAX_REDIS_REQUESTS_PER_MINUTE
+    )
+    result_listener = ResultListener(redis_connection)
+    image_store = ImageStore(IMAGE_STORE_PATH) if IMAGE_STORE_PATH else None
 
     @bot.event
     async def on_ready():
         logger.info(f"Starting bot as {bot.user}...")
 
-    @bot.slash_command(
-        description="Generate images using a text prompt", guild_ids=DISCORD_GUILD_IDS
-    )
-    async def prompt(ctx, text: str):
-        logger.info(
-            f"Receiving prompt from channel {ctx.interaction.channel_id}, "
-            f"from user {ctx.interaction.user.id}"
-        )
-        logger.info(f"Prompt message: {text}")
-        if text == "":
-            await ctx.respond(
-                f"Hi {ctx.interaction.user.mention}. Your prompt text may not be empty"
-            )
-            return
+    async def reply(
+        ctx,
+        text: str,
+        requests: list[TextToImageRequestV2Core | TextToImageRequestV2SD3],
+    ) -> None:
+        start = time.monotonic()
+        intro = f"Hi {ctx.interaction.user.mention}! Your prompt: **{text}**. "
+        await ctx.respond(intro + "Adding it to the queue...")
+        shown_status = ""
 
-        await ctx.respond(
-            f"Hi {ctx.interaction.user.mention}! Your prompt: **{text}**. "
-            "We will now be generating your image. "
-            "This may take a minute."
-        )
+        async def show_status(
+            status: str, files: list[discord.File] | None = None
+        ) -> None:
+            # the status is shown by editing the first response, with the files
+            # replacing any shown before.
+            nonlocal shown_status
+            if status == shown_status:
+                return
+            shown_status = status
+            try:
+                await ctx.edit(
+                    content=intro + status, files=files or [], attachments=[]
+                )
+            except discord.HTTPException as e:
+                logger.warning("Could not update the status of the prompt: %s", e)
+
+        async def upload(index: int, response: TextToImageResponse) -> None:
+            file = discord.File(
+                text_to_image_result_to_buffer(response),
+                filename=image_filename(
+                    ctx.interaction.user.name, text, index, response.output_format
+                ),
+            )
+            with span("upload", index=index):
+                await ctx.respond(file=file)
 
-        logger.info("Sending message to redis for worker to pick up")
+        logger.info("Adding message to the job queue for a worker to pick up")
         message = PubSubMessage(
-            interaction_id=str(ctx.interaction.id), text_prompt=text
+            interaction_id=str(ctx.interaction.id),
+            text_prompt=text,
+            guild_id=(
+                str(ctx.interaction.guild_id)
+                if ctx.interaction.guild_id is not None
+                else None
+            ),
+            user_id=str(ctx.interaction.user.id),
+            requests=requests,
+            deadline=time.time() + RESULT_TIMEOUT,
+            trace_context=trace_context(),
         )
 
-        await redis_connection.publish("droombot-prompts", message.model_dump_json())
-        logger.info("Polling for result")
+        await result_listener.register(message.interaction_id)
+        await redis_limiter.acquire()
+        with span("enqueue"):
+            entry_id = await job_queue.enqueue(message)
+        logger.info("Waiting for result")
 
+        # images are uploaded as soon as they are available, while following the
+        # progress of the others.
+        progress = Progress()
+        fetches = 0
+        uploads: dict[int, asyncio.Task] = {}
+        deadline = start + RESULT_TIMEOUT
         try:
-            image_results = await poll_interaction_result(
-                redis_connection, str(ctx.interaction.id)
-            )
+            while not progress.complete:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("Waited for too long, no result found")
+                if await result_listener.next_update(
+                    message.interaction_id, min(STATUS_INTERVAL, remaining)
+                ):
+                    await redis_limiter.acquire()
+                    with span("fetch_progress"):
+                        progress = await fetch_progress(
+                            redis_connection, message.interaction_id, progress
+                        )
+                    fetches += 1
+                elif not progress.started:
+                    await redis_limiter.acquire()
+                    position = await job_queue.position(entry_id, QUEUE_POSITION_LIMIT)
+                    await show_status(queue_status(position))
+                    continue
+
+                if progress.started and not progress.complete:
+                    await show_status(
+                        f"Generating images, {len(progress.responses)} of "
+                        f"{progress.count} done...",
+                        thumbnails(progress),
+                    )
+                for index, response in progress.responses.items():
+                    if (
+                        index not in uploads
+                        and response.finish_reason is FinishReason.SUCCESS
+                    ):
+                        uploads[index] = asyncio.create_task(upload(index, response))
+            RESULT_WAIT_ITERATIONS.observe(fetches)
+            if uploads:
+                await show_status("Uploading images...")
         except TimeoutError:
-            logger.error("Received timeout on polling for results...")
-            await ctx.respond("Image generation failed - please try again later.")
+            logger.error("Received timeout on waiting for results...")
+            if uploads:
+                await show_status(
+                    f"Here are the results so far! Only {len(uploads)} of "
+                    f"{progress.count} images were generated in time."
+                )
+            else:
+                await show_status("Image generation failed - please try again later.")
+            PROMPT_DURATION.labels("timeout").observe(time.monotonic() - start)
+            annotate(outcome="timeout")
             return
-        logger.info("Results received, converting to files")
+        finally:
+            result_listener.unregister(message.interaction_id)
+            if not progress.complete:
+                # let the workers know nobody is waiting for the images anymore
+                await cancel(redis_connection, message.interaction_id, RESULT_TIMEOUT)
+            for result in await asyncio.gather(
+                *uploads.values(), return_exceptions=True
+            ):
+                if isinstance(result, Exception):
+                    logger.error("Could not upload an image: %s", result)
 
-        if not all(r.finish_reason is FinishReason.SUCCESS for r in image_results):
-            is_error = any(r.finish_reason is FinishReason.ERROR for r in image_results)
+        logger.info("Results received")
+        image_results = [progress.responses[i] for i in sorted(progress.responses)]
+        # the results are not needed in redis anymore, once we have them.
+        await redis_limiter.acquire()
+        await delete_results(redis_connection, message.interaction_id)
+        if image_store is not None:
+            try:
+                with span("store_images"):
+                    await asyncio.to_thread(image_store.put, message, image_results)
+            except (OSError, sqlite3.Error):
+                logger.exception("Could not store images in the image store")
+
+        failures = [
+            r for r in image_results if r.finish_reason is not FinishReason.SUCCESS
+        ]
+        if not uploads:
+            is_error = any(r.finish_reason is FinishReason.ERROR for r in failures)
             is_filtered = any(
-                r.finish_reason is FinishReason.CONTENT_FILTERED for r in image_results
+                r.finish_reason is FinishReason.CONTENT_FILTERED for r in failures
             )
             if is_error:
-                await ctx.respond(
+                await show_status(
                     "Image generation failed to due to error - please try again later"
                 )
             elif is_filtered:
-                await ctx.respond(
+                await show_status(
                     "Image generation failed due to prompt being filtered. "
                     "Please try another prompt."
                 )
             else:
-                await ctx.respond("Image generation failed due to unknown error.")
+                await show_status("Image generation failed due to unknown error.")
+            PROMPT_DURATION.labels("failed").observe(time.monotonic() - start)
+            annotate(outcome="failed")
+            return
+
+        if failures:
+            await show_status(
+                f"Here are the results! {len(failures)} of {len(image_results)} "
+                "images could not be generated."
+            )
+        else:
+            await show_status("Here are the results!")
+        duration = time.monotonic() - start
+        PROMPT_DURATION.labels("success").observe(duration)
+        annotate(outcome="success", images=len(uploads))
+        logger.info(
+            "Replied with results after %.2f seconds",
+            duration,
+            extra={"duration": duration},
+        )
+
+    @bot.slash_command(
+        description="Generate images using a text prompt", guild_ids=DISCORD_GUILD_IDS
+    )
+    async def prompt(ctx, text: str):
+        # every interaction is handled in its own task
+        bind_log_fields(
+            interaction_id=str(ctx.interaction.id),
+            guild_id=ctx.interaction.guild_id,
+            user_id=ctx.interaction.user.id,
+        )
+        logger.info(
+            "Receiving prompt from channel %s, from user %s",
+            ctx.interaction.channel_id,
+            ctx.interaction.user.id,
+        )
+        logger.info("Prompt message: %s", text)
+        if text == "":
+            await ctx.respond(
+                f"Hi {ctx.interaction.user.mention}. Your prompt text may not be empty"
+            )
+            return
+
+        try:
+            requests = parse_prompt(text)
+        except PromptError as e:
+            await ctx.respond(
+                f"Hi {ctx.interaction.user.mention}. Your prompt has invalid options:\n"
+                + "\n".join(f"- {error}" for error in e.errors)
+            )
             return
 
-        logger.info("Converting response to buffers")
+        with span("prompt", interaction_id=str(ctx.interaction.id)):
+            await reply(ctx, text, requests)
 
-        files = []
-        for i, image_result in enumerate(image_results):
-            buffer = text_to_image_result_to_buffer(image_result)
-            file = discord.File(
-                buffer, filename=f"{ctx.interaction.user.name}_{text[:10]}_{i}.png"
+    if image_store is not None:
+
+        @bot.slash_command(
+            description="Send the images of one of your previous prompts again",
+            guild_ids=DISCORD_GUILD_IDS,
+        )
+        async def history(ctx, number: int = 1):
+            bind_log_fields(
+                interaction_id=str(ctx.interaction.id),
+                guild_id=ctx.interaction.guild_id,
+                user_id=ctx.interaction.user.id,
             )
-            files.append(file)
-        logger.info("Done converting to buffers")
+            if not 1 <= number <= HISTORY_LENGTH:
+                await ctx.respond(
+                    f"Hi {ctx.interaction.user.mention}. The number of your prompt "
+                    f"must be between 1 and {HISTORY_LENGTH}, 1 being the most recent."
+                )
+                return
 
-        await ctx.respond("Here are the results!", files=files)
+            interactions = await asyncio.to_thread(
+                image_store.interactions, str(ctx.interaction.user.id), number
+            )
+            if len(interactions) < number:
+                await ctx.respond(
+                    f"Hi {ctx.interaction.user.mention}. No images of your prompt "
+                    f"#{number} were found."
+                )
+                return
+            stored_images = await asyncio.to_thread(
+                image_store.images, interactions[-1]
+            )
+            images = []
+            files = []
+            for stored in stored_images:
+                image = await asyncio.to_thread(image_store.open, stored.digest)
+                if image is not None:
+                    images.append(image)
+                    files.append(
+                        discord.File(
+                            image,
+                            filename=image_filename(
+                                ctx.interaction.user.name,
+                                stored.prompt,
+                                stored.index,
+                                stored.output_format,
+                            ),
+                        )
+                    )
+            if not files:
+                await ctx.respond(
+                    f"Hi {ctx.interaction.user.mention}. The images of your prompt "
+                    f"#{number} are no longer available."
+                )
+                return
+            try:
+                await ctx.respond(
+                    f"Your prompt: **{stored_images[0].prompt}**", files=files
+                )
+            finally:
+                # discord does not close file objects it did not open itself
+                for file, image in zip(files, images):
+                    file.close()
+                    image.close()
+            logger.info("Sent %d images from history", len(files))
 
     return bot
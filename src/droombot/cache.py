@@ -0,0 +1,252 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import dataclasses
+import hashlib
+import itertools
+import json
+import logging
+import time
+
+import redis.asyncio as redis
+
+from .config import RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL
+from .metrics import CACHE_LOOKUPS, REDIS_LATENCY
+from .models import (
+    FinishReason,
+    TextToImageRequestV2Core,
+    TextToImageRequestV2SD3,
+    TextToImageResponse,
+)
+from .postprocess import PostprocessSettings
+from .results import decode_responses, encode_responses, payload_size
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = "droombot-cache"
+
+# KEYS: entry, lru, hits, misses
+# ARGV: ttl, now
+# A hit refreshes the ttl along with the lru score, so that entries only expire once
+# they were not accessed within their ttl, as put assumes.
+GET_SCRIPT = """
+local data = redis.call('HGETALL', KEYS[1])
+if #data > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    redis.call('ZADD', KEYS[2], 'XX', ARGV[2], KEYS[1])
+    redis.call('INCR', KEYS[3])
+else
+    redis.call('INCR', KEYS[4])
+end
+return data
+"""
+
+# KEYS: entry, lru, sizes, bytes
+# ARGV: ttl, now, max bytes, followed by field/value pairs of the entry
+PUT_SCRIPT = """
+local function remove(key)
+    local size = redis.call('HGET', KEYS[3], key)
+    redis.call('ZREM', KEYS[2], key)
+    redis.call('HDEL', KEYS[3], key)
+    redis.call('DEL', key)
+    if size then
+        redis.call('DECRBY', KEYS[4], size)
+    end
+end
+
+-- entries that were not accessed within their ttl have surely expired
+local expired = redis.call(
+    'ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. (ARGV[2] - ARGV[1])
+)
+for _, key in ipairs(expired) do
+    remove(key)
+end
+
+remove(KEYS[1])
+local size = 0
+for i = 4, #ARGV do
+    size = size + string.len(ARGV[i])
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], KEYS[1])
+redis.call('HSET', KEYS[3], KEYS[1], size)
+local total = redis.call('INCRBY', KEYS[4], size)
+
+local evicted = 0
+while total > tonumber(ARGV[3]) do
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, 0)
+    if #oldest == 0 then
+        break
+    end
+    remove(oldest[1])
+    total = tonumber(redis.call('GET', KEYS[4]))
+    evicted = evicted + 1
+end
+return evicted
+"""
+
+
+def request_digest(request: TextToImageRequestV2Core | TextToImageRequestV2SD3) -> str:
+    """Canonical hash of a text to image request
+
+    Two requests have the same digest if and only if they are of the same type, and
+    have the same (validated) values.
+
+    :param request: the request
+    :return: hex digest
+    """
+    canonical = json.dumps(
+        {"kind": type(request).__name__, "request": request.model_dump(mode="json")},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def settings_digest(settings: PostprocessSettings) -> str:
+    """Canonical hash of post-processing settings
+
+    :param settings: the post-processing settings
+    :return: hex digest
+    """
+    canonical = json.dumps(
+        dataclasses.asdict(settings), sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Cache of text to image results, shared by all workers through redis
+
+    Entries are keyed by the digest of the request, and of the post-processing
+    settings the results were post-processed with. Entries expire after a TTL, and
+    the least recently used entries are evicted once the total size of all entries
+    exceeds a byte budget. Only successful results are cached.
+    """
+
+    def __init__(
+        self,
+        redis_connection: redis.Redis,
+        ttl: int = RESULT_CACHE_TTL,
+        max_bytes: int = RESULT_CACHE_MAX_BYTES,
+        postprocess_settings: PostprocessSettings = PostprocessSettings(),
+    ):
+        self._redis_connection = redis_connection
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._settings_digest = settings_digest(postprocess_settings)
+        self._get_script = redis_connection.register_script(GET_SCRIPT)
+        self._put_script = redis_connection.register_script(PUT_SCRIPT)
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_bytes > 0
+
+    def digest(
+        self, request: TextToImageRequestV2Core | TextToImageRequestV2SD3
+    ) -> str:
+        """Digest of a request, and of the post-processing settings of its results
+
+        :param request: the request
+        :return: hex digests of the post-processing settings and the request
+        """
+        return f"{self._settings_digest}:{request_digest(request)}"
+
+    async def get(
+        self, request: TextToImageRequestV2Core | TextToImageRequestV2SD3
+    ) -> list[TextToImageResponse] | None:
+        """Get cached results for a request
+
+        :param request: the request
+        :return: list of responses, or None on a cache miss
+        """
+        if not self.enabled:
+            return None
+        with REDIS_LATENCY.labels("cache_get").time():
+            raw_entry = await self._get_script(
+                keys=[
+                    self._entry_key(request),
+                    f"{CACHE_PREFIX}:lru",
+                    f"{CACHE_PREFIX}:hits",
+                    f"{CACHE_PREFIX}:misses",
+                ],
+                args=[self.ttl, time.time()],
+            )
+        CACHE_LOOKUPS.labels("hit" if raw_entry else "miss").inc()
+        if not raw_entry:
+            return None
+        # scripts return hashes as a flat list of fields and values
+        return decode_responses(dict(zip(raw_entry[::2], raw_entry[1::2])))
+
+    async def put(
+        self,
+        request: TextToImageRequestV2Core | TextToImageRequestV2SD3,
+        responses: list[TextToImageResponse],
+    ) -> None:
+        """Cache the results for a request, if they are successful
+
+        :param request: the request
+        :param responses: the responses for this request
+        :return: None
+        """
+        if not self.enabled:
+            return
+        if not all(r.finish_reason is FinishReason.SUCCESS for r in responses):
+            return
+        mapping = encode_responses(responses)
+        size = payload_size(mapping)
+        if size > self.max_bytes:
+            logger.warning(f"Result of {size} bytes is too large to cache")
+            return
+        with REDIS_LATENCY.labels("cache_put").time():
+            evicted = await self._put_script(
+                keys=[
+                    self._entry_key(request),
+                    f"{CACHE_PREFIX}:lru",
+                    f"{CACHE_PREFIX}:sizes",
+                    f"{CACHE_PREFIX}:bytes",
+                ],
+                args=[
+                    self.ttl,
+                    time.time(),
+                    self.max_bytes,
+                    *itertools.chain.from_iterable(mapping.items()),
+                ],
+            )
+        if evicted:
+            logger.info(f"Evicted {evicted} entries from the result cache")
+
+    async def stats(self) -> dict[str, int]:
+        """Hit and miss counters, and current size of the cache
+
+        :return: dict with hits, misses, bytes and entries
+        """
+        async with self._redis_connection.pipeline(transaction=False) as pipe:
+            pipe.get(f"{CACHE_PREFIX}:hits")
+            pipe.get(f"{CACHE_PREFIX}:misses")
+            pipe.get(f"{CACHE_PREFIX}:bytes")
+            pipe.zcard(f"{CACHE_PREFIX}:lru")
+            hits, misses, size, entries = await pipe.execute()
+        return {
+            "hits": int(hits or 0),
+            "misses": int(misses or 0),
+            "bytes": int(size or 0),
+            "entries": int(entries),
+        }
+
+    def _entry_key(
+        self, request: TextToImageRequestV2Core | TextToImageRequestV2SD3
+    ) -> str:
+        return f"{CACHE_PREFIX}:entry:{self.digest(request)}"
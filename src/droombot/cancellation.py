@@ -0,0 +1,138 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import logging
+
+import redis.asyncio as redis
+
+from .metrics import REDIS_LATENCY
+
+logger = logging.getLogger(__name__)
+
+# The bot announces cancelled interactions on this channel, with the interaction id
+# as data.
+CANCEL_CHANNEL = "droombot-cancellations"
+
+# Seconds to wait before resubscribing after losing the connection to redis.
+RESUBSCRIBE_DELAY = 1
+
+
+def cancel_key(interaction_id: str) -> str:
+    return f"droombot-cancelled:{interaction_id}"
+
+
+async def cancel(redis_connection: redis.Redis, interaction_id: str, ttl: int) -> None:
+    """Cancel the prompt of an interaction, and announce it to the workers
+
+    Workers that did not start on the prompt yet skip it, and workers running it stop.
+
+    :param redis_connection: redis instance
+    :param interaction_id: the interaction id
+    :param ttl: number of seconds to remember the cancellation, should be longer than
+        the prompt may be waiting in the queue
+    :return: None
+    """
+    with REDIS_LATENCY.labels("cancel").time():
+        async with redis_connection.pipeline(transaction=True) as pipe:
+            pipe.set(cancel_key(interaction_id), b"1", ex=ttl)
+            pipe.publish(CANCEL_CHANNEL, interaction_id)
+            await pipe.execute()
+
+
+class CancellationListener:
+    """Watch interactions for cancellation by the bot
+
+    A single subscription to the cancellation channel is shared by all interactions.
+    Each watched interaction has a future, which is resolved when the interaction is
+    cancelled.
+
+    :param redis_connection: redis instance
+    """
+
+    def __init__(self, redis_connection: redis.Redis):
+        self._redis_connection = redis_connection
+        self._watched: dict[str, asyncio.Future[None]] = {}
+        self._subscribed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """Start listening, if not yet listening
+
+        :return: None, once subscribed to the cancellation channel
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(
+                self._listen(), name="cancellation-listener"
+            )
+        await self._subscribed.wait()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._subscribed.clear()
+
+    async def watch(self, interaction_id: str) -> asyncio.Future[None]:
+        """Watch an interaction for cancellation
+
+        :param interaction_id: the interaction id
+        :return: future that is resolved once the interaction is cancelled. It is
+            resolved already if the interaction was cancelled before.
+        """
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._watched[interaction_id] = future
+        # subscribe before looking for an earlier cancellation, so that a
+        # cancellation can not be missed.
+        await self._check([interaction_id])
+        return future
+
+    def unwatch(self, interaction_id: str) -> None:
+        self._watched.pop(interaction_id, None)
+
+    def _notify(self, interaction_id: str) -> None:
+        future = self._watched.get(interaction_id)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def _check(self, interaction_ids: list[str]) -> None:
+        if not interaction_ids:
+            return
+        with REDIS_LATENCY.labels("check_cancelled").time():
+            cancelled = await self._redis_connection.mget(
+                [cancel_key(i) for i in interaction_ids]
+            )
+        for interaction_id, value in zip(interaction_ids, cancelled):
+            if value is not None:
+                self._notify(interaction_id)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self._redis_connection.pubsub() as pubsub:
+                    await pubsub.subscribe(CANCEL_CHANNEL)
+                    self._subscribed.set()
+                    # cancellations may have been announced while we were not
+                    # subscribed.
+                    await self._check(list(self._watched))
+
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        self._notify(message["data"].decode("utf-8"))
+            except redis.ConnectionError as e:
+                logger.error(f"Lost subscription to {CANCEL_CHANNEL} due to: {e}")
+                self._subscribed.clear()
+                await asyncio.sleep(RESUBSCRIBE_DELAY)
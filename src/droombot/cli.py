@@ -17,31 +17,81 @@ import logging
 
 import click
 
-from .bot import create_bot
-from .config import DISCORD_BOT_TOKEN
+from .config import DISCORD_BOT_TOKEN, METRICS_PORT, WORKER_PROCESSES
 from .log import init_logging
-from .worker import Worker
 
 logger = logging.getLogger(__name__)
 
+# Modules are imported by the subcommand that needs them, so a worker does not pay for
+# importing discord, and the server does not pay for importing the worker.
+SUBCOMMAND_MODULES = {
+    "server": ("droombot.bot", "droombot.metrics", "droombot.tracing"),
+    "worker": ("droombot.supervisor", "droombot.worker"),
+}
+
 
 init_logging()
 
 
-@click.group()
-def cli():
-    pass
+@click.group(invoke_without_command=True)
+@click.option(
+    "--profile-startup",
+    is_flag=True,
+    help="Report the time spent importing modules at startup of the command, "
+    "instead of running it. Without a command, reports on all commands.",
+)
+@click.pass_context
+def cli(ctx: click.Context, profile_startup: bool):
+    if profile_startup:
+        from .startup import startup_report
+
+        if ctx.invoked_subcommand is None:
+            # modules shared by commands are imported once
+            modules = list(
+                dict.fromkeys(m for ms in SUBCOMMAND_MODULES.values() for m in ms)
+            )
+        else:
+            modules = list(SUBCOMMAND_MODULES.get(ctx.invoked_subcommand, ()))
+        click.echo(startup_report(["droombot.cli", *modules]))
+        ctx.exit()
+    if ctx.invoked_subcommand is None:
+        click.echo(ctx.get_help())
 
 
 @cli.command("server")
 def server():
+    from .bot import create_bot
+    from .metrics import start_metrics_server
+    from .tracing import init_tracing
+
     logger.info("Starting server application...")
+    start_metrics_server(METRICS_PORT)
+    init_tracing("droombot-server")
     bot = create_bot()
     bot.run(DISCORD_BOT_TOKEN)
 
 
 @cli.command("worker")
-def worker():
+@click.option(
+    "--processes",
+    type=click.IntRange(min=1),
+    default=WORKER_PROCESSES,
+    show_default=True,
+    help="Number of worker processes to run.",
+)
+def worker(processes: int):
     logger.info("Starting worker application...")
+    if processes > 1:
+        from .supervisor import Supervisor
+
+        Supervisor(processes).run()
+        return
+
+    from .metrics import start_metrics_server
+    from .tracing import init_tracing
+    from .worker import Worker
+
+    start_metrics_server(METRICS_PORT)
+    init_tracing("droombot-worker")
     w = Worker()
     w.run()
@@ -26,6 +26,16 @@ DISCORD_GUILD_IDS = [
 ]
 
 
+# Logging settings
+# Level of the droombot logs.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# Format of the logs, "text" or "json".
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# Levels of specific loggers, as comma-separated logger:level pairs. E.g.
+# "droombot.worker:DEBUG,discord:INFO"
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+
+
 # Redis settings
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
@@ -33,6 +43,129 @@ REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
 REDIS_KEY_LIFETIME = int(os.environ.get("REDIS_KEY_LIFETIME", 300))
 
 # Concurrency settings
-# Maximum number of requests per minute to redis and Stability. Note that
-# bursty behaviour may still happen, as long as it stays less than the maximum.
+# Maximum number of requests per minute to Stability, shared by all workers. The
+# rate is lowered temporarily when Stability tells us to slow down.
 MAX_REQUESTS_PER_MINUTE = int(os.environ.get("MAX_REQUESTS_PER_MINUTE", 100))
+# Maximum number of prompts queued and results fetched per minute by the bot.
+MAX_REDIS_REQUESTS_PER_MINUTE = int(
+    os.environ.get("MAX_REDIS_REQUESTS_PER_MINUTE", 6_000)
+)
+# Maximum (approximate) number of entries kept in the prompt stream.
+REDIS_STREAM_MAXLEN = int(os.environ.get("REDIS_STREAM_MAXLEN", 10_000))
+
+# Worker settings
+# Maximum number of prompts a worker reads from the stream in one go.
+WORKER_BATCH_SIZE = int(os.environ.get("WORKER_BATCH_SIZE", 10))
+# Number of seconds a prompt may be pending on a worker, before another worker
+# assumes it died and claims it. Should be longer than a Stability call may take.
+WORKER_CLAIM_IDLE_TIME = int(os.environ.get("WORKER_CLAIM_IDLE_TIME", 600))
+# Maximum number of prompts a worker generates images for at the same time.
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 4))
+# Number of seconds a stopping worker waits for running prompts to finish, before
+# putting them back in the queue.
+WORKER_DRAIN_TIMEOUT = int(os.environ.get("WORKER_DRAIN_TIMEOUT", 60))
+# Maximum number of prompts a worker holds on to, waiting to be run. The worker
+# picks the next prompt to run fairly from these.
+WORKER_MAX_HELD = int(os.environ.get("WORKER_MAX_HELD", 100))
+# Number of worker processes `droombot worker` starts, each with its own event loop
+# and connections. Crashed or unresponsive processes are restarted.
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 1))
+# Seconds after which a worker process that has not reported to be alive is
+# considered unresponsive, and restarted.
+WORKER_HEARTBEAT_TIMEOUT = int(os.environ.get("WORKER_HEARTBEAT_TIMEOUT", 60))
+# Maximum number of prompts of a single user a worker runs at the same time. 0 means
+# no maximum. Prompts of users at their maximum don't take up room in the local
+# queue, so a worker can look past the backlog of a single user.
+MAX_PROMPTS_IN_FLIGHT_PER_USER = int(
+    os.environ.get("MAX_PROMPTS_IN_FLIGHT_PER_USER", 2)
+)
+# Maximum number of prompts without a user a worker runs at the same time, such as
+# prompts queued by older versions of the bot. They share this maximum as if they
+# were of a single user. 0 means no maximum.
+MAX_ANONYMOUS_PROMPTS_IN_FLIGHT = int(
+    os.environ.get("MAX_ANONYMOUS_PROMPTS_IN_FLIGHT", 2)
+)
+# Relative share of the workers each guild gets. Comma-separated guild_id:weight
+# pairs, guilds not listed have a weight of 1.
+GUILD_WEIGHTS = os.environ.get("GUILD_WEIGHTS", "")
+
+# Result cache settings
+# Number of seconds results of identical requests are reused. 0 disables the cache.
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 86_400))
+# Maximum total size of the result cache in bytes. Least recently used results are
+# evicted once it is exceeded.
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 256 * 1024**2))
+
+# Maximum number of images that can be requested with a single prompt.
+MAX_IMAGES_PER_PROMPT = int(os.environ.get("MAX_IMAGES_PER_PROMPT", 4))
+
+# Port to serve prometheus metrics on, at /metrics. 0 disables the endpoint.
+# Requires the metrics extra.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
+# Where to export traces of prompts to: "otlp" for an OpenTelemetry collector, as
+# configured by the standard OTEL_EXPORTER_OTLP_* variables, or "file" for
+# TRACING_FILE. Empty disables tracing. Requires the tracing extra.
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "")
+# File the file exporter appends spans to, as json lines.
+TRACING_FILE = os.environ.get("TRACING_FILE", "droombot-spans.jsonl")
+
+# Image post-processing settings
+# Format to convert all images to: png, jpeg or webp. Empty keeps the format
+# requested with the prompt.
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "")
+# Maximum size of an image in bytes. Larger images are compressed, and scaled down
+# if needed. 0 means no maximum.
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", 8 * 1024**2))
+# Size in pixels of the longest side of thumbnails. 0 disables thumbnails.
+IMAGE_THUMBNAIL_SIZE = int(os.environ.get("IMAGE_THUMBNAIL_SIZE", 0))
+# Number of processes per worker for post-processing images. 0 post-processes
+# images in threads of the worker process instead.
+POSTPROCESS_PROCESSES = int(os.environ.get("POSTPROCESS_PROCESSES", 2))
+
+# Image store settings
+# Directory the bot keeps the images it replied with in, for /history. Empty disables
+# the image store.
+IMAGE_STORE_PATH = os.environ.get("IMAGE_STORE_PATH", "")
+# Maximum total size of the images in the store in bytes. Least recently accessed
+# images are evicted once it is exceeded.
+IMAGE_STORE_MAX_BYTES = int(os.environ.get("IMAGE_STORE_MAX_BYTES", 1024**3))
+
+# Backend that workers generate images with: "stability" for the Stability AI api,
+# or "local" to run Stable Diffusion on the CPUs of the worker.
+WORKER_BACKEND = os.environ.get("WORKER_BACKEND", "stability")
+
+# Local backend settings
+# Model to run, by name on Hugging Face or as a path to a local copy.
+LOCAL_MODEL = os.environ.get("LOCAL_MODEL", "stabilityai/sd-turbo")
+# Number of processes per worker running the model.
+LOCAL_PROCESSES = int(os.environ.get("LOCAL_PROCESSES", 1))
+# Number of inference steps per image.
+LOCAL_STEPS = int(os.environ.get("LOCAL_STEPS", 1))
+# Guidance scale. Models distilled without guidance, like sd-turbo, need 0.
+LOCAL_GUIDANCE_SCALE = float(os.environ.get("LOCAL_GUIDANCE_SCALE", 0.0))
+# Width and height of square images. Other aspect ratios have about as many pixels.
+LOCAL_IMAGE_SIZE = int(os.environ.get("LOCAL_IMAGE_SIZE", 512))
+# Maximum number of images of the same size generated in a single pass.
+LOCAL_MAX_BATCH_SIZE = int(os.environ.get("LOCAL_MAX_BATCH_SIZE", 4))
+# Seconds to wait for more requests to batch with.
+LOCAL_BATCH_WINDOW = float(os.environ.get("LOCAL_BATCH_WINDOW", 0.05))
+
+# Stability settings
+STABILITY_BASE_URL = os.environ.get("STABILITY_BASE_URL", "https://api.stability.ai")
+# Maximum number of open connections to Stability, per worker.
+STABILITY_MAX_CONNECTIONS = int(os.environ.get("STABILITY_MAX_CONNECTIONS", 10))
+# Number of seconds to wait for a connection to Stability.
+STABILITY_CONNECT_TIMEOUT = float(os.environ.get("STABILITY_CONNECT_TIMEOUT", 10))
+# Number of seconds to wait for data from Stability. Image generation takes some
+# time, so don't set this too low.
+STABILITY_READ_TIMEOUT = float(os.environ.get("STABILITY_READ_TIMEOUT", 300))
+# Maximum number of attempts for a call to Stability that fails with a retryable
+# error, such as a timeout or rate limiting.
+STABILITY_MAX_ATTEMPTS = int(os.environ.get("STABILITY_MAX_ATTEMPTS", 4))
+# Number of seconds after the first attempt after which no more attempts are made.
+STABILITY_RETRY_DEADLINE = float(os.environ.get("STABILITY_RETRY_DEADLINE", 600))
+# Maximum size in bytes of an image returned by Stability. Larger images fail.
+STABILITY_MAX_IMAGE_BYTES = int(
+    os.environ.get("STABILITY_MAX_IMAGE_BYTES", 64 * 1024**2)
+)
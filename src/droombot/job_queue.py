@@ -0,0 +1,335 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import logging
+import os
+import socket
+
+import msgpack  # type: ignore[import-untyped]
+import redis.asyncio as redis
+from redis.exceptions import ResponseError
+
+from .config import REDIS_STREAM_MAXLEN
+from .metrics import REDIS_LATENCY
+from .models import PubSubMessage, TextToImageRequestV2Core, TextToImageRequestV2SD3
+
+logger = logging.getLogger(__name__)
+
+PROMPT_STREAM = "droombot-prompts"
+WORKER_GROUP = "droombot-workers"
+
+# Version of the encoding of jobs in the stream. Bump it on incompatible changes.
+JOB_VERSION = 1
+REQUEST_KINDS: dict[
+    str, type[TextToImageRequestV2Core] | type[TextToImageRequestV2SD3]
+] = {"core": TextToImageRequestV2Core, "sd3": TextToImageRequestV2SD3}
+
+# Resets the idle time of entries that are still pending on the consumer. Entries
+# claimed by another consumer in the meantime are left alone.
+# KEYS: stream
+# ARGV: group, consumer, followed by entry ids
+KEEP_ALIVE_SCRIPT = """
+local owned = {}
+for i = 3, #ARGV do
+    local pending = redis.call('XPENDING', KEYS[1], ARGV[1], ARGV[i], ARGV[i], 1)
+    if #pending > 0 and pending[1][2] == ARGV[2] then
+        table.insert(owned, ARGV[i])
+    end
+end
+if #owned > 0 then
+    local args = {KEYS[1], ARGV[1], ARGV[2], 0}
+    for _, entry_id in ipairs(owned) do
+        table.insert(args, entry_id)
+    end
+    table.insert(args, 'JUSTID')
+    redis.call('XCLAIM', unpack(args))
+end
+return owned
+"""
+
+# A stream entry as read from the queue. The message is None if the entry could not
+# be parsed; it should still be acknowledged so it is not redelivered.
+QueueEntry = tuple[str, PubSubMessage | None]
+
+
+def default_consumer_name() -> str:
+    """Name of this process in the consumer group
+
+    :return: consumer name, unique per host and process
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def encode_job(message: PubSubMessage) -> bytes:
+    """Encode a message, including its parsed requests, as a compact job payload
+
+    Fields of the requests that have their default value are left out.
+
+    :param message: the message
+    :return: msgpack encoded job
+    """
+    requests = []
+    for request in message.requests:
+        kind = "core" if isinstance(request, TextToImageRequestV2Core) else "sd3"
+        requests.append([kind, request.model_dump(exclude_defaults=True)])
+    return msgpack.packb(
+        {
+            "interaction_id": message.interaction_id,
+            "text_prompt": message.text_prompt,
+            "guild_id": message.guild_id,
+            "user_id": message.user_id,
+            "requests": requests,
+            "deadline": message.deadline,
+            "trace_context": message.trace_context,
+        }
+    )
+
+
+def decode_job(payload: bytes) -> PubSubMessage:
+    """Decode a job payload, as encoded by encode_job
+
+    :param payload: msgpack encoded job
+    :return: the message
+    :raises: ValueError if the payload is invalid
+    """
+    try:
+        raw = msgpack.unpackb(payload)
+        if not isinstance(raw, dict):
+            raise ValueError(f"Job payload is not a map, but {type(raw).__name__}")
+        requests = [
+            REQUEST_KINDS[kind].model_validate(fields)
+            for kind, fields in raw.pop("requests")
+        ]
+        return PubSubMessage(**raw, requests=requests)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid job payload: {e!r}") from e
+
+
+class JobQueue:
+    """Job queue backed by a Redis stream with a consumer group
+
+    The bot appends prompts to the stream, and workers read from it as members of
+    the same consumer group. Each entry is therefore delivered to exactly one worker,
+    and stays pending until that worker acknowledges it. Entries pending on a
+    consumer that died can be claimed by another worker.
+    """
+
+    def __init__(
+        self,
+        redis_connection: redis.Redis,
+        stream: str = PROMPT_STREAM,
+        group: str = WORKER_GROUP,
+        consumer: str | None = None,
+    ):
+        self._redis_connection = redis_connection
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or default_consumer_name()
+        self._keep_alive_script = redis_connection.register_script(KEEP_ALIVE_SCRIPT)
+
+    async def ensure_group(self) -> None:
+        """Create the stream and consumer group, if they do not exist yet
+
+        :return: None
+        """
+        try:
+            await self._redis_connection.xgroup_create(
+                self.stream, self.group, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        else:
+            logger.info(f"Created consumer group {self.group} on {self.stream}")
+
+    async def enqueue(self, message: PubSubMessage) -> str:
+        """Append a message to the stream
+
+        :param message: message to append
+        :return: the stream entry id
+        """
+        with REDIS_LATENCY.labels("enqueue").time():
+            entry_id = await self._redis_connection.xadd(
+                self.stream,
+                self._entry_fields(message),
+                maxlen=REDIS_STREAM_MAXLEN,
+                approximate=True,
+            )
+        return _decode(entry_id)
+
+    async def read(self, count: int, block: int | None = None) -> list[QueueEntry]:
+        """Read new entries for this consumer
+
+        :param count: maximum number of entries to read
+        :param block: milliseconds to block when no entries are available. None
+            means don't block.
+        :return: list of queue entries
+        """
+        response = await self._redis_connection.xreadgroup(
+            self.group, self.consumer, {self.stream: ">"}, count=count, block=block
+        )
+        if not response:
+            return []
+        # response is a list of [stream, entries] pairs, we only read one stream.
+        _, entries = response[0]
+        return [self._parse_entry(entry_id, fields) for entry_id, fields in entries]
+
+    async def claim_stale(self, min_idle_time: int, count: int) -> list[QueueEntry]:
+        """Claim entries that have been pending on another consumer for too long
+
+        :param min_idle_time: minimum idle time in milliseconds before an entry is
+            considered stale
+        :param count: maximum number of entries to claim
+        :return: list of claimed queue entries
+        """
+        response = await self._redis_connection.xautoclaim(
+            self.stream,
+            self.group,
+            self.consumer,
+            min_idle_time=min_idle_time,
+            start_id="0-0",
+            count=count,
+        )
+        # redis >= 7 also returns a list of deleted ids, which we don't need.
+        entries = response[1]
+        claimed = [
+            self._parse_entry(entry_id, fields)
+            for entry_id, fields in entries
+            if fields is not None
+        ]
+        if claimed:
+            logger.warning(f"Claimed {len(claimed)} stale entries from {self.stream}")
+        return claimed
+
+    async def keep_alive(self, entry_ids: list[str]) -> list[str]:
+        """Reset the idle time of entries pending on this consumer
+
+        Entries that are held or run for longer than the claim idle time would
+        otherwise be claimed by other consumers, and run twice.
+
+        :param entry_ids: ids of the entries held by this consumer
+        :return: ids of the entries that are still pending on this consumer. The
+            others were acknowledged, or claimed by another consumer.
+        """
+        with REDIS_LATENCY.labels("keep_alive").time():
+            owned = await self._keep_alive_script(
+                keys=[self.stream], args=[self.group, self.consumer, *entry_ids]
+            )
+        return [_decode(entry_id) for entry_id in owned]
+
+    async def ack(self, entry_id: str) -> None:
+        """Acknowledge an entry, so it will not be delivered again
+
+        :param entry_id: the stream entry id
+        :return: None
+        """
+        with REDIS_LATENCY.labels("ack").time():
+            await self._redis_connection.xack(self.stream, self.group, entry_id)
+
+    async def depth(self) -> int:
+        """Number of entries not yet read or acknowledged by the consumer group
+
+        :return: number of entries
+        """
+        with REDIS_LATENCY.labels("depth").time():
+            groups = await self._redis_connection.xinfo_groups(self.stream)
+        for group in groups:
+            if _decode(group["name"]) == self.group:
+                # lag is unknown (None) after entries were deleted from the stream.
+                return group["pending"] + (group.get("lag") or 0)
+        return 0
+
+    async def position(self, entry_id: str, limit: int = 100) -> int | None:
+        """Number of entries ahead of an entry, that were not yet read by a worker
+
+        :param entry_id: the stream entry id
+        :param limit: maximum number of entries to count
+        :return: number of entries, at most limit, or None if the entry was read
+        """
+        with REDIS_LATENCY.labels("position").time():
+            groups = await self._redis_connection.xinfo_groups(self.stream)
+            last_delivered = next(
+                (
+                    _decode(group["last-delivered-id"])
+                    for group in groups
+                    if _decode(group["name"]) == self.group
+                ),
+                "0-0",
+            )
+            if _parse_id(entry_id) <= _parse_id(last_delivered):
+                return None
+            ahead = await self._redis_connection.xrange(
+                self.stream, min=f"({last_delivered}", max=f"({entry_id}", count=limit
+            )
+        return len(ahead)
+
+    async def requeue(self, entry_id: str, message: PubSubMessage) -> str:
+        """Put an entry back at the end of the stream, for any worker to pick up
+
+        :param entry_id: the stream entry id to acknowledge
+        :param message: message of the entry
+        :return: the new stream entry id
+        """
+        async with self._redis_connection.pipeline(transaction=True) as pipe:
+            pipe.xadd(
+                self.stream,
+                self._entry_fields(message),
+                maxlen=REDIS_STREAM_MAXLEN,
+                approximate=True,
+            )
+            pipe.xack(self.stream, self.group, entry_id)
+            new_entry_id, _ = await pipe.execute()
+        logger.info(f"Requeued entry {entry_id} as {_decode(new_entry_id)}")
+        return _decode(new_entry_id)
+
+    @staticmethod
+    def _entry_fields(message: PubSubMessage) -> dict[str, bytes | int]:
+        return {"version": JOB_VERSION, "job": encode_job(message)}
+
+    @staticmethod
+    def _parse_entry(entry_id: bytes | str, fields: dict) -> QueueEntry:
+        entry_id = _decode(entry_id)
+        try:
+            if b"job" in fields:
+                version = int(fields[b"version"])
+                if version != JOB_VERSION:
+                    raise ValueError(f"Unsupported job version {version}")
+                message = decode_job(fields[b"job"])
+            else:
+                # entries queued by older versions only hold the text prompt
+                message = PubSubMessage.model_validate_json(fields[b"message"])
+        except (KeyError, ValueError) as e:
+            logger.error(f"Could not parse entry {entry_id} from stream due to: {e}")
+            return entry_id, None
+        return entry_id, message
+
+
+def _decode(value: bytes | str) -> str:
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+def entry_time(entry_id: str) -> float:
+    """Time at which an entry was added to the stream
+
+    :param entry_id: the stream entry id
+    :return: unix time, according to the clock of redis
+    """
+    return _parse_id(entry_id)[0] / 1000
+
+
+def _parse_id(entry_id: str) -> tuple[int, int]:
+    milliseconds, _, sequence = entry_id.partition("-")
+    return int(milliseconds), int(sequence or 0)
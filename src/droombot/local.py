@@ -0,0 +1,341 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import concurrent.futures
+import dataclasses
+import importlib.util
+import io
+import logging
+import multiprocessing
+import os
+import random
+import time
+import types
+from typing import Any, Awaitable, Callable, Generic, Hashable, TypeVar
+
+from .config import (
+    LOCAL_BATCH_WINDOW,
+    LOCAL_GUIDANCE_SCALE,
+    LOCAL_IMAGE_SIZE,
+    LOCAL_MAX_BATCH_SIZE,
+    LOCAL_MODEL,
+    LOCAL_PROCESSES,
+    LOCAL_STEPS,
+)
+from .models import (
+    SEED_MAX,
+    FinishReason,
+    TextToImageRequestV2Core,
+    TextToImageRequestV2SD3,
+    TextToImageResponse,
+)
+from .postprocess import ignore_interrupts
+
+logger = logging.getLogger(__name__)
+
+# The local backend needs these packages, which are not installed with droombot.
+REQUIRED_PACKAGES = ("torch", "diffusers", "transformers")
+
+Key = TypeVar("Key", bound=Hashable)
+Item = TypeVar("Item")
+Result = TypeVar("Result")
+
+
+class Batcher(Generic[Key, Item, Result]):
+    """Collect items with the same key into batches, to be run at once
+
+    A batch is run once it is full, or once its first item has waited for the batch
+    window, whichever comes first.
+
+    :param run_batch: runs a batch of items with the same key, returning a result
+        per item
+    :param max_batch_size: maximum number of items in a batch
+    :param window: seconds to wait for more items, before running a batch
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Key, list[Item]], Awaitable[list[Result]]],
+        max_batch_size: int,
+        window: float,
+    ):
+        self._run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._pending: dict[Key, list[tuple[Item, asyncio.Future[Result]]]] = {}
+        self._timers: dict[Key, asyncio.TimerHandle] = {}
+        self._running: set[asyncio.Task] = set()
+
+    async def submit(self, key: Key, item: Item) -> Result:
+        """Add an item to the batch of its key, and wait for its result
+
+        :param key: items can only be batched with items of the same key
+        :param item: the item
+        :return: the result of the item
+        """
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[Result] = loop.create_future()
+        batch = self._pending.setdefault(key, [])
+        batch.append((item, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key: Key) -> None:
+        if (timer := self._timers.pop(key, None)) is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(key, batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(
+        self, key: Key, batch: list[tuple[Item, asyncio.Future[Result]]]
+    ) -> None:
+        try:
+            results = await self._run_batch(key, [item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+@dataclasses.dataclass(frozen=True)
+class BatchKey:
+    """Images can only be generated in a single pass if they have the same size"""
+
+    width: int
+    height: int
+
+
+@dataclasses.dataclass(frozen=True)
+class BatchItem:
+    prompt: str
+    negative_prompt: str | None
+    seed: int
+    output_format: str
+
+
+def image_size(aspect_ratio: str, size: int) -> tuple[int, int]:
+    """Width and height of an image with an aspect ratio
+
+    The image has about as many pixels as a square image of the given size, and its
+    sides are multiples of 64, as Stable Diffusion requires.
+
+    :param aspect_ratio: e.g. "16:9"
+    :param size: width and height of square images
+    :return: width and height
+    """
+    horizontal, _, vertical = aspect_ratio.partition(":")
+    ratio = int(horizontal) / int(vertical)
+    width = size * ratio**0.5
+    height = size / ratio**0.5
+    return max(64, round(width / 64) * 64), max(64, round(height / 64) * 64)
+
+
+# The pipeline of a local backend process. It is loaded once when the process starts,
+# and kept for all batches the process runs.
+_pipeline: Any = None
+_settings: dict[str, Any] = {}
+
+
+def load_pipeline(model: str, threads: int, steps: int, guidance_scale: float) -> None:
+    """Initializer of local backend processes
+
+    Weights are loaded from safetensors files, which are memory-mapped.
+
+    :param model: name of the model on Hugging Face, or path to a local copy
+    :param threads: number of threads torch may use
+    :param steps: number of inference steps
+    :param guidance_scale: guidance scale, 0 for models distilled without guidance
+    :return: None
+    """
+    import torch  # type: ignore[import-not-found]
+    from diffusers import AutoPipelineForText2Image  # type: ignore[import-not-found]
+
+    global _pipeline
+    ignore_interrupts()
+    torch.set_num_threads(threads)
+    _pipeline = AutoPipelineForText2Image.from_pretrained(
+        model, torch_dtype=torch.float32, use_safetensors=True
+    )
+    _pipeline.set_progress_bar_config(disable=True)
+    _settings.update(steps=steps, guidance_scale=guidance_scale)
+
+
+def generate_batch(key: BatchKey, items: list[BatchItem]) -> list[bytes | None]:
+    """Generate the images of a batch in a single pass of the pipeline
+
+    :param key: size of the images
+    :param items: prompts to generate images for
+    :return: for every item its encoded image, or None if it was filtered
+    """
+    import torch  # type: ignore[import-not-found]
+
+    with torch.inference_mode():
+        output = _pipeline(
+            prompt=[item.prompt for item in items],
+            negative_prompt=[item.negative_prompt or "" for item in items],
+            width=key.width,
+            height=key.height,
+            num_inference_steps=_settings["steps"],
+            guidance_scale=_settings["guidance_scale"],
+            generator=[torch.Generator("cpu").manual_seed(item.seed) for item in items],
+        )
+    filtered = getattr(output, "nsfw_content_detected", None) or [False] * len(items)
+    images: list[bytes | None] = []
+    for image, item, is_filtered in zip(output.images, items, filtered):
+        if is_filtered:
+            images.append(None)
+            continue
+        buffer = io.BytesIO()
+        image.save(buffer, format=item.output_format)
+        images.append(buffer.getvalue())
+    return images
+
+
+class LocalDiffusionBackend:
+    """Run Stable Diffusion on the CPUs of the worker
+
+    Every process of the backend loads the model once, and keeps it for all images
+    it generates. Requests of the same image size that arrive within the batch window
+    are generated in a single pass.
+
+    The aspect ratio, negative prompt, seed and output format of requests are
+    honoured. Other options, like the model and style preset, are ignored.
+
+    :param model: name of the model on Hugging Face, or path to a local copy
+    :param processes: number of processes running the model
+    :param steps: number of inference steps
+    :param guidance_scale: guidance scale, 0 for models distilled without guidance
+    :param size: width and height of square images
+    :param max_batch_size: maximum number of images generated in a single pass
+    :param batch_window: seconds to wait for more requests to batch
+    """
+
+    def __init__(
+        self,
+        model: str = LOCAL_MODEL,
+        processes: int = LOCAL_PROCESSES,
+        steps: int = LOCAL_STEPS,
+        guidance_scale: float = LOCAL_GUIDANCE_SCALE,
+        size: int = LOCAL_IMAGE_SIZE,
+        max_batch_size: int = LOCAL_MAX_BATCH_SIZE,
+        batch_window: float = LOCAL_BATCH_WINDOW,
+    ):
+        self.model = model
+        self.processes = processes
+        self.steps = steps
+        self.guidance_scale = guidance_scale
+        self.size = size
+        self._batcher: Batcher[BatchKey, BatchItem, bytes | None] = Batcher(
+            self._run_batch, max_batch_size, batch_window
+        )
+        self._pool: concurrent.futures.ProcessPoolExecutor | None = None
+
+    async def start(self) -> None:
+        if self._pool is not None:
+            return
+        missing = [p for p in REQUIRED_PACKAGES if importlib.util.find_spec(p) is None]
+        if missing:
+            raise RuntimeError(
+                f"The local backend needs {', '.join(missing)}, which are not installed"
+            )
+        logger.info("Loading %s in %d processes", self.model, self.processes)
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=load_pipeline,
+            initargs=(
+                self.model,
+                max(1, (os.cpu_count() or 1) // self.processes),
+                self.steps,
+                self.guidance_scale,
+            ),
+        )
+
+    async def close(self) -> None:
+        if self._pool is None:
+            return
+        self._pool.shutdown(cancel_futures=True)
+        self._pool = None
+
+    async def __aenter__(self) -> "LocalDiffusionBackend":
+        await self.start()
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: types.TracebackType | None,
+    ) -> None:
+        await self.close()
+
+    async def text_to_image(
+        self, request: TextToImageRequestV2Core | TextToImageRequestV2SD3
+    ) -> list[TextToImageResponse]:
+        """Generate an image for a text to image request
+
+        :param request: the request
+        :return: list with a single response
+        """
+        seed = request.seed or random.randint(1, SEED_MAX)
+        image = await self._batcher.submit(
+            BatchKey(*image_size(request.aspect_ratio, self.size)),
+            BatchItem(
+                request.prompt, request.negative_prompt, seed, request.output_format
+            ),
+        )
+        return [
+            TextToImageResponse(
+                image=image,
+                finish_reason=(
+                    FinishReason.SUCCESS
+                    if image is not None
+                    else FinishReason.CONTENT_FILTERED
+                ),
+                seed=seed,
+                output_format=request.output_format,
+            )
+        ]
+
+    async def _run_batch(
+        self, key: BatchKey, items: list[BatchItem]
+    ) -> list[bytes | None]:
+        if self._pool is None:
+            raise RuntimeError("Backend is not started")
+        start = time.monotonic()
+        images = await asyncio.get_running_loop().run_in_executor(
+            self._pool, generate_batch, key, items
+        )
+        duration = time.monotonic() - start
+        logger.info(
+            "Generated %d images of %dx%d locally in %.2f seconds",
+            len(items),
+            key.width,
+            key.height,
+            duration,
+            extra={"model": self.model, "duration": duration, "images": len(items)},
+        )
+        return images
@@ -12,44 +12,167 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-
+import atexit
+import contextlib
+import contextvars
+import copy
+import datetime
+import json
 import logging
-import logging.config
+import logging.handlers
+import queue
+import sys
+from typing import Any, Iterator
+
+from .config import LOG_FORMAT, LOG_LEVEL, LOG_LEVELS
 
 logger = logging.getLogger(__name__)
 
+TEXT_FORMAT = "[%(asctime)s] - %(levelname)s - %(message)s - [%(filename)s:%(lineno)d]"
 
-def init_logging():
-    """Initialize logging
+# Fields added to every record logged in the current context, such as the
+# interaction id of the prompt being handled.
+_log_context: contextvars.ContextVar[dict[str, Any]] = contextvars.ContextVar(
+    "log_context", default={}
+)
+
+# Attributes every log record has. Anything else was passed as extra, or added from
+# the log context.
+_RECORD_ATTRIBUTES = frozenset(
+    vars(logging.LogRecord("", logging.INFO, "", 0, "", None, None))
+) | {"message", "asctime"}
+
+# Listener started by init_logging, if any.
+_listener: logging.handlers.QueueListener | None = None
+
+
+@contextlib.contextmanager
+def log_fields(**fields: Any) -> Iterator[None]:
+    """Add fields to all records logged within this context
+
+    :param fields: fields to add, e.g. interaction_id
+    """
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
 
-    Set up logging handler to stdout, with friendly format.
 
-    Should be called at application bootup.
+def bind_log_fields(**fields: Any) -> None:
+    """Add fields to all records logged for the rest of the current task
 
+    :param fields: fields to add, e.g. interaction_id
     :return: None
     """
-    logging.config.dictConfig(
-        {
-            "version": 1,
-            "disable_existing_loggers": True,
-            "formatters": {
-                "default": {
-                    "format": (
-                        "[%(asctime)s] - %(levelname)s - %(message)s - "
-                        "[%(filename)s:%(lineno)d]"
-                    )
-                }
-            },
-            "handlers": {
-                "default": {
-                    "level": "DEBUG",
-                    "formatter": "default",
-                    "class": "logging.StreamHandler",
-                    "stream": "ext://sys.stdout",
-                }
-            },
-            "loggers": {
-                "droombot": {"handlers": ["default"], "level": "DEBUG"},
-            },
+    _log_context.set({**_log_context.get(), **fields})
+
+
+class ContextFilter(logging.Filter):
+    """Add the fields of the log context to records"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves formatting to the listener thread
+
+    The message is merged with its arguments right away, as the arguments may
+    change after logging. Formatting the record, including any traceback, is done
+    by the handlers of the listener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as a single line of JSON, including all extra fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "location": f"{record.filename}:{record.lineno}",
         }
-    )
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def parse_log_levels(value: str) -> dict[str, str]:
+    """Parse per-logger levels from a comma separated list of logger:level pairs
+
+    :param value: e.g. "droombot.worker:DEBUG,discord:WARNING"
+    :return: dict of logger name to level
+    """
+    levels = {}
+    for item in value.split(","):
+        if item.strip() == "":
+            continue
+        name, _, level = item.partition(":")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def init_logging(
+    level: str = LOG_LEVEL,
+    log_format: str = LOG_FORMAT,
+    levels: str = LOG_LEVELS,
+) -> logging.handlers.QueueListener:
+    """Initialize logging
+
+    Log records are put on a queue, and written to stdout by a separate thread, so
+    writing logs never blocks the event loop. Records are formatted as text, or as
+    JSON for log aggregation.
+
+    Should be called at application bootup. Calling it again replaces the previous
+    configuration.
+
+    :param level: level of the droombot loggers
+    :param log_format: "text" or "json"
+    :param levels: comma-separated logger:level pairs, overriding the level of
+        specific loggers
+    :return: the listener writing the records, stopped at exit
+    """
+    global _listener
+    if _listener is not None:
+        atexit.unregister(_listener.stop)
+        _listener.stop()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if log_format == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    _listener = listener
+
+    # third party libraries only log warnings, unless configured otherwise.
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(logging.WARNING)
+    logging.getLogger("droombot").setLevel(level.upper())
+    for name, logger_level in parse_log_levels(levels).items():
+        logging.getLogger(name).setLevel(logger_level)
+    return listener
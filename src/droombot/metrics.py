@@ -0,0 +1,152 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import contextlib
+import logging
+from typing import Any
+
+# Metrics are only collected when the optional prometheus-client package is
+# installed, with the metrics extra. Without it, all metrics are no-ops.
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+# Stability calls take seconds to minutes.
+STABILITY_BUCKETS = (0.5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300)
+REDIS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+SIZE_BUCKETS = tuple(2**i for i in range(10, 26))
+PROMPT_BUCKETS = (1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300, 600, 900)
+ITERATION_BUCKETS = (1, 2, 3, 4, 5, 10, 20)
+
+
+class _NoopMetric:
+    """Stand-in for a metric when prometheus-client is not installed"""
+
+    def labels(self, *args: Any, **kwargs: Any) -> "_NoopMetric":
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def set_function(self, f: Any) -> None:
+        pass
+
+    def observe(self, amount: float) -> None:
+        pass
+
+    def time(self) -> contextlib.AbstractContextManager:
+        return contextlib.nullcontext()
+
+    def track_inprogress(self) -> contextlib.AbstractContextManager:
+        return contextlib.nullcontext()
+
+
+def _metric(kind: str, name: str, documentation: str, **kwargs: Any) -> Any:
+    if prometheus_client is None:
+        return _NoopMetric()
+    return getattr(prometheus_client, kind)(name, documentation, **kwargs)
+
+
+QUEUE_DEPTH = _metric(
+    "Gauge",
+    "droombot_queue_depth",
+    "Number of prompts waiting to be run. The stream queue holds the prompts "
+    "that were not yet read or acknowledged by any worker, the local queue "
+    "holds the prompts read by this worker that were not yet started",
+    labelnames=["queue"],
+)
+IN_FLIGHT = _metric(
+    "Gauge",
+    "droombot_in_flight_prompts",
+    "Number of prompts being run by this worker",
+)
+STABILITY_LATENCY = _metric(
+    "Histogram",
+    "droombot_stability_latency_seconds",
+    "Duration of calls to Stability, including retries",
+    labelnames=["model", "outcome"],
+    buckets=STABILITY_BUCKETS,
+)
+REDIS_LATENCY = _metric(
+    "Histogram",
+    "droombot_redis_latency_seconds",
+    "Duration of redis operations",
+    labelnames=["operation"],
+    buckets=REDIS_BUCKETS,
+)
+RESULT_WAIT_ITERATIONS = _metric(
+    "Histogram",
+    "droombot_result_wait_iterations",
+    "Number of times the result of an interaction was fetched, before it was complete",
+    buckets=ITERATION_BUCKETS,
+)
+RESULT_SIZE = _metric(
+    "Histogram",
+    "droombot_result_size_bytes",
+    "Size of stored results",
+    buckets=SIZE_BUCKETS,
+)
+CACHE_LOOKUPS = _metric(
+    "Counter",
+    "droombot_cache_lookups_total",
+    "Number of lookups in the result cache, by whether they were a hit or a miss",
+    labelnames=["result"],
+)
+SINGLE_FLIGHT = _metric(
+    "Counter",
+    "droombot_single_flight_total",
+    "Number of Stability calls made as leader of a flight, and shared as follower",
+    labelnames=["role"],
+)
+ABANDONED_PROMPTS = _metric(
+    "Counter",
+    "droombot_abandoned_prompts_total",
+    "Number of prompts the bot stopped waiting for, because they expired or were "
+    "cancelled, by whether they were still queued or already running",
+    labelnames=["reason", "state"],
+)
+PROMPT_DURATION = _metric(
+    "Histogram",
+    "droombot_prompt_duration_seconds",
+    "Time from receiving a prompt to replying with the result",
+    labelnames=["outcome"],
+    buckets=PROMPT_BUCKETS,
+)
+
+
+def start_metrics_server(port: int) -> None:
+    """Serve metrics over http on /metrics, in a background thread
+
+    :param port: port to listen on. 0 disables the endpoint.
+    :return: None
+    """
+    if port == 0:
+        return
+    if prometheus_client is None:
+        logger.error(
+            "Cannot serve metrics, as prometheus-client is not installed. "
+            "Install droombot with the metrics extra."
+        )
+        return
+    prometheus_client.start_http_server(port)
+    logger.info(f"Serving metrics on port {port}")
@@ -11,14 +11,18 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
-import argparse
+import dataclasses
 import enum
 import logging
-import shlex
-from typing import Annotated, Literal
+import random
+import re
+import time
+from typing import Annotated, Any, Callable, Literal, Mapping, get_args
 
 import pydantic
 
+from .config import MAX_IMAGES_PER_PROMPT
+
 logger = logging.getLogger(__name__)
 
 
@@ -48,27 +52,54 @@ STYLE_PRESETS = Literal[
     "pixel-art",
     "tile-texture",
 ]
+OUTPUT_FORMATS = Literal["jpeg", "png", "webp"]
 
 
-SeedType = Annotated[int, pydantic.Field(ge=0, le=4294967295)]
+SEED_MAX = 4294967295
+SeedType = Annotated[int, pydantic.Field(ge=0, le=SEED_MAX)]
 PromptType = Annotated[str, pydantic.Field(min_length=1, max_length=10_000)]
 NegativePromptType = Annotated[str, pydantic.Field(min_length=0, max_length=10_000)]
 
 
 class TextToImageResponse(pydantic.BaseModel):
-    # base-64 encoded image or null if finish reason is not success
-    base64: str | None
+    # raw image bytes or null if finish reason is not success. Images read from the
+    # api are kept in the bytearray they were read into, rather than copied. Images
+    # are never serialized to json, they are stored separately from the rest of the
+    # response.
+    image: bytes | pydantic.InstanceOf[bytearray] | None = pydantic.Field(
+        default=None, exclude=True, repr=False
+    )
     # the finish reason
     finish_reason: FinishReason
     # What seed ended up being used for this
     seed: int
+    # the format of the image
+    output_format: OUTPUT_FORMATS = "png"
+    # small webp version of the image, if thumbnails are enabled, shown while the
+    # other images of a prompt are generated. Stored separately like the image.
+    thumbnail: bytes | None = pydantic.Field(default=None, exclude=True, repr=False)
 
     @classmethod
-    def from_raw_api(cls, raw_api_response: dict) -> "TextToImageResponse":
+    def from_raw_api(
+        cls,
+        headers: Mapping[str, str],
+        image: bytes | bytearray,
+        output_format: OUTPUT_FORMATS = "png",
+    ) -> "TextToImageResponse":
+        """Create a response from a binary response of the api
+
+        :param headers: headers of the response, with the finish reason and seed
+        :param image: body of the response
+        :param output_format: the format of the image
+        :return: the response
+        """
+        finish_reason = FinishReason(headers["finish-reason"])
         return cls(
-            base64=raw_api_response["image"],
-            finish_reason=raw_api_response["finish_reason"],
-            seed=raw_api_response["seed"],
+            # the image of a filtered prompt is blurred
+            image=image if finish_reason is FinishReason.SUCCESS else None,
+            finish_reason=finish_reason,
+            seed=int(headers["seed"]),
+            output_format=output_format,
         )
 
 
@@ -80,7 +111,7 @@ class TextToImageRequestV2Core(pydantic.BaseModel):
     negative_prompt: NegativePromptType | None = None
     seed: SeedType = 0
     style_preset: STYLE_PRESETS | None = None
-    output_format: Literal["jpeg", "png", "webp"] = "png"
+    output_format: OUTPUT_FORMATS = "png"
 
 
 class TextToImageRequestV2SD3(pydantic.BaseModel):
@@ -103,28 +134,219 @@ class PubSubMessage(pydantic.BaseModel):
     # The text prompt used
     text_prompt: str
 
+    # the discord guild and user the prompt came from, used to schedule prompts
+    # fairly. None for prompts queued by older versions.
+    guild_id: str | None = None
+    user_id: str | None = None
 
-def pubsub_to_t2i(
-    message: PubSubMessage,
-) -> TextToImageRequestV2Core | TextToImageRequestV2SD3:
-    """Convert a pubsub message to a text 2 image request
+    # the requests parsed from the text prompt by the bot, one for each image. Empty
+    # for prompts queued by older versions, which still need to be parsed.
+    requests: list[TextToImageRequestV2Core | TextToImageRequestV2SD3] = []
 
-    :param message: the message
-    :return: text to image request
+    # unix time after which the bot no longer waits for the result, and the prompt
+    # is not worth running. None for prompts queued by older versions.
+    deadline: float | None = None
+
+    # W3C trace context of the span the prompt was queued from, empty if tracing is
+    # disabled.
+    trace_context: dict[str, str] = {}
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.time() >= self.deadline
+
+
+def with_distinct_seeds(
+    request: TextToImageRequestV2Core | TextToImageRequestV2SD3, count: int
+) -> list[TextToImageRequestV2Core | TextToImageRequestV2SD3]:
+    """Fan out a request into a number of requests with distinct seeds
+
+    Seeds count up from the seed of the request. If the request has no seed (0), a
+    random starting seed is picked.
+
+    :param request: the request
+    :param count: number of requests
+    :return: list of requests
+    """
+    if count == 1:
+        return [request]
+    start = request.seed or random.randint(1, SEED_MAX)
+    return [
+        request.model_copy(update={"seed": (start - 1 + i) % SEED_MAX + 1})
+        for i in range(count)
+    ]
+
+
+@dataclasses.dataclass(frozen=True)
+class Option:
+    """An option that can be appended to a prompt"""
+
+    # name of the field of the request it sets
+    field: str
+    flags: tuple[str, ...]
+    choices: tuple[str, ...] | None = None
+    convert: Callable[[str], Any] = str
+
+    def parse(self, value: str) -> Any:
+        if self.choices is not None and value not in self.choices:
+            raise ValueError(f"must be one of {', '.join(self.choices)}")
+        try:
+            return self.convert(value)
+        except ValueError:
+            raise ValueError("must be a whole number") from None
+
+
+MODELS = ("core", "sd3", "sd3-turbo")
+
+OPTIONS = (
+    Option("model", ("-m", "--model"), choices=MODELS),
+    Option("count", ("-n", "--count"), convert=int),
+    Option("aspect_ratio", ("-a", "--aspect-ratio"), choices=get_args(ASPECT_RATIOS)),
+    Option("negative_prompt", ("--negative", "--negative-prompt")),
+    Option("seed", ("-s", "--seed"), convert=int),
+    Option(
+        "style_preset",
+        ("-p", "--style", "--style-preset"),
+        choices=get_args(STYLE_PRESETS),
+    ),
+    Option(
+        "output_format",
+        ("-f", "--format", "--output-format"),
+        choices=get_args(OUTPUT_FORMATS),
+    ),
+)
+_OPTIONS_BY_FLAG = {flag: option for option in OPTIONS for flag in option.flags}
+_OPTIONS_BY_FIELD = {option.field: option for option in OPTIONS}
+
+# Options start at the first word starting with a dash and a letter, so dashes in
+# the prompt itself (e.g. sci-fi) are left alone.
+_OPTIONS_START = re.compile(r"(?:^|\s)--?[a-zA-Z]")
+# Option values can be quoted, e.g. --negative "blurry, dark"
+_TOKEN = re.compile(r""""([^"]*)"|'([^']*)'|(\S+)""")
+
+
+@dataclasses.dataclass(frozen=True)
+class OptionError:
+    """A single invalid option of a prompt"""
+
+    option: str
+    value: str | None
+    message: str
+
+    def __str__(self) -> str:
+        if self.value is None:
+            return f"{self.option}: {self.message}"
+        return f"{self.option} {self.value}: {self.message}"
+
+
+class PromptError(ValueError):
+    """The options of a prompt are invalid
+
+    :param errors: all invalid options of the prompt
+    """
+
+    def __init__(self, errors: list[OptionError]):
+        super().__init__("; ".join(str(error) for error in errors))
+        self.errors = errors
+
+
+def parse_prompt(
+    text: str,
+) -> list[TextToImageRequestV2Core | TextToImageRequestV2SD3]:
+    """Parse a prompt with options to text to image requests
+
+    :param text: prompt, optionally followed by options such as -m sd3 -n 2
+    :return: text to image requests, one for each image to generate
+    :raises: PromptError, listing every invalid option
     """
-    parser = argparse.ArgumentParser(exit_on_error=False)
-    parser.add_argument(
-        "-m", "--model", choices=["core", "sd3", "sd3-turbo"], default="core"
+    match = _OPTIONS_START.search(text)
+    prompt, options = (
+        (text[: match.start()], text[match.start() :]) if match else (text, "")
     )
 
-    # we want to consider everything before a `-` as the text prompt, without quoting.
-    prompt, maybe_dash, options = message.text_prompt.partition("-")
+    values: dict[str, Any] = {}
+    errors: list[OptionError] = []
+    tokens = [
+        next(group for group in token_match.groups() if group is not None)
+        for token_match in _TOKEN.finditer(options)
+    ]
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        i += 1
+        flag, equals, value = token.partition("=")
+        option = _OPTIONS_BY_FLAG.get(flag)
+        if option is None:
+            # take the value of the unknown option along, if it has one
+            if not equals and i < len(tokens) and not tokens[i].startswith("-"):
+                value = tokens[i]
+                i += 1
+            errors.append(OptionError(flag, value or None, "unknown option"))
+            continue
+        if not equals:
+            if i == len(tokens):
+                errors.append(OptionError(flag, None, "missing value"))
+                continue
+            value = tokens[i]
+            i += 1
+        try:
+            values[option.field] = option.parse(value)
+        except ValueError as e:
+            errors.append(OptionError(flag, value, str(e)))
+
+    model = values.pop("model", "core")
+    count = values.pop("count", 1)
+    if not 1 <= count <= MAX_IMAGES_PER_PROMPT:
+        errors.append(
+            OptionError(
+                _OPTIONS_BY_FIELD["count"].flags[-1],
+                str(count),
+                f"must be between 1 and {MAX_IMAGES_PER_PROMPT}",
+            )
+        )
+    request_type: type[TextToImageRequestV2Core] | type[TextToImageRequestV2SD3]
+    if model == "core":
+        request_type = TextToImageRequestV2Core
+    else:
+        request_type = TextToImageRequestV2SD3
+        values["model"] = model
+    for field in list(values):
+        if field not in request_type.model_fields:
+            option = _OPTIONS_BY_FIELD[field]
+            errors.append(
+                OptionError(
+                    option.flags[-1],
+                    str(values.pop(field)),
+                    f"not supported by {model}",
+                )
+            )
+
+    request: TextToImageRequestV2Core | TextToImageRequestV2SD3 | None = None
+    try:
+        request = request_type(prompt=prompt.strip(), **values)
+    except pydantic.ValidationError as e:
+        for error in e.errors():
+            field = str(error["loc"][0])
+            errors.append(
+                OptionError(
+                    _OPTIONS_BY_FIELD[field].flags[-1]
+                    if field in _OPTIONS_BY_FIELD
+                    else field,
+                    str(error["input"]) if field != "prompt" else None,
+                    error["msg"],
+                )
+            )
+    if errors or request is None:
+        raise PromptError(errors)
+    return with_distinct_seeds(request, count)
 
-    args, failures = parser.parse_known_args(shlex.split(maybe_dash + options), None)
-    if failures:
-        logger.warning(f"Unrecognized arguments: {''.join(failures)}, ignoring...")
 
-    if args.model == "core":
-        return TextToImageRequestV2Core(prompt=prompt.strip())
+def pubsub_to_t2i(
+    message: PubSubMessage,
+) -> list[TextToImageRequestV2Core | TextToImageRequestV2SD3]:
+    """Convert a pubsub message to text 2 image requests
 
-    return TextToImageRequestV2SD3(prompt=prompt.strip(), model=args.model)
+    :param message: the message
+    :return: text to image requests, one for each image to generate
+    :raises: PromptError
+    """
+    return parse_prompt(message.text_prompt)
@@ -0,0 +1,152 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import dataclasses
+import io
+import logging
+import signal
+from typing import TYPE_CHECKING, cast, get_args
+
+from .config import IMAGE_FORMAT, IMAGE_MAX_BYTES, IMAGE_THUMBNAIL_SIZE
+from .models import OUTPUT_FORMATS
+
+# Pillow is only needed by the processes that post-process images, so it is imported
+# by them.
+if TYPE_CHECKING:
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Qualities to try for lossy formats, before scaling images down.
+QUALITIES = (90, 80, 70, 60)
+# Factor to scale images down with, until they fit.
+DOWNSCALE_FACTOR = 0.75
+# Images are never scaled down below this size, in pixels.
+MIN_SIZE = 256
+THUMBNAIL_FORMAT: OUTPUT_FORMATS = "webp"
+THUMBNAIL_QUALITY = 75
+
+
+@dataclasses.dataclass(frozen=True)
+class PostprocessSettings:
+    """What to do with images after they are generated"""
+
+    # format to convert all images to, None keeps the format of the image.
+    output_format: OUTPUT_FORMATS | None = None
+    # 0 means no maximum
+    max_bytes: int = 0
+    # 0 means no thumbnails
+    thumbnail_size: int = 0
+
+    @classmethod
+    def from_config(cls) -> "PostprocessSettings":
+        if IMAGE_FORMAT and IMAGE_FORMAT not in get_args(OUTPUT_FORMATS):
+            raise ValueError(f"Unsupported image format: {IMAGE_FORMAT}")
+        return cls(
+            output_format=cast(OUTPUT_FORMATS, IMAGE_FORMAT) or None,
+            max_bytes=IMAGE_MAX_BYTES,
+            thumbnail_size=IMAGE_THUMBNAIL_SIZE,
+        )
+
+    def applies_to(
+        self, image: bytes | bytearray, output_format: OUTPUT_FORMATS
+    ) -> bool:
+        """Whether an image needs any post-processing
+
+        :param image: the encoded image
+        :param output_format: format of the image
+        :return: True if the image must be converted, compressed or thumbnailed
+        """
+        return (
+            (self.output_format is not None and self.output_format != output_format)
+            or 0 < self.max_bytes < len(image)
+            or self.thumbnail_size > 0
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class ProcessedImage:
+    image: bytes | bytearray
+    output_format: OUTPUT_FORMATS
+    thumbnail: bytes | None = None
+
+
+def ignore_interrupts() -> None:
+    """Initializer of post-processing processes
+
+    The worker handles interrupts, and lets running post-processing finish.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def postprocess_image(
+    image: bytes | bytearray,
+    output_format: OUTPUT_FORMATS,
+    settings: PostprocessSettings,
+) -> ProcessedImage:
+    """Convert, compress and make a thumbnail of an image, as configured
+
+    This is CPU intensive, so it should be run in a separate process.
+
+    :param image: the encoded image
+    :param output_format: format of the image
+    :param settings: what to do with the image
+    :return: the processed image
+    """
+    from PIL import Image
+
+    if not settings.applies_to(image, output_format):
+        return ProcessedImage(image, output_format)
+    target_format = settings.output_format or output_format
+
+    with Image.open(io.BytesIO(image)) as opened:
+        opened.load()
+        decoded: Image.Image = opened
+    if target_format != output_format:
+        image = _encode(decoded, target_format, QUALITIES[0])
+
+    if 0 < settings.max_bytes < len(image):
+        # png is lossless, so it can hardly be compressed any further.
+        if target_format == "png":
+            target_format = "webp"
+        for quality in QUALITIES:
+            image = _encode(decoded, target_format, quality)
+            if len(image) <= settings.max_bytes:
+                break
+        while len(image) > settings.max_bytes and min(decoded.size) > MIN_SIZE:
+            decoded = decoded.resize(
+                (
+                    int(decoded.width * DOWNSCALE_FACTOR),
+                    int(decoded.height * DOWNSCALE_FACTOR),
+                ),
+                Image.Resampling.LANCZOS,
+            )
+            image = _encode(decoded, target_format, QUALITIES[-1])
+
+    thumbnail = None
+    if settings.thumbnail_size:
+        small = decoded.copy()
+        small.thumbnail((settings.thumbnail_size, settings.thumbnail_size))
+        thumbnail = _encode(small, THUMBNAIL_FORMAT, THUMBNAIL_QUALITY)
+
+    return ProcessedImage(image, target_format, thumbnail)
+
+
+def _encode(image: "Image.Image", output_format: OUTPUT_FORMATS, quality: int) -> bytes:
+    if output_format == "jpeg" and image.mode not in ("RGB", "L"):
+        # jpeg has no transparency
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=output_format, quality=quality, optimize=True)
+    return buffer.getvalue()
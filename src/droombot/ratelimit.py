@@ -0,0 +1,157 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import logging
+
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+RATELIMIT_PREFIX = "droombot-ratelimit"
+
+# Number of seconds a bucket is kept around when it is not used.
+BUCKET_LIFETIME = 3600
+
+# Both scripts first bring the bucket up to date: the rate recovers linearly
+# towards the maximum rate, and the bucket fills up at the current rate. The
+# clock of redis is used, so all clients share the same clock.
+#
+# KEYS: bucket
+# ARGV: max rate, capacity, recovery per second
+REFILL = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local max_rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local recovery = tonumber(ARGV[3])
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated', 'rate')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+local rate = tonumber(state[3]) or max_rate
+
+local elapsed = math.max(now - updated, 0)
+rate = math.min(max_rate, rate + recovery * elapsed)
+tokens = math.min(capacity, tokens + rate * elapsed)
+"""
+
+STORE = (
+    """
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], %d)
+"""
+    % BUCKET_LIFETIME
+)
+
+# Take a token if there is one. Returns the number of seconds to wait before trying
+# again, 0 if a token was taken.
+ACQUIRE_SCRIPT = (
+    REFILL
+    + """
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+"""
+    + STORE
+    + """
+return tostring(wait)
+"""
+)
+
+# ARGV (additionally): decrease factor, minimum rate, seconds to block
+# Returns the new rate.
+PENALIZE_SCRIPT = (
+    REFILL
+    + """
+rate = math.max(tonumber(ARGV[5]), rate * tonumber(ARGV[4]))
+-- nobody gets a token for the given number of seconds
+tokens = math.min(tokens, 0) - rate * tonumber(ARGV[6])
+"""
+    + STORE
+    + """
+return tostring(rate)
+"""
+)
+
+
+class RedisTokenBucket:
+    """Token bucket rate limiter, shared by all processes through redis
+
+    The rate adapts to the upstream limit: when the upstream service tells us to
+    slow down, the rate is cut, after which it gradually recovers to the maximum.
+
+    :param redis_connection: redis instance to keep the bucket in
+    :param name: name of the bucket. Limiters with the same name share a budget
+    :param requests_per_minute: maximum rate
+    :param burst: maximum number of requests in a burst. Defaults to a second's
+        worth of requests, with a minimum of one
+    :param decrease: factor to cut the rate with on a penalty
+    :param min_fraction: the rate is never cut below this fraction of the maximum
+    :param recovery_time: seconds to recover from the minimum to the maximum rate
+    """
+
+    def __init__(
+        self,
+        redis_connection: redis.Redis,
+        name: str,
+        requests_per_minute: float,
+        burst: float | None = None,
+        decrease: float = 0.5,
+        min_fraction: float = 0.1,
+        recovery_time: float = 300,
+    ):
+        self.key = f"{RATELIMIT_PREFIX}:{name}"
+        self.max_rate = requests_per_minute / 60
+        self.burst = burst if burst is not None else max(self.max_rate, 1)
+        self.decrease = decrease
+        self.min_rate = self.max_rate * min_fraction
+        self.recovery = (self.max_rate - self.min_rate) / recovery_time
+        self._acquire_script = redis_connection.register_script(ACQUIRE_SCRIPT)
+        self._penalize_script = redis_connection.register_script(PENALIZE_SCRIPT)
+
+    @property
+    def _args(self) -> list[float]:
+        return [self.max_rate, self.burst, self.recovery]
+
+    async def acquire(self) -> None:
+        """Wait until a request may be made
+
+        :return: None
+        """
+        while True:
+            wait = float(await self._acquire_script(keys=[self.key], args=self._args))
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def penalize(self, retry_after: float | None = None) -> None:
+        """Cut the rate, because the upstream service is limiting us
+
+        :param retry_after: seconds during which no requests should be made at all
+        :return: None
+        """
+        rate = float(
+            await self._penalize_script(
+                keys=[self.key],
+                args=[*self._args, self.decrease, self.min_rate, retry_after or 0],
+            )
+        )
+        logger.warning(
+            f"Rate limited upstream, reduced rate of {self.key} to "
+            f"{rate * 60:.1f} requests per minute"
+        )
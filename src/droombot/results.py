@@ -0,0 +1,391 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import dataclasses
+import logging
+
+import pydantic
+import redis.asyncio as redis
+
+from .metrics import REDIS_LATENCY, RESULT_SIZE
+from .models import TextToImageResponse
+
+logger = logging.getLogger(__name__)
+
+# Workers announce stored results on this channel, with the interaction id as data.
+RESULT_CHANNEL = "droombot-results"
+
+# Seconds to wait before resubscribing after losing the connection to redis.
+RESUBSCRIBE_DELAY = 1
+
+# Results are stored as a hash, with the number of expected responses in one field,
+# and for each response its metadata as json and the raw bytes of its image and
+# thumbnail in fields of their own. Responses are added as soon as they are available.
+COUNT_FIELD = b"count"
+
+RESPONSE_ADAPTER = pydantic.TypeAdapter(TextToImageResponse)
+
+
+def result_key(interaction_id: str) -> str:
+    return f"interaction:{interaction_id}"
+
+
+def meta_field(index: int) -> bytes:
+    return b"meta:%d" % index
+
+
+def image_field(index: int) -> bytes:
+    return b"image:%d" % index
+
+
+def thumbnail_field(index: int) -> bytes:
+    return b"thumbnail:%d" % index
+
+
+def encode_response(
+    index: int, response: TextToImageResponse
+) -> dict[bytes, bytes | memoryview]:
+    """Encode a single response to a mapping of hash fields
+
+    :param index: index of the response
+    :param response: the text to image response
+    :return: mapping of hash field to value
+    """
+    mapping: dict[bytes, bytes | memoryview] = {
+        meta_field(index): RESPONSE_ADAPTER.dump_json(response)
+    }
+    if response.image is not None:
+        # redis takes bytearrays as a view only, which does not copy the image
+        mapping[image_field(index)] = memoryview(response.image)
+    if response.thumbnail is not None:
+        mapping[thumbnail_field(index)] = response.thumbnail
+    return mapping
+
+
+def encode_responses(
+    responses: list[TextToImageResponse],
+) -> dict[bytes, bytes | memoryview]:
+    """Encode responses to a mapping of hash fields
+
+    :param responses: the text to image responses
+    :return: mapping of hash field to value
+    """
+    mapping: dict[bytes, bytes | memoryview] = {COUNT_FIELD: b"%d" % len(responses)}
+    for i, response in enumerate(responses):
+        mapping.update(encode_response(i, response))
+    return mapping
+
+
+def payload_size(mapping: dict[bytes, bytes | memoryview]) -> int:
+    """Number of bytes of encoded responses
+
+    :param mapping: mapping of hash field to value
+    :return: number of bytes
+    """
+    return sum(len(field) + len(value) for field, value in mapping.items())
+
+
+def decode_responses(
+    mapping: dict[bytes, bytes], partial: bool = False
+) -> list[TextToImageResponse] | None:
+    """Decode responses from a mapping of hash fields
+
+    :param mapping: mapping of hash field to value, as encoded by encode_responses
+    :param partial: whether to return the responses available so far, if not all
+        responses are available yet
+    :return: the text to image responses, or None if they are not all available and
+        partial is False
+    """
+    if COUNT_FIELD not in mapping:
+        return None
+    count = int(mapping[COUNT_FIELD])
+    responses = []
+    for i in range(count):
+        raw_response = mapping.get(meta_field(i))
+        if raw_response is None:
+            if not partial:
+                return None
+            continue
+        responses.append(_decode_response(mapping, i, raw_response))
+    return responses
+
+
+def _decode_response(
+    mapping: dict[bytes, bytes], index: int, raw_response: bytes
+) -> TextToImageResponse:
+    response = RESPONSE_ADAPTER.validate_json(raw_response)
+    response.image = mapping.get(image_field(index))
+    response.thumbnail = mapping.get(thumbnail_field(index))
+    return response
+
+
+@dataclasses.dataclass
+class Progress:
+    """How far the worker is with the images of an interaction"""
+
+    # number of images, None if no worker started on the interaction yet.
+    count: int | None = None
+    # the responses available so far, by index
+    responses: dict[int, TextToImageResponse] = dataclasses.field(default_factory=dict)
+
+    @property
+    def started(self) -> bool:
+        return self.count is not None
+
+    @property
+    def complete(self) -> bool:
+        return self.count is not None and len(self.responses) == self.count
+
+
+async def announce_started(
+    redis_connection: redis.Redis, interaction_id: str, count: int, ttl: int
+) -> None:
+    """Announce that a worker started generating the images of an interaction
+
+    :param redis_connection: Redis instance to store in
+    :param interaction_id: the interaction id
+    :param count: number of images that will be generated
+    :param ttl: number of seconds to keep the results around
+    :return: None
+    """
+    key = result_key(interaction_id)
+    with REDIS_LATENCY.labels("announce_started").time():
+        async with redis_connection.pipeline(transaction=True) as pipe:
+            pipe.hset(key, COUNT_FIELD, b"%d" % count)
+            pipe.expire(key, ttl)
+            pipe.publish(RESULT_CHANNEL, interaction_id)
+            await pipe.execute()
+
+
+async def store_response(
+    redis_connection: redis.Redis,
+    interaction_id: str,
+    index: int,
+    count: int,
+    response: TextToImageResponse,
+    ttl: int,
+) -> None:
+    """Store a single response for an interaction, and announce it to listeners
+
+    :param redis_connection: Redis instance to store in
+    :param interaction_id: interaction id the response belongs to
+    :param index: index of the response
+    :param count: total number of responses for the interaction
+    :param response: the text to image response
+    :param ttl: number of seconds to keep the results around
+    :return: None
+    """
+    key = result_key(interaction_id)
+    mapping = {COUNT_FIELD: b"%d" % count, **encode_response(index, response)}
+    RESULT_SIZE.observe(payload_size(mapping))
+    with REDIS_LATENCY.labels("store_result").time():
+        async with redis_connection.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=mapping)  # type: ignore[arg-type]
+            pipe.expire(key, ttl)
+            pipe.publish(RESULT_CHANNEL, interaction_id)
+            await pipe.execute()
+
+
+async def store_results(
+    redis_connection: redis.Redis,
+    interaction_id: str,
+    responses: list[TextToImageResponse],
+    ttl: int,
+) -> None:
+    """Store all results for an interaction, and announce them to listeners
+
+    :param redis_connection: Redis instance to store in
+    :param interaction_id: interaction id the results belong to
+    :param responses: the text to image responses
+    :param ttl: number of seconds to keep the results around
+    :return: None
+    """
+    key = result_key(interaction_id)
+    mapping = encode_responses(responses)
+    RESULT_SIZE.observe(payload_size(mapping))
+    with REDIS_LATENCY.labels("store_result").time():
+        async with redis_connection.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping=mapping)  # type: ignore[arg-type]
+            pipe.expire(key, ttl)
+            pipe.publish(RESULT_CHANNEL, interaction_id)
+            await pipe.execute()
+
+
+async def fetch_results(
+    redis_connection: redis.Redis, interaction_id: str
+) -> list[TextToImageResponse] | None:
+    """Fetch the results for an interaction
+
+    :param redis_connection: Redis instance to fetch from
+    :param interaction_id: interaction id to retrieve
+    :return: list of text to image responses, or None if not all results are
+        available yet
+    """
+    with REDIS_LATENCY.labels("fetch_results").time():
+        mapping = await redis_connection.hgetall(result_key(interaction_id))
+    return decode_responses(mapping)
+
+
+async def fetch_progress(
+    redis_connection: redis.Redis,
+    interaction_id: str,
+    known: Progress | None = None,
+) -> Progress:
+    """Fetch the progress of an interaction, with the results available so far
+
+    Only the responses that are not known yet are fetched, so that every image is
+    transferred once while following the progress of an interaction.
+
+    :param redis_connection: Redis instance to fetch from
+    :param interaction_id: interaction id to retrieve
+    :param known: the progress fetched before, if any
+    :return: the progress
+    """
+    progress = Progress()
+    if known is not None:
+        progress = Progress(known.count, dict(known.responses))
+    key = result_key(interaction_id)
+    with REDIS_LATENCY.labels("fetch_progress").time():
+        if progress.count is None:
+            raw_count = await redis_connection.hget(key, COUNT_FIELD)
+            if raw_count is None:
+                return progress
+            progress.count = int(raw_count)
+        missing = [i for i in range(progress.count) if i not in progress.responses]
+        fields = [
+            field
+            for i in missing
+            for field in (meta_field(i), image_field(i), thumbnail_field(i))
+        ]
+        values = await redis_connection.hmget(key, fields) if fields else []
+    mapping = {
+        field: value for field, value in zip(fields, values) if value is not None
+    }
+    for i in missing:
+        raw_response = mapping.get(meta_field(i))
+        if raw_response is not None:
+            progress.responses[i] = _decode_response(mapping, i, raw_response)
+    return progress
+
+
+async def delete_results(redis_connection: redis.Redis, interaction_id: str) -> None:
+    """Delete the results for an interaction, once they are no longer needed
+
+    :param redis_connection: Redis instance to delete from
+    :param interaction_id: interaction id to delete
+    :return: None
+    """
+    with REDIS_LATENCY.labels("delete_results").time():
+        await redis_connection.delete(result_key(interaction_id))
+
+
+class ResultListener:
+    """Wait for results of interactions, as announced by the workers
+
+    A single subscription to the result channel is shared by all interactions. Each
+    interaction waits on its own future, which is resolved when a result for that
+    interaction is announced. Callers fetch results once they are announced.
+
+    Interactions must be registered before their prompt is queued, so that an
+    announcement can not be missed.
+
+    :param redis_connection: redis instance
+    """
+
+    def __init__(self, redis_connection: redis.Redis):
+        self._redis_connection = redis_connection
+        self._waiters: dict[str, asyncio.Future[None]] = {}
+        self._subscribed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        """Start listening, if not yet listening
+
+        :return: None, once subscribed to the result channel
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen(), name="result-listener")
+        await self._subscribed.wait()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._subscribed.clear()
+
+    async def register(self, interaction_id: str) -> None:
+        """Register an interaction to wait for
+
+        :param interaction_id: the interaction id
+        :return: None
+        """
+        await self.start()
+        self._waiters[interaction_id] = asyncio.get_running_loop().create_future()
+
+    async def next_update(self, interaction_id: str, timeout: float) -> bool:
+        """Wait for the next announcement for a registered interaction
+
+        Unlike wait, this does not fetch anything, so callers can follow the
+        progress of an interaction. The interaction stays registered.
+
+        :param interaction_id: the interaction id, must be registered
+        :param timeout: seconds to wait
+        :return: True if there was an announcement, False on timeout
+        """
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(self._waiters[interaction_id]), max(timeout, 0)
+            )
+        except asyncio.TimeoutError:
+            return False
+        # wait again before fetching, so that an announcement made while fetching is
+        # not missed.
+        self._waiters[interaction_id] = asyncio.get_running_loop().create_future()
+        return True
+
+    def unregister(self, interaction_id: str) -> None:
+        """Stop waiting for an interaction, without having waited for its result
+
+        :param interaction_id: the interaction id
+        :return: None
+        """
+        self._waiters.pop(interaction_id, None)
+
+    def _notify(self, interaction_id: str) -> None:
+        future = self._waiters.get(interaction_id)
+        # the interaction may belong to another bot instance, or may have timed out.
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with self._redis_connection.pubsub() as pubsub:
+                    await pubsub.subscribe(RESULT_CHANNEL)
+                    self._subscribed.set()
+                    # results may have been announced while we were not subscribed,
+                    # so have everyone check once.
+                    for interaction_id in list(self._waiters):
+                        self._notify(interaction_id)
+
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        self._notify(message["data"].decode("utf-8"))
+            except redis.ConnectionError as e:
+                logger.error(f"Lost subscription to {RESULT_CHANNEL} due to: {e}")
+                self._subscribed.clear()
+                await asyncio.sleep(RESUBSCRIBE_DELAY)
@@ -0,0 +1,217 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import collections
+import logging
+from typing import Callable
+
+from .job_queue import QueueEntry
+
+logger = logging.getLogger(__name__)
+
+# A flow is the prompts of a single user in a single guild.
+Flow = tuple[str | None, str | None]
+
+
+def flow_of(entry: QueueEntry) -> Flow:
+    """Flow an entry belongs to
+
+    :param entry: the queue entry
+    :return: tuple of guild id and user id. Unknown ids are None
+    """
+    _, message = entry
+    if message is None:
+        return None, None
+    return message.guild_id, message.user_id
+
+
+def parse_guild_weights(value: str) -> dict[str, float]:
+    """Parse guild weights from a comma separated list of guild_id:weight pairs
+
+    :param value: e.g. "1234:2,5678:0.5"
+    :return: dict of guild id to weight
+    """
+    weights = {}
+    for item in value.split(","):
+        if item.strip() == "":
+            continue
+        guild_id, _, raw_weight = item.partition(":")
+        weight = float(raw_weight)
+        if weight <= 0:
+            raise ValueError(f"Weight of guild {guild_id} must be positive")
+        weights[guild_id.strip()] = weight
+    return weights
+
+
+class FairQueue:
+    """Local queue of a worker, that schedules entries fairly between users
+
+    Entries are scheduled with start-time fair queuing: every user in every guild
+    gets a share of the worker proportional to the weight of their guild, no matter
+    how many prompts they queue. Users that have the maximum number of prompts
+    running, counted over all guilds, are skipped until one of their prompts is done.
+    Their waiting entries don't count towards maxsize, so the queue can take in
+    entries of other users.
+
+    Like asyncio.Queue, every entry taken with get must be marked with task_done.
+
+    :param maxsize: maximum number of waiting entries that can be started right away
+    :param max_held: maximum number of waiting entries in total, including entries
+        of users that have the maximum number of prompts running
+    :param weights: weights of guilds, guilds default to a weight of 1
+    :param max_in_flight_per_user: maximum number of running entries per user,
+        0 means no maximum
+    :param max_in_flight_anonymous: maximum number of running entries without a
+        user, together. 0 means no maximum
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        max_held: int,
+        weights: dict[str, float] | None = None,
+        max_in_flight_per_user: int = 0,
+        max_in_flight_anonymous: int = 0,
+    ):
+        self.maxsize = maxsize
+        self.max_held = max(max_held, maxsize)
+        self.weights = weights or {}
+        self.max_in_flight_per_user = max_in_flight_per_user
+        self.max_in_flight_anonymous = max_in_flight_anonymous
+        self._flows: dict[Flow, collections.deque[tuple[float, QueueEntry]]] = {}
+        # finish tag of the last entry put in each flow
+        self._finish_tags: dict[Flow, float] = {}
+        self._virtual_time = 0.0
+        # running entries by user id, None for entries without a user
+        self._in_flight: collections.Counter[str | None] = collections.Counter()
+        self._changed = asyncio.Event()
+
+    def qsize(self) -> int:
+        return sum(len(entries) for entries in self._flows.values())
+
+    def empty(self) -> bool:
+        return not self._flows
+
+    def room(self) -> int:
+        """Number of entries that can be put without waiting
+
+        :return: number of entries
+        """
+        waiting: collections.Counter[str | None] = collections.Counter()
+        for (_, user_id), entries in self._flows.items():
+            waiting[user_id] += len(entries)
+        runnable = sum(
+            min(count, self._free_slots(user_id)) for user_id, count in waiting.items()
+        )
+        return max(min(self.maxsize - runnable, self.max_held - self.qsize()), 0)
+
+    async def put(self, entry: QueueEntry) -> None:
+        """Put an entry in the queue, waiting for room if needed
+
+        :param entry: the queue entry
+        :return: None
+        """
+        await self._wait_for(lambda: self.room() > 0)
+        flow = flow_of(entry)
+        start = max(self._virtual_time, self._finish_tags.get(flow, 0.0))
+        self._finish_tags[flow] = start + 1 / self.weights.get(flow[0] or "", 1.0)
+        self._flows.setdefault(flow, collections.deque()).append((start, entry))
+        self._notify()
+
+    async def get(self) -> QueueEntry:
+        """Take the next entry to run, waiting for one if needed
+
+        :return: the queue entry
+        """
+        while (flow := self._next_flow()) is None:
+            await self._changed.wait()
+        start, entry = self._flows[flow].popleft()
+        if not self._flows[flow]:
+            del self._flows[flow]
+        self._virtual_time = start
+        self._in_flight[flow[1]] += 1
+        self._forget_idle_flows()
+        self._notify()
+        return entry
+
+    def task_done(self, entry: QueueEntry) -> None:
+        """Mark an entry taken with get as done
+
+        :param entry: the queue entry
+        :return: None
+        """
+        _, user_id = flow_of(entry)
+        self._in_flight[user_id] -= 1
+        if self._in_flight[user_id] <= 0:
+            del self._in_flight[user_id]
+        self._notify()
+
+    def take_waiting(self) -> list[QueueEntry]:
+        """Remove all waiting entries from the queue
+
+        :return: the waiting entries, in the order they would have run
+        """
+        waiting = sorted(
+            (item for entries in self._flows.values() for item in entries),
+            key=lambda item: item[0],
+        )
+        self._flows.clear()
+        self._notify()
+        return [entry for _, entry in waiting]
+
+    async def join(self) -> None:
+        """Wait until no entries are waiting or running
+
+        :return: None
+        """
+        await self._wait_for(lambda: self.empty() and not self._in_flight)
+
+    def _notify(self) -> None:
+        # wake up everyone waiting for a change, and start over for the next one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _wait_for(self, predicate: Callable[[], bool]) -> None:
+        while not predicate():
+            await self._changed.wait()
+
+    def _free_slots(self, user_id: str | None) -> int:
+        """Number of entries of a user that can be started right now"""
+        # entries queued by older versions don't tell whose they are, and share a
+        # maximum of their own.
+        maximum = (
+            self.max_in_flight_anonymous
+            if user_id is None
+            else self.max_in_flight_per_user
+        )
+        if maximum <= 0:
+            return self.maxsize
+        return max(maximum - self._in_flight[user_id], 0)
+
+    def _next_flow(self) -> Flow | None:
+        runnable = [flow for flow in self._flows if self._free_slots(flow[1]) > 0]
+        if not runnable:
+            return None
+        return min(runnable, key=lambda flow: self._flows[flow][0][0])
+
+    def _forget_idle_flows(self) -> None:
+        # a flow that is not waiting has no claim on its past finish tag once the
+        # virtual time has passed it.
+        for flow in [
+            flow
+            for flow, tag in self._finish_tags.items()
+            if flow not in self._flows and tag <= self._virtual_time
+        ]:
+            del self._finish_tags[flow]
@@ -0,0 +1,189 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import contextlib
+import logging
+import uuid
+from typing import Awaitable, Callable
+
+import redis.asyncio as redis
+from redis.asyncio.lock import Lock
+from redis.exceptions import LockError
+
+from .metrics import SINGLE_FLIGHT
+from .models import FinishReason, TextToImageResponse
+from .results import RESULT_CHANNEL, ResultListener, fetch_results, store_results
+
+logger = logging.getLogger(__name__)
+
+FLIGHT_PREFIX = "droombot-flight"
+# Seconds the lock of a flight is held without being refreshed. Followers take over a
+# flight whose leader did not refresh its lock in time.
+FLIGHT_LOCK_TTL = 30
+# Seconds the result of a flight is kept for its followers to pick it up.
+FLIGHT_RESULT_TTL = 30
+
+
+class SingleFlight:
+    """Share a single call between identical requests, across all workers
+
+    The first worker to run a request leads its flight. Workers running an identical
+    request while the flight is in progress follow it: they wait for the leader to
+    store its result, instead of making a call of their own. The result is stored
+    like the result of an interaction, so followers are woken up by the same
+    announcements the bot listens to. It is only shared with the followers of the
+    flight: an identical request made after the flight landed starts a new one.
+
+    A leader holds a lock in redis for as long as it runs, and refreshes it. If a
+    leader dies, its lock expires, and one of its followers takes over the flight. A
+    leader that is cancelled releases its lock, and announces the flight without a
+    result, so that one of its followers takes over right away.
+
+    :param redis_connection: redis instance
+    """
+
+    def __init__(self, redis_connection: redis.Redis):
+        self._redis_connection = redis_connection
+        self._listener = ResultListener(redis_connection)
+        # flights of this worker, with the number of callers waiting for each.
+        self._local: dict[str, tuple[asyncio.Task, list[int]]] = {}
+
+    async def stop(self) -> None:
+        await self._listener.stop()
+
+    async def run(
+        self,
+        digest: str,
+        call: Callable[[], Awaitable[list[TextToImageResponse]]],
+    ) -> list[TextToImageResponse]:
+        """Run a call, or follow an identical call in flight
+
+        Identical calls of this worker share a single flight. The flight is cancelled
+        once none of its callers wait for it anymore.
+
+        :param digest: canonical hash of the request, see ResultCache.digest
+        :param call: the call to run, if no identical call is in flight
+        :return: the responses of the call
+        """
+        if digest in self._local:
+            task, waiters = self._local[digest]
+            logger.info("Followed an identical request of this worker")
+            SINGLE_FLIGHT.labels("follower").inc()
+        else:
+            task, waiters = asyncio.create_task(self._run(digest, call)), [0]
+            self._local[digest] = (task, waiters)
+            task.add_done_callback(lambda t: self._forget(digest, t))
+        waiters[0] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            waiters[0] -= 1
+            if not waiters[0] and not task.done():
+                task.cancel()
+                self._forget(digest, task)
+
+    def _forget(self, digest: str, task: asyncio.Task) -> None:
+        if digest in self._local and self._local[digest][0] is task:
+            del self._local[digest]
+        # the exception was raised to the callers, if any were left
+        if task.done() and not task.cancelled():
+            task.exception()
+
+    async def _run(
+        self,
+        digest: str,
+        call: Callable[[], Awaitable[list[TextToImageResponse]]],
+    ) -> list[TextToImageResponse]:
+        lock_key = f"{FLIGHT_PREFIX}:{digest}:lock"
+        lock = self._redis_connection.lock(
+            lock_key, timeout=FLIGHT_LOCK_TTL, thread_local=False
+        )
+        while True:
+            # every flight stores its result under the token of its lock, so only
+            # callers that join while it is in flight get its result.
+            token = uuid.uuid4().hex
+            if await lock.acquire(blocking=False, token=token):
+                break
+            leader_token = await self._redis_connection.get(lock_key)
+            if leader_token is None:
+                # the flight just landed, start a new one
+                continue
+            flight_id = f"{FLIGHT_PREFIX}:{digest}:{leader_token.decode('utf-8')}"
+            # register before looking for a result, so its announcement can not be
+            # missed.
+            await self._listener.register(flight_id)
+            responses = await fetch_results(self._redis_connection, flight_id)
+            if responses is None:
+                responses = await self._follow(flight_id)
+            else:
+                self._listener.unregister(flight_id)
+            if responses is not None:
+                logger.info("Followed an identical request in flight")
+                SINGLE_FLIGHT.labels("follower").inc()
+                return responses
+
+        flight_id = f"{FLIGHT_PREFIX}:{digest}:{token}"
+
+        SINGLE_FLIGHT.labels("leader").inc()
+        keeper = asyncio.create_task(self._keep(lock))
+        stored = False
+        try:
+            responses = await call()
+        except Exception:
+            # followers must not wait for a result that will never come.
+            await self._store(
+                flight_id,
+                [TextToImageResponse(finish_reason=FinishReason.ERROR, seed=0)],
+            )
+            stored = True
+            raise
+        else:
+            await self._store(flight_id, responses)
+            stored = True
+        finally:
+            keeper.cancel()
+            with contextlib.suppress(LockError):
+                await lock.release()
+            if not stored:
+                # cancelled, wake up the followers so one of them takes over
+                await self._redis_connection.publish(RESULT_CHANNEL, flight_id)
+        return responses
+
+    async def _store(
+        self, flight_id: str, responses: list[TextToImageResponse]
+    ) -> None:
+        await store_results(
+            self._redis_connection, flight_id, responses, FLIGHT_RESULT_TTL
+        )
+
+    async def _follow(self, flight_id: str) -> list[TextToImageResponse] | None:
+        # woken up once the leader stored its result, or released its lock without
+        # one. Without a result, or without being woken up in time, try to take over.
+        try:
+            if not await self._listener.next_update(flight_id, FLIGHT_LOCK_TTL):
+                return None
+            return await fetch_results(self._redis_connection, flight_id)
+        finally:
+            self._listener.unregister(flight_id)
+
+    @staticmethod
+    async def _keep(lock: Lock) -> None:
+        while True:
+            await asyncio.sleep(FLIGHT_LOCK_TTL / 3)
+            try:
+                await lock.reacquire()
+            except LockError:
+                logger.warning("Lost the lock of a flight, followers may take over")
+                return
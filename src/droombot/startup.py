@@ -0,0 +1,83 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import collections
+import dataclasses
+import logging
+import subprocess
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the lines python -X importtime reports imports with.
+IMPORT_TIME_PREFIX = "import time:"
+
+
+@dataclasses.dataclass(frozen=True)
+class ImportTime:
+    module: str
+    # seconds spent importing the module itself
+    self_time: float
+    # seconds spent importing the module, including the modules it imported
+    cumulative: float
+
+
+def measure_imports(modules: list[str]) -> list[ImportTime]:
+    """Measure the time spent importing modules, as at a cold start
+
+    The modules are imported in a fresh interpreter, with python -X importtime.
+
+    :param modules: names of the modules to import
+    :return: for every module imported, including the modules they imported, the
+        time it took
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith(IMPORT_TIME_PREFIX):
+            continue
+        self_time, cumulative, module = line[len(IMPORT_TIME_PREFIX) :].split("|")
+        # the header of the report
+        if not self_time.strip().isdigit():
+            continue
+        times.append(
+            ImportTime(module.strip(), int(self_time) / 1e6, int(cumulative) / 1e6)
+        )
+    return times
+
+
+def startup_report(modules: list[str], limit: int = 15) -> str:
+    """Report the time spent importing modules, by top-level package
+
+    :param modules: names of the modules to import
+    :param limit: maximum number of packages to report
+    :return: the report
+    """
+    times = measure_imports(modules)
+    packages: collections.defaultdict[str, float] = collections.defaultdict(float)
+    for t in times:
+        packages[t.module.partition(".")[0]] += t.self_time
+    lines = [
+        f"Importing {', '.join(modules)} took {sum(packages.values()) * 1000:.1f} ms",
+        f"{'package':<30} {'ms':>8}",
+    ]
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    for package, seconds in slowest[:limit]:
+        lines.append(f"{package:<30} {seconds * 1000:>8.1f}")
+    return "\n".join(lines)
@@ -0,0 +1,273 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import dataclasses
+import hashlib
+import io
+import logging
+import mmap
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from .config import IMAGE_STORE_MAX_BYTES
+from .models import FinishReason, PubSubMessage, TextToImageResponse
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access);
+CREATE TABLE IF NOT EXISTS results (
+    interaction_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    digest TEXT NOT NULL REFERENCES images (digest) ON DELETE CASCADE,
+    user_id TEXT,
+    guild_id TEXT,
+    prompt TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    seed INTEGER NOT NULL,
+    output_format TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (interaction_id, idx)
+);
+CREATE INDEX IF NOT EXISTS results_user ON results (user_id, created);
+CREATE INDEX IF NOT EXISTS results_guild ON results (guild_id, created);
+CREATE INDEX IF NOT EXISTS results_prompt_hash ON results (prompt_hash);
+CREATE INDEX IF NOT EXISTS results_digest ON results (digest);
+"""
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+@dataclasses.dataclass(frozen=True)
+class StoredImage:
+    interaction_id: str
+    index: int
+    # sha256 of the image, under which it is stored
+    digest: str
+    prompt: str
+    seed: int
+    output_format: str
+    # unix timestamp
+    created: float
+
+
+class MappedImage(io.BufferedIOBase):
+    """Read-only file object serving an image from a memory map
+
+    The image is not read into memory, pages are loaded by the OS when read.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        with path.open("rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int | None = -1) -> bytes:
+        return self._map.read(size)
+
+    def read1(self, size: int = -1) -> bytes:
+        return self._map.read(size)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self._map.seek(offset, whence)  # type: ignore[arg-type]
+        return self._map.tell()
+
+    def tell(self) -> int:
+        return self._map.tell()
+
+    def close(self) -> None:
+        if not self.closed:
+            self._map.close()
+        super().close()
+
+
+class ImageStore:
+    """Content-addressed store of generated images on disk
+
+    Images are stored in files named after their sha256, so identical images are
+    stored once. A SQLite index maps interactions, users, guilds, prompts and seeds
+    to images. Once the images take up more than max_bytes, the least recently
+    accessed images are evicted, together with their index entries.
+
+    Methods block on disk IO, so should be run in a thread from async code.
+
+    :param path: directory to store in, created if it does not exist
+    :param max_bytes: maximum total size of the images
+    """
+
+    def __init__(self, path: str | os.PathLike, max_bytes: int = IMAGE_STORE_MAX_BYTES):
+        self.path = pathlib.Path(path)
+        self.max_bytes = max_bytes
+        (self.path / "objects").mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self.path / "index.sqlite3", check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA foreign_keys = ON")
+        self._db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def image_path(self, digest: str) -> pathlib.Path:
+        return self.path / "objects" / digest[:2] / digest
+
+    def put(
+        self, message: PubSubMessage, responses: list[TextToImageResponse]
+    ) -> list[str]:
+        """Store the successful images of an interaction
+
+        :param message: the message the responses were generated for
+        :param responses: the responses, in order
+        :return: digests of the stored images
+        """
+        now = time.time()
+        images = {}
+        rows = []
+        for index, response in enumerate(responses):
+            if response.finish_reason is not FinishReason.SUCCESS or not response.image:
+                continue
+            digest = hashlib.sha256(response.image).hexdigest()
+            images[digest] = response.image
+            rows.append(
+                (
+                    message.interaction_id,
+                    index,
+                    digest,
+                    message.user_id,
+                    message.guild_id,
+                    message.text_prompt,
+                    prompt_hash(message.text_prompt),
+                    response.seed,
+                    response.output_format,
+                    now,
+                )
+            )
+
+        # files are written and evicted under the lock as well, so an image can not
+        # be evicted while it is being added again.
+        with self._lock:
+            for digest, image in images.items():
+                self._write(digest, image)
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    "INSERT INTO images (digest, size, last_access) VALUES (?, ?, ?) "
+                    "ON CONFLICT (digest) DO UPDATE "
+                    "SET last_access = excluded.last_access",
+                    [(digest, len(image), now) for digest, image in images.items()],
+                )
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO results "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                evicted = self._evict()
+            for digest in evicted:
+                self.image_path(digest).unlink(missing_ok=True)
+        if evicted:
+            logger.info("Evicted %d images from the image store", len(evicted))
+        return [row[2] for row in rows]
+
+    def open(self, digest: str) -> MappedImage | None:
+        """Open a stored image
+
+        :param digest: digest of the image
+        :return: the image as a memory-mapped file object, or None if it is not stored
+        """
+        try:
+            image = MappedImage(self.image_path(digest))
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._db.execute(
+                "UPDATE images SET last_access = ? WHERE digest = ?",
+                (time.time(), digest),
+            )
+        return image
+
+    def images(self, interaction_id: str) -> list[StoredImage]:
+        """Stored images of an interaction
+
+        :param interaction_id: the interaction id
+        :return: the images, in order
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT interaction_id, idx, digest, prompt, seed, output_format, "
+                "created FROM results WHERE interaction_id = ? ORDER BY idx",
+                (interaction_id,),
+            ).fetchall()
+        return [StoredImage(*row) for row in rows]
+
+    def interactions(self, user_id: str, limit: int = 10) -> list[str]:
+        """Interactions of a user with stored images, most recent first
+
+        :param user_id: the user id
+        :param limit: maximum number of interactions
+        :return: interaction ids
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT interaction_id FROM results WHERE user_id = ? "
+                "GROUP BY interaction_id ORDER BY MAX(created) DESC LIMIT ?",
+                (user_id, limit),
+            ).fetchall()
+        return [interaction_id for (interaction_id,) in rows]
+
+    def _write(self, digest: str, image: bytes | bytearray) -> None:
+        path = self.image_path(digest)
+        if path.exists():
+            return
+        path.parent.mkdir(exist_ok=True)
+        # write to a temporary file first, so readers never see a partial image
+        tmp = path.with_name(f"{digest}.tmp")
+        tmp.write_bytes(image)
+        os.replace(tmp, path)
+
+    def _evict(self) -> list[str]:
+        (total,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM images"
+        ).fetchone()
+        evicted: list[str] = []
+        if total <= self.max_bytes:
+            return evicted
+        for digest, size in self._db.execute(
+            "SELECT digest, size FROM images ORDER BY last_access"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append(digest)
+            total -= size
+        self._db.executemany(
+            "DELETE FROM images WHERE digest = ?", [(digest,) for digest in evicted]
+        )
+        return evicted
@@ -0,0 +1,220 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.process
+import signal
+import threading
+import time
+from typing import Any, Callable
+
+from .config import (
+    METRICS_PORT,
+    WORKER_DRAIN_TIMEOUT,
+    WORKER_HEARTBEAT_TIMEOUT,
+)
+from .log import bind_log_fields, init_logging
+from .metrics import start_metrics_server
+from .tracing import init_tracing
+from .worker import Worker
+
+logger = logging.getLogger(__name__)
+
+# How often worker processes report to be alive, in seconds.
+HEARTBEAT_INTERVAL = 5
+# How often the supervisor checks the health of worker processes, in seconds.
+HEALTH_CHECK_INTERVAL = 1
+# Seconds to wait before restarting a crashed process. Doubled for every crash in a
+# row, up to MAX_RESTART_DELAY.
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+# Processes that ran for this many seconds did not crash in a row.
+STABLE_TIME = 60
+# Seconds on top of WORKER_DRAIN_TIMEOUT to wait for processes to stop, before they
+# are killed.
+SHUTDOWN_GRACE = 10
+
+
+def run_worker(index: int, heartbeats: Any) -> None:
+    """Run a worker in a worker process
+
+    :param index: index of the process
+    :param heartbeats: shared array, in which the process reports to be alive
+    :return: None
+    """
+    init_logging()
+    bind_log_fields(worker_process=index)
+    # every process serves its own metrics, on consecutive ports.
+    start_metrics_server(METRICS_PORT + index if METRICS_PORT else 0)
+    init_tracing("droombot-worker", **{"droombot.worker_process": index})
+    asyncio.run(_run_worker(index, heartbeats))
+
+
+async def _run_worker(index: int, heartbeats: Any) -> None:
+    async def beat() -> None:
+        while True:
+            heartbeats[index] = time.time()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    heartbeat = asyncio.create_task(beat())
+    try:
+        await Worker().loop()
+    finally:
+        heartbeat.cancel()
+
+
+class Supervisor:
+    """Run workers in multiple processes, to make use of multiple cores
+
+    Every process runs its own worker, with its own event loop and connections to
+    redis and Stability. Rate limits are kept in redis, so all processes share them.
+
+    Processes that crash are restarted, with a growing delay if they keep crashing.
+    Processes that stop reporting to be alive, e.g. because their event loop is
+    blocked, are killed and restarted. Prompts they were running are claimed by other
+    workers after WORKER_CLAIM_IDLE_TIME.
+
+    On SIGTERM or SIGINT, all processes are asked to stop, and given
+    WORKER_DRAIN_TIMEOUT seconds to drain their running prompts.
+
+    :param processes: number of worker processes
+    :param target: function run in every process, with its index and the shared
+        heartbeat array
+    :param heartbeat_timeout: seconds without heartbeat after which a process is
+        considered unresponsive
+    :param check_interval: how often to check the health of processes, in seconds
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        target: Callable[[int, Any], None] = run_worker,
+        heartbeat_timeout: float = WORKER_HEARTBEAT_TIMEOUT,
+        check_interval: float = HEALTH_CHECK_INTERVAL,
+    ):
+        self.processes = processes
+        self.target = target
+        self.heartbeat_timeout = heartbeat_timeout
+        self.check_interval = check_interval
+        # forking a process with running threads is unsafe
+        self._context = multiprocessing.get_context("spawn")
+        self._heartbeats = self._context.Array("d", processes, lock=False)
+        self._children: list[multiprocessing.process.BaseProcess | None] = [
+            None
+        ] * processes
+        self._started_at = [0.0] * processes
+        self._restart_at: list[float | None] = [None] * processes
+        self._crashes = [0] * processes
+        self._stopping = threading.Event()
+        # number of times processes were restarted
+        self.restarts = 0
+
+    def run(self) -> None:
+        """Run the worker processes until SIGTERM or SIGINT
+
+        :return: None
+        """
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *_: self.stop())
+        logger.info("Starting %d worker processes...", self.processes)
+        self.supervise()
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    def supervise(self) -> None:
+        """Start the worker processes, and keep them running until stopped
+
+        :return: None, once all processes have stopped
+        """
+        for index in range(self.processes):
+            self._start(index)
+        try:
+            while not self._stopping.is_set():
+                sentinels = [c.sentinel for c in self._children if c is not None]
+                multiprocessing.connection.wait(sentinels, timeout=self.check_interval)
+                self._check()
+        finally:
+            self._shutdown()
+
+    def _start(self, index: int) -> None:
+        child = self._context.Process(
+            target=self.target,
+            args=(index, self._heartbeats),
+            name=f"droombot-worker-{index}",
+        )
+        # the process gets until the heartbeat timeout to start up.
+        self._heartbeats[index] = time.time()
+        child.start()
+        self._children[index] = child
+        self._started_at[index] = time.monotonic()
+        self._restart_at[index] = None
+        logger.info("Started worker process %d with pid %s", index, child.pid)
+
+    def _check(self) -> None:
+        now = time.monotonic()
+        for index, child in enumerate(self._children):
+            if child is None:
+                restart_at = self._restart_at[index]
+                if restart_at is not None and now >= restart_at:
+                    self.restarts += 1
+                    self._start(index)
+                continue
+
+            if child.is_alive():
+                silence = time.time() - self._heartbeats[index]
+                if silence <= self.heartbeat_timeout:
+                    continue
+                logger.error(
+                    "Worker process %d has not reported for %.0f seconds, killing it",
+                    index,
+                    silence,
+                )
+                child.kill()
+                child.join()
+            else:
+                child.join()
+                logger.error(
+                    "Worker process %d exited with code %s", index, child.exitcode
+                )
+
+            if now - self._started_at[index] >= STABLE_TIME:
+                self._crashes[index] = 0
+            delay = min(RESTART_DELAY * 2 ** self._crashes[index], MAX_RESTART_DELAY)
+            self._crashes[index] += 1
+            logger.info("Restarting worker process %d in %d seconds", index, delay)
+            child.close()
+            self._children[index] = None
+            self._restart_at[index] = now + delay
+
+    def _shutdown(self) -> None:
+        logger.info("Stopping worker processes...")
+        children = [c for c in self._children if c is not None]
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+        deadline = time.monotonic() + WORKER_DRAIN_TIMEOUT + SHUTDOWN_GRACE
+        for child in children:
+            child.join(max(0.0, deadline - time.monotonic()))
+            if child.is_alive():
+                logger.error(
+                    "Worker process %s did not stop in time, killing it", child.pid
+                )
+                child.kill()
+                child.join()
+        self._children = [None] * self.processes
+        logger.info("Stopped all worker processes")
@@ -0,0 +1,149 @@
+#    Copyright 2023-2024 Sander Bollen
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import contextlib
+import logging
+from typing import TYPE_CHECKING, Any, Iterator
+
+from .config import TRACING_EXPORTER, TRACING_FILE
+
+# Traces are only collected when the optional opentelemetry packages are installed,
+# with the tracing extra, and an exporter is configured. Otherwise, spans are no-ops.
+# opentelemetry is only imported once tracing is enabled, to keep startup fast.
+if TYPE_CHECKING:
+    from opentelemetry.sdk.trace.export import SpanExporter
+
+logger = logging.getLogger(__name__)
+
+EXPORTERS = ("otlp", "file")
+
+# Set by init_tracing, if tracing is enabled.
+_provider: Any = None
+_tracer: Any = None
+
+
+def init_tracing(service_name: str, **attributes: Any) -> None:
+    """Start exporting spans, if TRACING_EXPORTER is set
+
+    :param service_name: name of the service the spans belong to
+    :param attributes: extra attributes of all spans of the process
+    :return: None
+    """
+    global _provider, _tracer
+    if not TRACING_EXPORTER:
+        return
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        logger.error(
+            "Cannot export traces, as opentelemetry is not installed. "
+            "Install droombot with the tracing extra."
+        )
+        return
+    # spans are exported in batches, from a background thread. Spans that are left
+    # are exported when the process exits.
+    _provider = TracerProvider(
+        resource=Resource.create({"service.name": service_name, **attributes})
+    )
+    _provider.add_span_processor(BatchSpanProcessor(_create_exporter(TRACING_EXPORTER)))
+    _tracer = _provider.get_tracer("droombot")
+    logger.info(f"Exporting traces with the {TRACING_EXPORTER} exporter")
+
+
+def _create_exporter(name: str) -> "SpanExporter":
+    match name:
+        case "otlp":
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+
+            # configured by the standard OTEL_EXPORTER_OTLP_* environment variables
+            return OTLPSpanExporter()
+        case "file":
+            from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+            return ConsoleSpanExporter(
+                out=open(TRACING_FILE, "a", encoding="utf-8"),
+                formatter=lambda span: span.to_json(indent=None) + "\n",
+            )
+        case _:
+            raise ValueError(
+                f"Unknown trace exporter: {name}. Choose from {', '.join(EXPORTERS)}"
+            )
+
+
+def span(
+    name: str, start_time: float | None = None, **attributes: Any
+) -> contextlib.AbstractContextManager:
+    """Time a stage of a prompt in a span, as child of the current span
+
+    :param name: name of the span
+    :param start_time: unix time at which the span started, if before now
+    :param attributes: attributes of the span
+    :return: context manager, that ends the span on exit
+    """
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.start_as_current_span(
+        name,
+        start_time=None if start_time is None else int(start_time * 1e9),
+        attributes=attributes,
+    )
+
+
+def annotate(**attributes: Any) -> None:
+    """Add attributes to the current span
+
+    :param attributes: the attributes
+    :return: None
+    """
+    if _tracer is not None:
+        from opentelemetry import trace
+
+        trace.get_current_span().set_attributes(attributes)
+
+
+def trace_context() -> dict[str, str]:
+    """The current trace context, to send along with a job
+
+    :return: the trace context as W3C trace context headers. Empty if tracing is
+        disabled.
+    """
+    carrier: dict[str, str] = {}
+    if _tracer is not None:
+        from opentelemetry import propagate
+
+        propagate.inject(carrier)
+    return carrier
+
+
+@contextlib.contextmanager
+def continue_trace(carrier: dict[str, str]) -> Iterator[None]:
+    """Make spans children of the span a job was sent from
+
+    :param carrier: the trace context sent with the job, see trace_context
+    :return: context manager, that restores the previous trace context on exit
+    """
+    if _tracer is None or not carrier:
+        yield
+        return
+    from opentelemetry import context, propagate
+
+    token = context.attach(propagate.extract(carrier))
+    try:
+        yield
+    finally:
+        context.detach(token)
@@ -12,41 +12,61 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-
+import functools
 import importlib.metadata
+import pathlib
 import subprocess
 
+# Root of the source checkout, when droombot runs from one.
+SOURCE_ROOT = pathlib.Path(__file__).resolve().parents[2]
+
 
+@functools.cache
 def get_version() -> str:
     """Get the current version of droombot.
 
-    This will be of shape <x.y.z>-<git short hash>. The git hash can only
-    be computed if we are in a git repo and git is installed.
-    So from docker or from pip installs, the hash will be empty. Lastly, if we are in
-    a git repo, we will append a `-dirty` tag if the current checkout is in a dirty
-    state.
+    This will be of shape <x.y.z>-<git revision>. The git revision is baked into
+    containers at build time, as the REVISION build argument. Otherwise it can only be
+    computed if we are running from a git checkout and git is installed, so from pip
+    installs it will be empty. Lastly, if we are in a git checkout, we will append a
+    `-dirty` tag if the current checkout is in a dirty state.
+
+    The version is computed once, when it is first needed.
 
     :return: Version string
     """
+    git_tag = _build_revision() or _git_revision()
+
+    base_version = importlib.metadata.version("droombot")
+
+    if git_tag is None:
+        return base_version
+
+    return f"{base_version}-{git_tag}"
+
+
+def _build_revision() -> str | None:
     try:
-        git_tag: str | None = (
+        from ._revision import REVISION  # type: ignore[import-not-found]
+    except ImportError:
+        return None
+    return REVISION or None
+
+
+def _git_revision() -> str | None:
+    # only look for git in development, where droombot runs from a checkout
+    if not (SOURCE_ROOT / ".git").exists():
+        return None
+    try:
+        return (
             subprocess.run(
                 ["git", "describe", "--always", "--dirty"],
                 capture_output=True,
                 check=True,
+                cwd=SOURCE_ROOT,
             )
             .stdout.decode("utf-8")
             .strip()
         )
     except (subprocess.CalledProcessError, FileNotFoundError):
-        git_tag = None
-
-    base_version = importlib.metadata.version("droombot")
-
-    if git_tag is None:
-        return base_version
-
-    return f"{base_version}-{git_tag}"
-
-
-VERSION = get_version()
+        return None
@@ -13,36 +13,153 @@
 #    limitations under the License.
 
 import asyncio
-import json
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
 import logging
+import math
+import multiprocessing
+import signal
+import time
 import traceback
 
-import aiohttp
-import pydantic
-import pydantic.json
 import redis.asyncio as redis
-from aiolimiter import AsyncLimiter
 
-from .api import text_to_image
-from .config import MAX_REQUESTS_PER_MINUTE, REDIS_HOST, REDIS_KEY_LIFETIME, REDIS_PORT
-from .models import PubSubMessage, pubsub_to_t2i
+from .backend import TextToImageBackend, create_backend
+from .cache import ResultCache
+from .cancellation import CancellationListener
+from .config import (
+    GUILD_WEIGHTS,
+    MAX_ANONYMOUS_PROMPTS_IN_FLIGHT,
+    MAX_PROMPTS_IN_FLIGHT_PER_USER,
+    POSTPROCESS_PROCESSES,
+    REDIS_HOST,
+    REDIS_KEY_LIFETIME,
+    REDIS_PORT,
+    WORKER_BACKEND,
+    WORKER_BATCH_SIZE,
+    WORKER_CLAIM_IDLE_TIME,
+    WORKER_CONCURRENCY,
+    WORKER_DRAIN_TIMEOUT,
+    WORKER_MAX_HELD,
+)
+from .job_queue import JobQueue, QueueEntry, entry_time
+from .log import log_fields
+from .metrics import ABANDONED_PROMPTS, IN_FLIGHT, QUEUE_DEPTH
+from .models import (
+    FinishReason,
+    PubSubMessage,
+    TextToImageRequestV2Core,
+    TextToImageRequestV2SD3,
+    TextToImageResponse,
+    pubsub_to_t2i,
+)
+from .postprocess import PostprocessSettings, ignore_interrupts, postprocess_image
+from .results import announce_started, store_response, store_results
+from .scheduling import FairQueue, parse_guild_weights
+from .singleflight import SingleFlight
+from .tracing import annotate, continue_trace, span
 
 logger = logging.getLogger(__name__)
 
+# How long to block on reading the stream, in milliseconds.
+READ_BLOCK_TIME = 1_000
+# How often to look for stale entries of dead workers, in seconds.
+CLAIM_INTERVAL = 60
+# Number of times the idle time of held entries is reset per WORKER_CLAIM_IDLE_TIME.
+KEEP_ALIVES_PER_CLAIM_TIME = 3
+# How often to measure the depth of the job queue, in seconds.
+QUEUE_DEPTH_INTERVAL = 5
+# Seconds results are kept after the deadline of their prompt, for the bot to fetch
+# results stored just before the deadline.
+RESULT_GRACE_TIME = 30
+
+
+def result_ttl(message: PubSubMessage) -> int:
+    """Number of seconds to keep the results of a prompt in redis
+
+    Results are only needed until the bot stops waiting for them, at the deadline of
+    the prompt.
+
+    :param message: the prompt
+    :return: the ttl
+    """
+    if message.deadline is None:
+        return REDIS_KEY_LIFETIME
+    return max(0, math.ceil(message.deadline - time.time())) + RESULT_GRACE_TIME
+
 
 class Worker:
-    def __init__(self):
-        self._redis_connection = redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    """Worker running text-to-image generation for prompts in the job queue
 
+    A single reader reads entries from the job queue into a local queue, which is
+    bounded to the number of concurrent generations. A fixed number of consumers take
+    entries from the local queue and run them, picking entries fairly between users
+    and guilds. When all consumers are busy, the local queue fills up and the reader
+    stops reading, leaving the entries in the job queue for other workers.
+    """
+
+    def __init__(
+        self,
+        redis_connection: redis.Redis | None = None,
+        concurrency: int = WORKER_CONCURRENCY,
+        backend: TextToImageBackend | None = None,
+        postprocess_settings: PostprocessSettings | None = None,
+    ):
+        self._redis_connection = redis_connection or redis.Redis(
+            host=REDIS_HOST, port=REDIS_PORT
+        )
+        self._job_queue = JobQueue(self._redis_connection)
+        self._single_flight = SingleFlight(self._redis_connection)
+        self._cancellations = CancellationListener(self._redis_connection)
+        self._backend = backend or create_backend(
+            WORKER_BACKEND, self._redis_connection
+        )
+        self._concurrency = concurrency
+        # prompts can request multiple images, so the number of concurrent calls to
+        # the backend is bounded separately from the number of concurrent prompts.
+        self._backend_slots = asyncio.Semaphore(concurrency)
+        self._postprocess_settings = (
+            postprocess_settings or PostprocessSettings.from_config()
+        )
+        self._cache = ResultCache(
+            self._redis_connection, postprocess_settings=self._postprocess_settings
+        )
+        # created by loop. Without it, images are post-processed in threads.
+        self._postprocess_pool: concurrent.futures.ProcessPoolExecutor | None = None
+
+        self._queue = FairQueue(
+            maxsize=concurrency,
+            max_held=WORKER_MAX_HELD,
+            weights=parse_guild_weights(GUILD_WEIGHTS),
+            max_in_flight_per_user=MAX_PROMPTS_IN_FLIGHT_PER_USER,
+            max_in_flight_anonymous=MAX_ANONYMOUS_PROMPTS_IN_FLIGHT,
+        )
+        # entries read from the job queue, but not yet put on the local queue.
+        self._unqueued: collections.deque[QueueEntry] = collections.deque()
+        # ids of entries read from the job queue that are waiting or running.
+        self._held: set[str] = set()
+        self._stopping = asyncio.Event()
         self._running_tasks: set[asyncio.Task] = set()
-        self._wait_lock = asyncio.Lock()
+        QUEUE_DEPTH.labels("local").set_function(
+            lambda: self._queue.qsize() + len(self._unqueued)
+        )
 
     def run(self):
         logger.info("Starting worker...")
         asyncio.run(self.loop())
 
+    def stop(self) -> None:
+        """Stop reading new prompts, and drain the running ones
+
+        :return: None
+        """
+        logger.info("Stopping worker...")
+        self._stopping.set()
+
     def _done_callback(self, t: asyncio.Task) -> None:
-        if (exc := t.exception()) is not None:
+        if not t.cancelled() and (exc := t.exception()) is not None:
             logger.error(
                 f"Task {t.get_name()} raised an exception during execution...: {exc} "
                 f"\n \n {''.join(traceback.format_tb(exc.__traceback__))}"
@@ -51,57 +168,384 @@ class Worker:
 
     async def loop(self):
         """Main application loop"""
-        http_client = aiohttp.ClientSession()
-        limiter = AsyncLimiter(MAX_REQUESTS_PER_MINUTE)
-        async with self._redis_connection.pubsub() as pubsub:
-            await pubsub.subscribe("droombot-prompts")
-            while True:
-                async with limiter:
-                    task = asyncio.create_task(self.read_and_run(pubsub, http_client))
-                    self._running_tasks.add(task)
-                    task.add_done_callback(self._done_callback)
-
-    async def read_and_run(
-        self, channel: redis.client.PubSub, session: aiohttp.ClientSession
-    ) -> None:
-        """Read redis channel for new message, and run text-to-image if there is one.
+        event_loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            event_loop.add_signal_handler(sig, self.stop)
+
+        await self._job_queue.ensure_group()
+        # post-processing images is CPU bound, so it is done in separate processes to
+        # keep the event loop responsive. Processes are spawned, as forking a process
+        # with running threads is unsafe.
+        if POSTPROCESS_PROCESSES > 0:
+            self._postprocess_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=POSTPROCESS_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=ignore_interrupts,
+            )
+        try:
+            await self._run()
+        finally:
+            await self._single_flight.stop()
+            await self._cancellations.stop()
+            if self._postprocess_pool is not None:
+                self._postprocess_pool.shutdown(cancel_futures=True)
+                self._postprocess_pool = None
+
+    async def _run(self) -> None:
+        async with self._backend:
+            for i in range(self._concurrency):
+                task = asyncio.create_task(self.consume(), name=f"consumer-{i}")
+                self._running_tasks.add(task)
+                task.add_done_callback(self._done_callback)
+
+            reader = asyncio.create_task(self.read(), name="reader")
+            keeper = asyncio.create_task(self.keep_alive(), name="keeper")
+            stopping = asyncio.create_task(self._stopping.wait())
+            await asyncio.wait({reader, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            reader.cancel()
+            stopping.cancel()
+            await asyncio.gather(reader, stopping, return_exceptions=True)
+            await self.drain()
+            keeper.cancel()
+            await asyncio.gather(keeper, return_exceptions=True)
+            # a crashed reader should crash the worker, after draining.
+            if not reader.cancelled() and (exc := reader.exception()) is not None:
+                raise exc
+
+    async def read(self) -> None:
+        """Read entries from the job queue into the local queue
 
-        The result is stored back into redis by the interaction id
+        Only as many entries are read as there is space for in the local queue, so
+        entries are not held back from other workers.
 
         :return: None
         """
-        async with self._wait_lock:
-            message = await channel.get_message(ignore_subscribe_messages=True)
+        last_claim = float("-inf")
+        last_depth = float("-inf")
+        while True:
+            count = min(WORKER_BATCH_SIZE, max(1, self._queue.room()))
+            if time.monotonic() - last_depth >= QUEUE_DEPTH_INTERVAL:
+                QUEUE_DEPTH.labels("stream").set(await self._job_queue.depth())
+                last_depth = time.monotonic()
+            if time.monotonic() - last_claim >= CLAIM_INTERVAL:
+                self._hold(
+                    await self._job_queue.claim_stale(
+                        int(WORKER_CLAIM_IDLE_TIME * 1000), count
+                    )
+                )
+                last_claim = time.monotonic()
+            if not self._unqueued:
+                self._hold(await self._job_queue.read(count, block=READ_BLOCK_TIME))
+            while self._unqueued:
+                # blocks while all consumers are busy
+                await self._queue.put(self._unqueued[0])
+                self._unqueued.popleft()
 
-        if message is None:
-            logger.debug("No message to process...")
-            return
+    def _hold(self, entries: list[QueueEntry]) -> None:
+        self._unqueued.extend(entries)
+        self._held.update(entry_id for entry_id, _ in entries)
+
+    async def keep_alive(self) -> None:
+        """Keep entries held by this worker from being claimed by other workers
+
+        Entries stay pending in the job queue while they wait to be run and while
+        they run, which can take longer than WORKER_CLAIM_IDLE_TIME. Their idle time
+        is reset well before then, as long as they are still pending on this worker.
+
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(WORKER_CLAIM_IDLE_TIME / KEEP_ALIVES_PER_CLAIM_TIME)
+            if not self._held:
+                continue
+            entry_ids = list(self._held)
+            try:
+                owned = set(await self._job_queue.keep_alive(entry_ids))
+            except redis.RedisError as e:
+                logger.error("Could not keep held entries alive: %s", e)
+                continue
+            for entry_id in entry_ids:
+                if entry_id not in owned and entry_id in self._held:
+                    logger.warning(
+                        "Entry %s is no longer pending on this worker", entry_id
+                    )
+                    self._held.discard(entry_id)
+
+    async def consume(self) -> None:
+        """Run entries from the local queue, one at a time
+
+        An entry that can not be finished, e.g. because its result or acknowledgement
+        could not be stored, is left pending to be claimed by another worker. The
+        consumer carries on with the next entry.
+
+        :return: None
+        """
+        while True:
+            entry = await self._queue.get()
+            try:
+                await self.run_entry(*entry)
+            except Exception:
+                logger.exception(
+                    "Could not finish entry %s, leaving it pending", entry[0]
+                )
+            finally:
+                # done with, or given up on. Either way, no longer kept alive.
+                self._held.discard(entry[0])
+                self._queue.task_done(entry)
+
+    async def drain(self) -> None:
+        """Requeue entries that were not started, and wait for running ones
+
+        Running entries that do not finish within WORKER_DRAIN_TIMEOUT seconds are
+        cancelled, and requeued.
+
+        :return: None
+        """
+        self._unqueued.extendleft(reversed(self._queue.take_waiting()))
+        for entry_id, message in self._unqueued:
+            await self._requeue(entry_id, message)
+        self._unqueued.clear()
 
         try:
-            deserialized_message = PubSubMessage.parse_raw(message["data"])
-        except pydantic.ValidationError as e:
-            logger.error(f"Could not parse message from pubsub due to: {e}")
+            await asyncio.wait_for(self._queue.join(), WORKER_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Running prompts did not finish in time, requeueing them")
+
+        tasks = list(self._running_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info("Worker stopped.")
+
+    async def _requeue(self, entry_id: str, message: PubSubMessage | None) -> None:
+        if message is None:
+            await self._job_queue.ack(entry_id)
+        else:
+            await self._job_queue.requeue(entry_id, message)
+        self._held.discard(entry_id)
+
+    async def run_entry(
+        self,
+        entry_id: str,
+        message: PubSubMessage | None,
+    ) -> None:
+        """Run a single stream entry, and acknowledge it afterwards.
+
+        Entries are acknowledged even if running them failed, so a broken prompt is
+        not retried indefinitely. An error is stored as the result instead, so the
+        bot can answer right away. Entries that are cancelled while the worker shuts
+        down are requeued instead. Entries of workers that die halfway remain
+        pending, to be claimed by another worker.
+
+        :return: None
+        """
+        interaction_id = message.interaction_id if message is not None else None
+        with log_fields(entry_id=entry_id, interaction_id=interaction_id):
+            try:
+                if message is not None:
+                    with (
+                        continue_trace(message.trace_context),
+                        IN_FLIGHT.track_inprogress(),
+                    ):
+                        # entry ids start with the time they were queued at
+                        with span("queued", start_time=entry_time(entry_id)):
+                            pass
+                        with span("run_prompt", entry_id=entry_id):
+                            await self.run_until_abandoned(message)
+            except asyncio.CancelledError:
+                # a failed requeue leaves the entry pending, to be claimed by another
+                # worker. Either way, the cancellation goes on.
+                try:
+                    await self._requeue(entry_id, message)
+                except redis.RedisError as e:
+                    logger.error("Could not requeue entry %s: %s", entry_id, e)
+                raise
+            except Exception as e:
+                logger.error(
+                    f"Running entry {entry_id} failed: {e} "
+                    f"\n \n {''.join(traceback.format_tb(e.__traceback__))}"
+                )
+                if message is not None:
+                    await store_results(
+                        self._redis_connection,
+                        message.interaction_id,
+                        [TextToImageResponse(finish_reason=FinishReason.ERROR, seed=0)],
+                        result_ttl(message),
+                    )
+            await self._job_queue.ack(entry_id)
+
+    async def run_until_abandoned(self, message: PubSubMessage) -> None:
+        """Run a message, unless the bot stopped waiting for its result
+
+        Messages past their deadline, or cancelled by the bot, are skipped. Running
+        messages are stopped once they pass their deadline or are cancelled, which
+        aborts their calls to the backend.
+
+        :param message: the message
+        :return: None
+        """
+        if message.expired():
+            logger.info("Skipping prompt, as it is past its deadline")
+            annotate(abandoned="expired")
+            ABANDONED_PROMPTS.labels("expired", "queued").inc()
             return
+        cancelled = await self._cancellations.watch(message.interaction_id)
+        try:
+            if cancelled.done():
+                logger.info("Skipping prompt, as it was cancelled")
+                annotate(abandoned="cancelled")
+                ABANDONED_PROMPTS.labels("cancelled", "queued").inc()
+                return
+            task = asyncio.create_task(self.run_message(message))
+            try:
+                await asyncio.wait(
+                    {task, cancelled},
+                    timeout=(
+                        None
+                        if message.deadline is None
+                        else max(0.0, message.deadline - time.time())
+                    ),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if task.done():
+                    # raises the exception of the message, if any
+                    task.result()
+                    return
+                reason = "cancelled" if cancelled.done() else "expired"
+                logger.info("Stopping prompt, as it was %s", reason)
+                annotate(abandoned=reason)
+                ABANDONED_PROMPTS.labels(reason, "running").inc()
+            finally:
+                if not task.done():
+                    task.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await task
+        finally:
+            self._cancellations.unwatch(message.interaction_id)
 
+    async def run_message(
+        self,
+        message: PubSubMessage,
+    ) -> None:
+        """Run text-to-image for a message.
+
+        Each image requested by the message is generated concurrently, and stored
+        back into redis by the interaction id as soon as it is available.
+
+        :return: None
+        """
+        start = time.monotonic()
         logger.info(
-            "Received message with for interaction "
-            f"{deserialized_message.interaction_id} with prompt: "
-            f"'{deserialized_message.text_prompt}'"
+            "Received message for interaction %s with prompt: '%s'",
+            message.interaction_id,
+            message.text_prompt,
         )
 
-        text_to_image_request = pubsub_to_t2i(deserialized_message)
+        # only prompts queued by older versions still need to be parsed
+        with span("parse_prompt"):
+            text_to_image_requests = message.requests or pubsub_to_t2i(message)
+        count = len(text_to_image_requests)
+        ttl = result_ttl(message)
+        await announce_started(
+            self._redis_connection, message.interaction_id, count, ttl
+        )
 
-        logger.info("Running text-to-image conversion")
-        responses = await text_to_image(session, text_to_image_request)
-        logger.info("Received response from text-to-image conversion")
-        serialized_responses = json.dumps(
-            responses, default=pydantic.json.pydantic_encoder
+        async def generate_and_store(
+            index: int, request: TextToImageRequestV2Core | TextToImageRequestV2SD3
+        ) -> None:
+            try:
+                with span("generate", index=index):
+                    response = await self.generate(request)
+            except Exception as e:
+                # a failing image should not fail the other images
+                logger.error("Generating image %d failed due to: %s", index, e)
+                response = TextToImageResponse(
+                    finish_reason=FinishReason.ERROR,
+                    seed=request.seed,
+                    output_format=request.output_format,
+                )
+            logger.info("Storing image %d/%d in redis.", index + 1, count)
+            with span("store_response", index=index):
+                await store_response(
+                    self._redis_connection,
+                    message.interaction_id,
+                    index,
+                    count,
+                    response,
+                    ttl,
+                )
+
+        await asyncio.gather(
+            *(generate_and_store(i, r) for i, r in enumerate(text_to_image_requests))
+        )
+        duration = time.monotonic() - start
+        logger.info(
+            "Stored result in redis after %.2f seconds.",
+            duration,
+            extra={"duration": duration, "images": count},
         )
 
-        logger.info("Storing result in redis.")
-        await self._redis_connection.set(
-            f"interaction:{deserialized_message.interaction_id}",
-            serialized_responses,
-            ex=REDIS_KEY_LIFETIME,
+    async def generate(
+        self,
+        request: TextToImageRequestV2Core | TextToImageRequestV2SD3,
+    ) -> TextToImageResponse:
+        """Generate a single image, or take it from the cache
+
+        Identical requests that are generated at the same time, by any worker, share
+        a single call to the backend.
+
+        :param request: the request
+        :return: the response
+        """
+        responses = await self._cache.get(request)
+        annotate(cached=responses is not None)
+        if responses is not None:
+            logger.info("Found result of an identical request in the cache")
+        else:
+
+            async def call() -> list[TextToImageResponse]:
+                with span("wait_for_backend"):
+                    await self._backend_slots.acquire()
+                try:
+                    logger.info("Running text-to-image conversion")
+                    with span("backend"):
+                        responses = await self._backend.text_to_image(request)
+                finally:
+                    self._backend_slots.release()
+                logger.info("Received response from text-to-image conversion")
+                with span("postprocess"):
+                    responses = [await self.postprocess(r) for r in responses]
+                await self._cache.put(request, responses)
+                return responses
+
+            responses = await self._single_flight.run(self._cache.digest(request), call)
+        # the v2 api generates one image per request
+        return responses[0]
+
+    async def postprocess(self, response: TextToImageResponse) -> TextToImageResponse:
+        """Convert, compress and make a thumbnail of a generated image, as configured
+
+        :param response: the response
+        :return: the response with the processed image
+        """
+        if response.image is None or not self._postprocess_settings.applies_to(
+            response.image, response.output_format
+        ):
+            return response
+        start = time.monotonic()
+        processed = await asyncio.get_running_loop().run_in_executor(
+            self._postprocess_pool,
+            postprocess_image,
+            response.image,
+            response.output_format,
+            self._postprocess_settings,
+        )
+        logger.info(
+            "Post-processed %s image of %d bytes to %s image of %d bytes in %.3f s",
+            response.output_format,
+            len(response.image),
+            processed.output_format,
+            len(processed.image),
+            time.monotonic() - start,
         )
-        logger.info("Stored result in redis.")
+        return response.model_copy(update=dataclasses.asdict(processed))
@@ -0,0 +1,201 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from droombot.api import (
+    RetryPolicy,
+    StabilityClient,
+    StabilityError,
+    parse_retry_after,
+)
+from droombot.models import (
+    FinishReason,
+    TextToImageRequestV2Core,
+    TextToImageRequestV2SD3,
+    TextToImageResponse,
+)
+
+
+def stability_app(received: list) -> web.Application:
+    """Local stand-in for api.stability.ai"""
+
+    async def generate(request: web.Request) -> web.Response:
+        fields = dict(await request.post())
+        received.append((request.path, request.headers, fields))
+        if fields["prompt"] == "fail":
+            return web.json_response({"errors": ["bad prompt"]}, status=400)
+        if fields["prompt"] == "flaky" and len(received) < 3:
+            if len(received) == 1:
+                return web.Response(status=503, text="<html>unavailable</html>")
+            return web.json_response(
+                {"errors": ["slow down"]}, status=429, headers={"Retry-After": "0"}
+            )
+        if fields["prompt"] == "huge":
+            return web.Response(
+                body=b"x" * 1000, headers={"finish-reason": "SUCCESS", "seed": "42"}
+            )
+        return web.Response(
+            body=b"image",
+            content_type="image/png",
+            headers={"finish-reason": "SUCCESS", "seed": "42"},
+        )
+
+    app = web.Application()
+    app.router.add_post("/v2beta/stable-image/generate/core", generate)
+    app.router.add_post("/v2beta/stable-image/generate/sd3", generate)
+    return app
+
+
+class FakeRateLimiter:
+    def __init__(self):
+        self.acquired = 0
+        self.penalties: list = []
+
+    async def acquire(self):
+        self.acquired += 1
+
+    async def penalize(self, retry_after=None):
+        self.penalties.append(retry_after)
+
+
+def run_with_client(scenario, received: list, rate_limiter=None):
+    async def main():
+        async with TestServer(stability_app(received)) as server:
+            base_url = str(server.make_url(""))
+            async with StabilityClient(
+                api_key="key",
+                base_url=base_url,
+                retry_policy=RetryPolicy(max_attempts=3, base_delay=0.01),
+                rate_limiter=rate_limiter,
+                max_image_bytes=100,
+            ) as client:
+                await scenario(client)
+
+    asyncio.run(main())
+
+
+def test_text_to_image():
+    received: list = []
+
+    async def scenario(client):
+        responses = await client.text_to_image(
+            TextToImageRequestV2SD3(prompt="foo", model="sd3-turbo")
+        )
+        assert responses == [
+            TextToImageResponse(
+                image=b"image", finish_reason=FinishReason.SUCCESS, seed=42
+            )
+        ]
+        # the image is kept in the buffer it was read into, not copied
+        assert isinstance(responses[0].image, bytearray)
+
+    run_with_client(scenario, received)
+
+    path, headers, fields = received[0]
+    assert path == "/v2beta/stable-image/generate/sd3"
+    assert headers["Authorization"] == "Bearer key"
+    assert headers["accept"] == "image/*"
+    assert fields["prompt"] == "foo"
+    assert fields["model"] == "sd3-turbo"
+    # unset options are not sent
+    assert "negative_prompt" not in fields
+
+
+def test_text_to_image_reuses_connections():
+    received: list = []
+
+    async def scenario(client):
+        for _ in range(3):
+            await client.text_to_image(TextToImageRequestV2Core(prompt="foo"))
+        assert client.stats.created == 1
+        assert client.stats.reused == 2
+
+    run_with_client(scenario, received)
+    assert len(received) == 3
+
+
+def test_text_to_image_error():
+    received: list = []
+
+    async def scenario(client):
+        with pytest.raises(StabilityError) as e:
+            await client.text_to_image(TextToImageRequestV2Core(prompt="fail"))
+        assert e.value.status == 400
+        assert not e.value.retryable
+
+    run_with_client(scenario, received)
+    # client errors are not retried
+    assert len(received) == 1
+
+
+def test_text_to_image_too_large():
+    received: list = []
+
+    async def scenario(client):
+        with pytest.raises(StabilityError) as e:
+            await client.text_to_image(TextToImageRequestV2Core(prompt="huge"))
+        assert not e.value.retryable
+
+    run_with_client(scenario, received)
+    assert len(received) == 1
+
+
+def test_text_to_image_past_deadline():
+    received: list = []
+
+    async def scenario(client):
+        client.retry_policy = RetryPolicy(deadline=0)
+        with pytest.raises(StabilityError) as e:
+            await client.text_to_image(TextToImageRequestV2Core(prompt="foo"))
+        assert not e.value.retryable
+
+    run_with_client(scenario, received)
+    # no attempt is made without time left
+    assert len(received) == 0
+
+
+def test_text_to_image_retries():
+    received: list = []
+
+    async def scenario(client):
+        responses = await client.text_to_image(TextToImageRequestV2Core(prompt="flaky"))
+        assert responses[0].finish_reason is FinishReason.SUCCESS
+
+    run_with_client(scenario, received)
+    assert len(received) == 3
+
+
+def test_text_to_image_rate_limited():
+    received: list = []
+    rate_limiter = FakeRateLimiter()
+
+    async def scenario(client):
+        await client.text_to_image(TextToImageRequestV2Core(prompt="flaky"))
+
+    run_with_client(scenario, received, rate_limiter)
+    # every attempt waits for the limiter, and only the 429 slows it down
+    assert rate_limiter.acquired == 3
+    assert rate_limiter.penalties == [0]
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, None),
+        ("5", 5),
+        ("-1", 0),
+        ("Wed, 21 Oct 2015 07:28:00 GMT", 0),
+        ("soon", None),
+    ],
+)
+def test_parse_retry_after(value, expected):
+    assert parse_retry_after(value) == expected
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(base_delay=1, max_delay=10)
+    assert 0 <= policy.delay(1) <= 1
+    assert 0 <= policy.delay(3) <= 4
+    assert 0 <= policy.delay(10) <= 10
+    assert 5 <= policy.delay(1, retry_after=5) <= 6
@@ -0,0 +1,122 @@
+import asyncio
+
+import fakeredis.aioredis
+from droombot.cache import ResultCache, request_digest
+from droombot.models import (
+    FinishReason,
+    TextToImageRequestV2Core,
+    TextToImageRequestV2SD3,
+    TextToImageResponse,
+)
+from droombot.postprocess import PostprocessSettings
+from droombot.results import encode_responses
+
+SUCCESS = [
+    TextToImageResponse(image=b"foo", finish_reason=FinishReason.SUCCESS, seed=0)
+]
+
+
+def test_request_digest():
+    core = TextToImageRequestV2Core(prompt="foo")
+    assert request_digest(core) == request_digest(
+        TextToImageRequestV2Core(prompt="foo")
+    )
+    assert request_digest(core) != request_digest(TextToImageRequestV2SD3(prompt="foo"))
+    assert request_digest(core) != request_digest(
+        TextToImageRequestV2Core(prompt="foo", seed=1)
+    )
+
+
+def test_cache_hit_and_miss():
+    async def scenario():
+        cache = ResultCache(fakeredis.aioredis.FakeRedis(), ttl=60, max_bytes=10_000)
+        request = TextToImageRequestV2Core(prompt="foo")
+
+        assert await cache.get(request) is None
+        await cache.put(request, SUCCESS)
+        assert await cache.get(request) == SUCCESS
+
+        stats = await cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["entries"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cache_skips_failures():
+    async def scenario():
+        cache = ResultCache(fakeredis.aioredis.FakeRedis(), ttl=60, max_bytes=10_000)
+        request = TextToImageRequestV2Core(prompt="foo")
+        failed = [
+            TextToImageResponse(image=None, finish_reason=FinishReason.ERROR, seed=0)
+        ]
+        await cache.put(request, failed)
+        assert await cache.get(request) is None
+
+    asyncio.run(scenario())
+
+
+def test_cache_evicts_least_recently_used():
+    async def scenario():
+        requests = [TextToImageRequestV2Core(prompt=str(i)) for i in range(3)]
+        # size of one entry
+        size = sum(len(k) + len(v) for k, v in encode_responses(SUCCESS).items())
+        cache = ResultCache(fakeredis.aioredis.FakeRedis(), ttl=60, max_bytes=2 * size)
+        await cache.put(requests[0], SUCCESS)
+        await cache.put(requests[1], SUCCESS)
+        # make the first entry the most recently used one
+        assert await cache.get(requests[0]) == SUCCESS
+        await cache.put(requests[2], SUCCESS)
+
+        assert await cache.get(requests[0]) == SUCCESS
+        assert await cache.get(requests[1]) is None
+        assert await cache.get(requests[2]) == SUCCESS
+        assert (await cache.stats())["bytes"] == 2 * size
+
+    asyncio.run(scenario())
+
+
+def test_disabled_cache():
+    async def scenario():
+        cache = ResultCache(fakeredis.aioredis.FakeRedis(), ttl=0)
+        request = TextToImageRequestV2Core(prompt="foo")
+        await cache.put(request, SUCCESS)
+        assert await cache.get(request) is None
+
+    asyncio.run(scenario())
+
+
+def test_cache_hit_refreshes_ttl():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        cache = ResultCache(connection, ttl=60, max_bytes=10_000)
+        request = TextToImageRequestV2Core(prompt="foo")
+        await cache.put(request, SUCCESS)
+        key = cache._entry_key(request)
+        await connection.expire(key, 10)
+
+        assert await cache.get(request) == SUCCESS
+        assert await connection.ttl(key) > 10
+
+    asyncio.run(scenario())
+
+
+def test_cache_keyed_on_postprocess_settings():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        request = TextToImageRequestV2Core(prompt="foo")
+        png = ResultCache(connection, ttl=60, max_bytes=10_000)
+        webp = ResultCache(
+            connection,
+            ttl=60,
+            max_bytes=10_000,
+            postprocess_settings=PostprocessSettings(output_format="webp"),
+        )
+        await png.put(request, SUCCESS)
+
+        assert await webp.get(request) is None
+        assert await png.get(request) == SUCCESS
+        assert png.digest(request) != webp.digest(request)
+
+    asyncio.run(scenario())
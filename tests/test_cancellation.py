@@ -0,0 +1,30 @@
+import asyncio
+
+import fakeredis.aioredis
+from droombot.cancellation import CancellationListener, cancel
+
+
+def test_listener_sees_cancellations():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        bot_connection = fakeredis.aioredis.FakeRedis(server=server)
+        worker_connection = fakeredis.aioredis.FakeRedis(server=server)
+        listener = CancellationListener(worker_connection)
+
+        # cancelled before it was watched
+        await cancel(bot_connection, "1", ttl=10)
+        assert (await listener.watch("1")).done()
+
+        cancelled = await listener.watch("2")
+        other = await listener.watch("3")
+        assert not cancelled.done()
+        await cancel(bot_connection, "2", ttl=10)
+        await asyncio.wait_for(cancelled, 5)
+        assert not other.done()
+        assert 0 < await bot_connection.ttl("droombot-cancelled:2") <= 10
+
+        for interaction_id in ("1", "2", "3"):
+            listener.unwatch(interaction_id)
+        await listener.stop()
+
+    asyncio.run(scenario())
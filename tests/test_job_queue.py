@@ -0,0 +1,190 @@
+import asyncio
+
+import fakeredis.aioredis
+import msgpack
+from droombot.job_queue import JobQueue, decode_job, encode_job
+from droombot.models import PubSubMessage, parse_prompt
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_enqueue_read_ack():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection, consumer="worker-1")
+        await queue.ensure_group()
+        # creating the group twice is fine
+        await queue.ensure_group()
+
+        message = PubSubMessage(interaction_id="1", text_prompt="foo bar")
+        entry_id = await queue.enqueue(message)
+
+        entries = await queue.read(10)
+        assert entries == [(entry_id, message)]
+        # nothing new to read
+        assert await queue.read(10) == []
+
+        await queue.ack(entry_id)
+        assert (await connection.xpending(queue.stream, queue.group))["pending"] == 0
+
+    run(scenario())
+
+
+def test_entries_delivered_once_per_group():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        first = JobQueue(connection, consumer="worker-1")
+        second = JobQueue(connection, consumer="worker-2")
+        await first.ensure_group()
+
+        for i in range(4):
+            await first.enqueue(PubSubMessage(interaction_id=str(i), text_prompt="x"))
+
+        first_entries = await first.read(2)
+        second_entries = await second.read(10)
+        assert len(first_entries) == 2
+        assert len(second_entries) == 2
+        assert {e[0] for e in first_entries}.isdisjoint({e[0] for e in second_entries})
+
+    run(scenario())
+
+
+def test_claim_stale():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        dead = JobQueue(connection, consumer="dead-worker")
+        alive = JobQueue(connection, consumer="alive-worker")
+        await dead.ensure_group()
+
+        message = PubSubMessage(interaction_id="1", text_prompt="foo")
+        entry_id = await dead.enqueue(message)
+        await dead.read(10)
+
+        assert await alive.claim_stale(min_idle_time=60_000, count=10) == []
+        assert await alive.claim_stale(min_idle_time=0, count=10) == [
+            (entry_id, message)
+        ]
+
+    run(scenario())
+
+
+def test_keep_alive_only_owned_entries():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        slow = JobQueue(connection, consumer="slow-worker")
+        other = JobQueue(connection, consumer="other-worker")
+        await slow.ensure_group()
+        for i in range(3):
+            await slow.enqueue(PubSubMessage(interaction_id=str(i), text_prompt="x"))
+        entry_ids = [entry_id for entry_id, _ in await slow.read(10)]
+        await asyncio.sleep(0.1)
+
+        claimed = await other.claim_stale(min_idle_time=50, count=1)
+        await slow.ack(entry_ids[2])
+        # entries claimed by another worker, or acknowledged, are left alone
+        assert await slow.keep_alive(entry_ids) == [entry_ids[1]]
+        pending = await connection.xpending_range(slow.stream, slow.group, "-", "+", 10)
+        assert {p["message_id"].decode(): p["consumer"] for p in pending} == {
+            claimed[0][0]: b"other-worker",
+            entry_ids[1]: b"slow-worker",
+        }
+        assert await other.claim_stale(min_idle_time=50, count=10) == []
+
+    run(scenario())
+
+
+def test_unparseable_entry():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection)
+        await queue.ensure_group()
+        entry_id = await connection.xadd(queue.stream, {"message": "not json"})
+
+        assert await queue.read(10) == [(entry_id.decode(), None)]
+
+    run(scenario())
+
+
+def test_depth():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection, consumer="worker-1")
+        await queue.ensure_group()
+        for i in range(3):
+            await queue.enqueue(PubSubMessage(interaction_id=str(i), text_prompt="a"))
+        assert await queue.depth() == 3
+
+        # read entries are still waiting to be run, until acknowledged
+        (entry_id, _), *_ = await queue.read(2)
+        assert await queue.depth() == 3
+        await queue.ack(entry_id)
+        assert await queue.depth() == 2
+
+    run(scenario())
+
+
+def test_position():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection, consumer="worker-1")
+        await queue.ensure_group()
+        entry_ids = [
+            await queue.enqueue(PubSubMessage(interaction_id=str(i), text_prompt="a"))
+            for i in range(4)
+        ]
+        assert await queue.position(entry_ids[0]) == 0
+        assert await queue.position(entry_ids[3]) == 3
+        assert await queue.position(entry_ids[3], limit=2) == 2
+
+        # entries read by a worker are no longer queued
+        await queue.read(2)
+        assert await queue.position(entry_ids[1]) is None
+        assert await queue.position(entry_ids[3]) == 1
+
+    run(scenario())
+
+
+def test_encode_decode_job():
+    message = PubSubMessage(
+        interaction_id="1",
+        text_prompt="foo -n 2 -m sd3-turbo",
+        guild_id="2",
+        user_id="3",
+        requests=[
+            *parse_prompt("foo -n 2 -m sd3-turbo"),
+            *parse_prompt("bar -a 16:9 -p anime"),
+        ],
+        deadline=1_700_000_000.5,
+    )
+    assert decode_job(encode_job(message)) == message
+
+
+def test_read_legacy_and_invalid_entries():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection, consumer="worker-1")
+        await queue.ensure_group()
+        message = PubSubMessage(interaction_id="1", text_prompt="foo")
+        legacy_id = await connection.xadd(
+            queue.stream, {"message": message.model_dump_json()}
+        )
+        future_id = await connection.xadd(
+            queue.stream, {"version": 1000, "job": encode_job(message)}
+        )
+        broken_id = await connection.xadd(queue.stream, {"version": 1, "job": b"foo"})
+        # valid msgpack, but not a job
+        not_a_job_ids = [
+            await connection.xadd(queue.stream, {"version": 1, "job": msgpack.packb(v)})
+            for v in (5, "x", None)
+        ]
+
+        assert await queue.read(10) == [
+            (legacy_id.decode(), message),
+            (future_id.decode(), None),
+            (broken_id.decode(), None),
+            *((entry_id.decode(), None) for entry_id in not_a_job_ids),
+        ]
+
+    run(scenario())
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from droombot.local import (
+    BatchItem,
+    BatchKey,
+    Batcher,
+    LocalDiffusionBackend,
+    image_size,
+)
+from droombot.models import (
+    FinishReason,
+    TextToImageRequestV2Core,
+    TextToImageRequestV2SD3,
+)
+
+
+def test_batches_by_key():
+    batches = []
+
+    async def run_batch(key, items):
+        batches.append((key, items))
+        return [f"{key}{item}" for item in items]
+
+    async def scenario():
+        batcher = Batcher(run_batch, max_batch_size=2, window=0.05)
+        results = await asyncio.gather(
+            batcher.submit("a", 1),
+            batcher.submit("b", 2),
+            batcher.submit("a", 3),
+            batcher.submit("a", 4),
+        )
+        assert results == ["a1", "b2", "a3", "a4"]
+
+    asyncio.run(scenario())
+    # full batches run right away, others after the window
+    assert batches == [("a", [1, 3]), ("b", [2]), ("a", [4])]
+
+
+def test_batch_failure_fails_all_items():
+    async def run_batch(key, items):
+        raise ValueError("An error occurred")
+
+    async def scenario():
+        batcher = Batcher(run_batch, max_batch_size=2, window=0.05)
+        results = await asyncio.gather(
+            batcher.submit("a", 1), batcher.submit("a", 2), return_exceptions=True
+        )
+        assert all(isinstance(r, ValueError) for r in results)
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize(
+    "aspect_ratio, expected",
+    [("1:1", (512, 512)), ("16:9", (704, 384)), ("2:3", (448, 640))],
+)
+def test_image_size(aspect_ratio, expected):
+    assert image_size(aspect_ratio, 512) == expected
+
+
+class FakeLocalDiffusionBackend(LocalDiffusionBackend):
+    """Local backend without a model"""
+
+    async def _run_batch(self, key: BatchKey, items: list[BatchItem]):
+        return [None if "filtered" in i.prompt else b"image" for i in items]
+
+
+def test_text_to_image():
+    async def scenario():
+        backend = FakeLocalDiffusionBackend(batch_window=0.01)
+        (response,) = await backend.text_to_image(
+            TextToImageRequestV2SD3(prompt="foo", seed=3, output_format="jpeg")
+        )
+        assert response.image == b"image"
+        assert response.seed == 3
+        assert response.output_format == "jpeg"
+
+        (response,) = await backend.text_to_image(
+            TextToImageRequestV2Core(prompt="filtered")
+        )
+        assert response.finish_reason is FinishReason.CONTENT_FILTERED
+        # a seed is picked if none was given
+        assert response.seed > 0
+
+    asyncio.run(scenario())
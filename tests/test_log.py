@@ -0,0 +1,50 @@
+import json
+import logging
+
+from droombot.log import (
+    ContextFilter,
+    DeferredQueueHandler,
+    JsonFormatter,
+    log_fields,
+    parse_log_levels,
+)
+
+
+def test_json_format_with_context():
+    records: list[logging.LogRecord] = []
+    handler = DeferredQueueHandler(_ListQueue(records))
+    handler.addFilter(ContextFilter())
+    test_logger = logging.getLogger("droombot.test_log")
+    test_logger.addHandler(handler)
+    test_logger.setLevel(logging.INFO)
+    try:
+        with log_fields(interaction_id="1"):
+            test_logger.info("took %.1f seconds", 1.25, extra={"duration": 1.25})
+        test_logger.info("outside")
+    finally:
+        test_logger.removeHandler(handler)
+
+    first = json.loads(JsonFormatter().format(records[0]))
+    assert first["message"] == "took 1.2 seconds"
+    assert first["interaction_id"] == "1"
+    assert first["duration"] == 1.25
+    assert first["logger"] == "droombot.test_log"
+    assert "interaction_id" not in json.loads(JsonFormatter().format(records[1]))
+
+
+def test_parse_log_levels():
+    assert parse_log_levels("") == {}
+    assert parse_log_levels("droombot.worker:debug, discord:INFO") == {
+        "droombot.worker": "DEBUG",
+        "discord": "INFO",
+    }
+
+
+class _ListQueue:
+    """Stand-in for a queue, collecting records in a list"""
+
+    def __init__(self, records: list):
+        self.records = records
+
+    def put_nowait(self, record):
+        self.records.append(record)
@@ -0,0 +1,49 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+from droombot.metrics import _NoopMetric
+from droombot.models import FinishReason, TextToImageResponse
+from droombot.results import store_results
+
+
+prometheus_client = pytest.importorskip("prometheus_client")
+
+
+def sample(name: str, labels: dict | None = None) -> float:
+    return prometheus_client.REGISTRY.get_sample_value(name, labels or {}) or 0
+
+
+def test_store_results_is_measured():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        await store_results(
+            connection,
+            "1",
+            [
+                TextToImageResponse(
+                    image=b"foo", finish_reason=FinishReason.SUCCESS, seed=0
+                )
+            ],
+            ttl=10,
+        )
+
+    stored = sample("droombot_result_size_bytes_count")
+    timed = sample(
+        "droombot_redis_latency_seconds_count", {"operation": "store_result"}
+    )
+    asyncio.run(scenario())
+    assert sample("droombot_result_size_bytes_count") == stored + 1
+    assert (
+        sample("droombot_redis_latency_seconds_count", {"operation": "store_result"})
+        == timed + 1
+    )
+
+
+def test_noop_metric():
+    metric = _NoopMetric()
+    metric.labels("foo").observe(1)
+    with metric.labels(operation="foo").time():
+        pass
+    with metric.track_inprogress():
+        pass
@@ -1,11 +1,17 @@
 import pydantic
 import pytest
+from droombot.config import MAX_IMAGES_PER_PROMPT
 from droombot.models import (
+    SEED_MAX,
+    OptionError,
+    PromptError,
     PubSubMessage,
     TextToImageRequestV2Core,
     TextToImageRequestV2SD3,
     TextToImageResponse,
+    parse_prompt,
     pubsub_to_t2i,
+    with_distinct_seeds,
 )
 
 
@@ -17,32 +23,114 @@ def test_generation_text_prompts_not_defined():
 
 
 def test_response_from_raw_api():
-    example_response = {"image": "foo", "finish_reason": "SUCCESS", "seed": 0}
-    assert TextToImageResponse.from_raw_api(example_response) == TextToImageResponse(
-        base64="foo", finish_reason="SUCCESS", seed=0
+    headers = {"finish-reason": "SUCCESS", "seed": "3"}
+    assert TextToImageResponse.from_raw_api(
+        headers, b"foo", "jpeg"
+    ) == TextToImageResponse(
+        image=b"foo", finish_reason="SUCCESS", seed=3, output_format="jpeg"
     )
+    # the blurred image of a filtered prompt is dropped
+    headers = {"finish-reason": "CONTENT_FILTERED", "seed": "3"}
+    assert TextToImageResponse.from_raw_api(headers, b"blurred").image is None
 
 
 PUBSUB_TO_T2I_DATA = [
     (
         PubSubMessage(interaction_id="0", text_prompt="foo bar"),
-        TextToImageRequestV2Core(prompt="foo bar"),
+        [TextToImageRequestV2Core(prompt="foo bar")],
     ),
     (
         PubSubMessage(interaction_id="0", text_prompt="foo bar -m sd3"),
-        TextToImageRequestV2SD3(prompt="foo bar"),
+        [TextToImageRequestV2SD3(prompt="foo bar")],
     ),
     (
         PubSubMessage(interaction_id="0", text_prompt="foo bar -m sd3-turbo"),
-        TextToImageRequestV2SD3(prompt="foo bar", model="sd3-turbo"),
+        [TextToImageRequestV2SD3(prompt="foo bar", model="sd3-turbo")],
     ),
     (
         PubSubMessage(interaction_id="0", text_prompt="foo bar --model sd3"),
-        TextToImageRequestV2SD3(prompt="foo bar"),
+        [TextToImageRequestV2SD3(prompt="foo bar")],
+    ),
+    (
+        PubSubMessage(interaction_id="0", text_prompt="sci-fi city --model=sd3"),
+        [TextToImageRequestV2SD3(prompt="sci-fi city")],
+    ),
+    (
+        PubSubMessage(
+            interaction_id="0",
+            text_prompt='foo -a 16:9 --negative "blurry, dark" -s 5 -p anime -f webp',
+        ),
+        [
+            TextToImageRequestV2Core(
+                prompt="foo",
+                aspect_ratio="16:9",
+                negative_prompt="blurry, dark",
+                seed=5,
+                style_preset="anime",
+                output_format="webp",
+            )
+        ],
     ),
 ]
 
 
-@pytest.mark.parametrize("message, t2i_request", PUBSUB_TO_T2I_DATA)
-def test_request_from_pubsub(message, t2i_request):
-    assert pubsub_to_t2i(message) == t2i_request
+@pytest.mark.parametrize("message, t2i_requests", PUBSUB_TO_T2I_DATA)
+def test_request_from_pubsub(message, t2i_requests):
+    assert pubsub_to_t2i(message) == t2i_requests
+
+
+@pytest.mark.parametrize("option", ["-n 3", "--count 3"])
+def test_request_from_pubsub_count(option):
+    message = PubSubMessage(interaction_id="0", text_prompt=f"foo bar -m sd3 {option}")
+    t2i_requests = pubsub_to_t2i(message)
+    assert len(t2i_requests) == 3
+    assert len({r.seed for r in t2i_requests}) == 3
+    assert all(r.seed != 0 for r in t2i_requests)
+    assert all(
+        r.model_copy(update={"seed": 0}) == TextToImageRequestV2SD3(prompt="foo bar")
+        for r in t2i_requests
+    )
+
+
+@pytest.mark.parametrize("count", [0, MAX_IMAGES_PER_PROMPT + 1])
+def test_request_from_pubsub_count_bounded(count):
+    message = PubSubMessage(interaction_id="0", text_prompt=f"foo -n {count}")
+    with pytest.raises(PromptError) as e:
+        pubsub_to_t2i(message)
+    assert e.value.errors == [
+        OptionError(
+            "--count", str(count), f"must be between 1 and {MAX_IMAGES_PER_PROMPT}"
+        )
+    ]
+
+
+def test_with_distinct_seeds():
+    request = TextToImageRequestV2Core(prompt="foo", seed=SEED_MAX - 1)
+    assert [r.seed for r in with_distinct_seeds(request, 3)] == [
+        SEED_MAX - 1,
+        SEED_MAX,
+        1,
+    ]
+    assert with_distinct_seeds(request, 1) == [request]
+
+
+def test_parse_prompt_errors():
+    with pytest.raises(PromptError) as e:
+        parse_prompt("foo -x 1 -m sd3 -p anime -a 5:4 -s many -n")
+    assert e.value.errors == [
+        OptionError("-x", "1", "unknown option"),
+        OptionError(
+            "-a", "5:4", "must be one of 16:9, 1:1, 21:9, 2:3, 3:2, 4:5, 9:16, 9:21"
+        ),
+        OptionError("-s", "many", "must be a whole number"),
+        OptionError("-n", None, "missing value"),
+        OptionError("--style-preset", "anime", "not supported by sd3"),
+    ]
+
+
+def test_parse_prompt_validation_errors():
+    with pytest.raises(PromptError) as e:
+        parse_prompt(f"foo -s {SEED_MAX + 1}")
+    [error] = e.value.errors
+    assert error.option == "--seed"
+    assert error.value == str(SEED_MAX + 1)
@@ -0,0 +1,48 @@
+import io
+
+from droombot.postprocess import PostprocessSettings, postprocess_image
+from PIL import Image
+
+
+def noise_png(size: int) -> bytes:
+    image = Image.effect_noise((size, size), 64).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="png")
+    return buffer.getvalue()
+
+
+def test_untouched_without_settings():
+    image = noise_png(64)
+    processed = postprocess_image(image, "png", PostprocessSettings())
+    assert processed.image is image
+    assert processed.output_format == "png"
+    assert processed.thumbnail is None
+
+
+def test_transcode():
+    processed = postprocess_image(
+        noise_png(64), "png", PostprocessSettings(output_format="jpeg")
+    )
+    assert processed.output_format == "jpeg"
+    assert Image.open(io.BytesIO(processed.image)).format == "JPEG"
+
+
+def test_fits_byte_budget():
+    image = noise_png(1024)
+    processed = postprocess_image(image, "png", PostprocessSettings(max_bytes=50_000))
+    assert len(processed.image) <= 50_000
+    # png can not be compressed enough, so it is converted to webp
+    assert processed.output_format == "webp"
+    decoded = Image.open(io.BytesIO(processed.image))
+    assert decoded.format == "WEBP"
+    assert decoded.size[0] < 1024
+
+
+def test_thumbnail():
+    processed = postprocess_image(
+        noise_png(512), "png", PostprocessSettings(thumbnail_size=128)
+    )
+    assert processed.output_format == "png"
+    thumbnail = Image.open(io.BytesIO(processed.thumbnail))
+    assert thumbnail.format == "WEBP"
+    assert thumbnail.size == (128, 128)
@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import fakeredis.aioredis
+from droombot.ratelimit import RedisTokenBucket
+
+
+async def timed_acquires(bucket: RedisTokenBucket, count: int) -> float:
+    start = time.monotonic()
+    for _ in range(count):
+        await bucket.acquire()
+    return time.monotonic() - start
+
+
+def test_acquire_within_burst():
+    async def scenario():
+        bucket = RedisTokenBucket(
+            fakeredis.aioredis.FakeRedis(), "test", requests_per_minute=60, burst=3
+        )
+        assert await timed_acquires(bucket, 3) < 0.5
+
+    asyncio.run(scenario())
+
+
+def test_acquire_waits_for_tokens():
+    async def scenario():
+        # 10 per second
+        bucket = RedisTokenBucket(
+            fakeredis.aioredis.FakeRedis(), "test", requests_per_minute=600, burst=1
+        )
+        assert await timed_acquires(bucket, 4) >= 0.25
+
+    asyncio.run(scenario())
+
+
+def test_bucket_is_shared():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        buckets = [
+            RedisTokenBucket(
+                fakeredis.aioredis.FakeRedis(server=server),
+                "test",
+                requests_per_minute=600,
+                burst=2,
+            )
+            for _ in range(2)
+        ]
+        await timed_acquires(buckets[0], 2)
+        # the burst was used up by the other bucket
+        assert await timed_acquires(buckets[1], 1) >= 0.05
+
+    asyncio.run(scenario())
+
+
+def test_penalize():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        bucket = RedisTokenBucket(
+            connection, "test", requests_per_minute=6000, min_fraction=0.25
+        )
+        await bucket.penalize(retry_after=0.2)
+        assert float(await connection.hget(bucket.key, "rate")) == 50
+        assert await timed_acquires(bucket, 1) >= 0.2
+
+        # the rate is never lowered below the minimum
+        for _ in range(3):
+            await bucket.penalize()
+        assert float(await connection.hget(bucket.key, "rate")) == 25
+
+    asyncio.run(scenario())
+
+
+def test_rate_recovers():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        bucket = RedisTokenBucket(
+            connection, "test", requests_per_minute=6000, recovery_time=0.1
+        )
+        await bucket.penalize()
+        await asyncio.sleep(0.2)
+        await bucket.acquire()
+        assert float(await connection.hget(bucket.key, "rate")) == 100
+
+    asyncio.run(scenario())
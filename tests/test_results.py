@@ -0,0 +1,146 @@
+import asyncio
+
+import fakeredis.aioredis
+from droombot.models import FinishReason, TextToImageResponse
+from droombot.results import (
+    ResultListener,
+    announce_started,
+    delete_results,
+    fetch_progress,
+    fetch_results,
+    store_response,
+    store_results,
+)
+
+RESPONSES = [
+    TextToImageResponse(image=b"foo", finish_reason=FinishReason.SUCCESS, seed=1)
+]
+
+
+def test_store_and_fetch_results():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        assert await fetch_results(connection, "1") is None
+        await store_results(connection, "1", RESPONSES, ttl=10)
+        assert await fetch_results(connection, "1") == RESPONSES
+        assert 0 < await connection.ttl("interaction:1") <= 10
+        # the image is stored as raw bytes, next to the metadata
+        assert await connection.hget("interaction:1", "image:0") == b"foo"
+        await delete_results(connection, "1")
+        assert await fetch_results(connection, "1") is None
+
+        # images read from the api are bytearrays
+        read = [
+            TextToImageResponse(
+                image=bytearray(b"foo"), finish_reason=FinishReason.SUCCESS, seed=1
+            )
+        ]
+        await store_results(connection, "1", read, ttl=10)
+        assert await fetch_results(connection, "1") == RESPONSES
+
+    asyncio.run(scenario())
+
+
+def test_listener_wakes_up_on_announcement():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        bot_connection = fakeredis.aioredis.FakeRedis(server=server)
+        worker_connection = fakeredis.aioredis.FakeRedis(server=server)
+        listener = ResultListener(bot_connection)
+
+        await listener.register("1")
+        await listener.register("2")
+        waiter = asyncio.create_task(listener.next_update("1", timeout=5))
+        await asyncio.sleep(0)
+        await store_results(worker_connection, "1", RESPONSES, ttl=10)
+
+        assert await waiter
+        assert await fetch_results(bot_connection, "1") == RESPONSES
+        assert not await listener.next_update("2", timeout=0.1)
+        await listener.stop()
+
+    asyncio.run(scenario())
+
+
+def test_thumbnails_are_stored():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        responses = [
+            TextToImageResponse(
+                image=b"foo",
+                finish_reason=FinishReason.SUCCESS,
+                seed=1,
+                output_format="webp",
+                thumbnail=b"bar",
+            )
+        ]
+        await store_results(connection, "1", responses, ttl=10)
+        assert await connection.hget("interaction:1", "thumbnail:0") == b"bar"
+        (fetched,) = await fetch_results(connection, "1")
+        assert fetched.thumbnail == b"bar"
+
+    asyncio.run(scenario())
+
+
+def test_progress():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        progress = await fetch_progress(connection, "1")
+        assert not progress.started
+        assert not progress.complete
+
+        await announce_started(connection, "1", 2, ttl=10)
+        progress = await fetch_progress(connection, "1")
+        assert progress.started
+        assert progress.count == 2
+        assert progress.responses == {}
+
+        await store_response(connection, "1", 1, 2, RESPONSES[0], ttl=10)
+        progress = await fetch_progress(connection, "1")
+        assert progress.responses == {1: RESPONSES[0]}
+        assert not progress.complete
+
+        await store_response(connection, "1", 0, 2, RESPONSES[0], ttl=10)
+        assert (await fetch_progress(connection, "1")).complete
+
+    asyncio.run(scenario())
+
+
+def test_progress_fetches_only_new_responses():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        await announce_started(connection, "1", 2, ttl=10)
+        await store_response(connection, "1", 1, 2, RESPONSES[0], ttl=10)
+        known = await fetch_progress(connection, "1")
+
+        await store_response(connection, "1", 0, 2, RESPONSES[0], ttl=10)
+        # responses that were fetched before are not fetched again
+        await connection.hdel("interaction:1", "image:1")
+        progress = await fetch_progress(connection, "1", known)
+        assert progress.complete
+        assert progress.responses[1].image == RESPONSES[0].image
+        assert progress.responses[0] == RESPONSES[0]
+        assert known.responses.keys() == {1}
+
+    asyncio.run(scenario())
+
+
+def test_listener_follows_updates():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        bot_connection = fakeredis.aioredis.FakeRedis(server=server)
+        worker_connection = fakeredis.aioredis.FakeRedis(server=server)
+        listener = ResultListener(bot_connection)
+
+        await listener.register("1")
+        assert not await listener.next_update("1", timeout=0.1)
+        await announce_started(worker_connection, "1", 1, ttl=10)
+        assert await listener.next_update("1", timeout=5)
+        # every announcement is seen once
+        assert not await listener.next_update("1", timeout=0.1)
+        await store_response(worker_connection, "1", 0, 1, RESPONSES[0], ttl=10)
+        assert await listener.next_update("1", timeout=5)
+        listener.unregister("1")
+        await listener.stop()
+
+    asyncio.run(scenario())
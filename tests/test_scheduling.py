@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+from droombot.models import PubSubMessage
+from droombot.scheduling import FairQueue, parse_guild_weights
+
+
+def entry(entry_id: str, guild_id: str, user_id: str):
+    return entry_id, PubSubMessage(
+        interaction_id=entry_id, text_prompt="foo", guild_id=guild_id, user_id=user_id
+    )
+
+
+async def take(queue: FairQueue, count: int) -> list[str]:
+    taken = []
+    for _ in range(count):
+        entry = await asyncio.wait_for(queue.get(), 1)
+        queue.task_done(entry)
+        taken.append(entry[0])
+    return taken
+
+
+def test_users_take_turns():
+    async def scenario():
+        queue = FairQueue(maxsize=10, max_held=10)
+        for i in range(4):
+            await queue.put(entry(f"a{i}", "guild", "a"))
+        await queue.put(entry("b0", "guild", "b"))
+        # b does not wait for the backlog of a
+        assert await take(queue, 5) == ["a0", "b0", "a1", "a2", "a3"]
+
+    asyncio.run(scenario())
+
+
+def test_guild_weights():
+    async def scenario():
+        queue = FairQueue(maxsize=12, max_held=12, weights={"busy": 2})
+        for i in range(6):
+            await queue.put(entry(f"busy{i}", "busy", "a"))
+            await queue.put(entry(f"quiet{i}", "quiet", "b"))
+        taken = await take(queue, 6)
+        assert sum(e.startswith("busy") for e in taken) == 4
+
+    asyncio.run(scenario())
+
+
+def test_max_in_flight_per_user():
+    async def scenario():
+        queue = FairQueue(maxsize=2, max_held=10, max_in_flight_per_user=1)
+        await queue.put(entry("a0", "guild", "a"))
+        await queue.put(entry("a1", "guild", "a"))
+        running = await queue.get()
+        # a1 can not run, so it does not take up room
+        assert queue.room() == 2
+        await queue.put(entry("b0", "guild", "b"))
+        assert (await queue.get())[0] == "b0"
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(queue.get(), 0.05)
+
+        queue.task_done(running)
+        assert (await asyncio.wait_for(queue.get(), 1))[0] == "a1"
+
+    asyncio.run(scenario())
+
+
+def test_take_waiting_and_join():
+    async def scenario():
+        queue = FairQueue(maxsize=10, max_held=10)
+        for i in range(3):
+            await queue.put(entry(str(i), "guild", "a"))
+        running = await queue.get()
+        assert [e for e, _ in queue.take_waiting()] == ["1", "2"]
+
+        joined = asyncio.create_task(queue.join())
+        await asyncio.sleep(0)
+        assert not joined.done()
+        queue.task_done(running)
+        await asyncio.wait_for(joined, 1)
+
+    asyncio.run(scenario())
+
+
+def test_parse_guild_weights():
+    assert parse_guild_weights("") == {}
+    assert parse_guild_weights("1:2, 3:0.5") == {"1": 2, "3": 0.5}
+    with pytest.raises(ValueError):
+        parse_guild_weights("1:0")
+
+
+def test_max_in_flight_per_user_across_guilds():
+    async def scenario():
+        queue = FairQueue(maxsize=2, max_held=10, max_in_flight_per_user=1)
+        await queue.put(entry("a0", "guild", "a"))
+        await queue.put(entry("a1", "other", "a"))
+        running = await queue.get()
+        assert queue.room() == 2
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(queue.get(), 0.05)
+
+        queue.task_done(running)
+        assert (await asyncio.wait_for(queue.get(), 1))[0] == "a1"
+
+    asyncio.run(scenario())
+
+
+def test_unknown_users_share_a_maximum():
+    async def scenario():
+        queue = FairQueue(
+            maxsize=3,
+            max_held=10,
+            max_in_flight_per_user=1,
+            max_in_flight_anonymous=2,
+        )
+        for i in range(3):
+            await queue.put((str(i), None))
+        assert [(await queue.get())[0] for _ in range(2)] == ["0", "1"]
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(queue.get(), 0.05)
+
+    asyncio.run(scenario())
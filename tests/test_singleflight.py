@@ -0,0 +1,185 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+from droombot import singleflight
+from droombot.models import FinishReason, TextToImageResponse
+from droombot.singleflight import SingleFlight
+
+RESPONSES = [
+    TextToImageResponse(image=b"foo", finish_reason=FinishReason.SUCCESS, seed=1)
+]
+
+
+def flights(count: int) -> list[SingleFlight]:
+    """Single flights of separate workers, sharing a redis server"""
+    server = fakeredis.FakeServer()
+    return [
+        SingleFlight(fakeredis.aioredis.FakeRedis(server=server)) for _ in range(count)
+    ]
+
+
+def test_identical_calls_are_shared():
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return RESPONSES
+
+    async def scenario():
+        workers = flights(3)
+        results = await asyncio.gather(*(w.run("digest", call) for w in workers))
+        assert calls == 1
+        assert results == [RESPONSES] * 3
+        # other requests are not shared
+        await workers[0].run("other", call)
+        assert calls == 2
+        for w in workers:
+            await w.stop()
+
+    asyncio.run(scenario())
+
+
+def test_followers_get_error_of_failed_leader():
+    async def call():
+        await asyncio.sleep(0.1)
+        raise ValueError("An error occurred")
+
+    async def scenario():
+        leader, follower = flights(2)
+        leading = asyncio.create_task(leader.run("digest", call))
+        await asyncio.sleep(0.01)
+        responses = await follower.run("digest", call)
+        assert [r.finish_reason for r in responses] == [FinishReason.ERROR]
+        with pytest.raises(ValueError):
+            await leading
+        await leader.stop()
+        await follower.stop()
+
+    asyncio.run(scenario())
+
+
+def test_landed_flights_are_not_shared():
+    calls = 0
+
+    async def failing():
+        nonlocal calls
+        calls += 1
+        raise ValueError("An error occurred")
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        return RESPONSES
+
+    async def scenario():
+        (worker,) = flights(1)
+        with pytest.raises(ValueError):
+            await worker.run("digest", failing)
+        # the error of the previous flight is not handed out
+        assert await worker.run("digest", call) == RESPONSES
+        assert await worker.run("digest", call) == RESPONSES
+        assert calls == 3
+        await worker.stop()
+
+    asyncio.run(scenario())
+
+
+def test_follower_takes_over_from_dead_leader(monkeypatch):
+    monkeypatch.setattr(singleflight, "FLIGHT_LOCK_TTL", 0.2)
+
+    async def call():
+        return RESPONSES
+
+    async def scenario():
+        (follower,) = flights(1)
+        # a leader that died without releasing its lock
+        await follower._redis_connection.set(
+            "droombot-flight:digest:lock", "dead", px=200
+        )
+        responses = await asyncio.wait_for(follower.run("digest", call), 5)
+        assert responses == RESPONSES
+        await follower.stop()
+
+    asyncio.run(scenario())
+
+
+def test_follower_takes_over_from_cancelled_leader():
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(10)
+        return RESPONSES
+
+    async def scenario():
+        leader, follower = flights(2)
+        leading = asyncio.create_task(leader.run("digest", call))
+        await asyncio.sleep(0.01)
+        following = asyncio.create_task(follower.run("digest", call))
+        await asyncio.sleep(0.01)
+
+        leading.cancel()
+        # well before the lock of the leader would have expired
+        assert await asyncio.wait_for(following, 2) == RESPONSES
+        assert calls == 2
+        await leader.stop()
+        await follower.stop()
+
+    asyncio.run(scenario())
+
+
+def test_identical_calls_of_a_worker_are_shared():
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return RESPONSES
+
+    async def scenario():
+        (worker,) = flights(1)
+        results = await asyncio.gather(*(worker.run("digest", call) for _ in range(3)))
+        assert calls == 1
+        assert results == [RESPONSES] * 3
+        await worker.stop()
+
+    asyncio.run(scenario())
+
+
+def test_flight_is_cancelled_without_callers():
+    started = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def call():
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return RESPONSES
+
+    async def scenario():
+        (worker,) = flights(1)
+        first = asyncio.create_task(worker.run("digest", call))
+        second = asyncio.create_task(worker.run("digest", call))
+        await started.wait()
+
+        # the flight keeps going for the remaining caller
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled.is_set()
+        second.cancel()
+        await asyncio.wait_for(cancelled.wait(), 5)
+        # the lock is released, for others to take over
+        while await worker._redis_connection.exists("droombot-flight:digest:lock"):
+            await asyncio.sleep(0.01)
+        await worker.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,62 @@
+import subprocess
+import sys
+
+from droombot.startup import measure_imports, startup_report
+
+
+def test_measure_imports():
+    times = {t.module: t for t in measure_imports(["json"])}
+    assert "json" in times
+    assert times["json"].cumulative >= times["json"].self_time > 0
+    assert startup_report(["json"]).startswith("Importing json took")
+
+
+def test_commands_import_what_they_need():
+    code = (
+        "import sys\n"
+        "import droombot.cli, droombot.supervisor, droombot.worker\n"
+        "print(' '.join(sorted(sys.modules)))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    )
+    modules = result.stdout.split()
+    for package in ("discord", "aiohttp", "PIL", "opentelemetry"):
+        assert package not in modules
+
+
+def test_profile_startup_option():
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from droombot.cli import cli; cli()",
+            "--profile-startup",
+            "worker",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert result.stdout.startswith(
+        "Importing droombot.cli, droombot.supervisor, droombot.worker took"
+    )
+    assert "redis" in result.stdout
+
+
+def test_profile_startup_of_all_commands():
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from droombot.cli import cli; cli()",
+            "--profile-startup",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert result.stdout.startswith(
+        "Importing droombot.cli, droombot.bot, droombot.metrics, droombot.tracing, "
+        "droombot.supervisor, droombot.worker took"
+    )
@@ -0,0 +1,73 @@
+import os
+
+from droombot.models import FinishReason, PubSubMessage, TextToImageResponse
+from droombot.store import ImageStore
+
+
+def message(interaction_id: str, user_id: str = "user") -> PubSubMessage:
+    return PubSubMessage(
+        interaction_id=interaction_id,
+        text_prompt=f"prompt {interaction_id}",
+        guild_id="guild",
+        user_id=user_id,
+    )
+
+
+def response(image: bytes | None, seed: int = 0) -> TextToImageResponse:
+    return TextToImageResponse(
+        image=image,
+        finish_reason=FinishReason.SUCCESS if image else FinishReason.ERROR,
+        seed=seed,
+        output_format="webp",
+    )
+
+
+def test_put_and_open(tmp_path):
+    store = ImageStore(tmp_path, max_bytes=1000)
+    digests = store.put(
+        message("1"), [response(b"foo", 1), response(None), response(b"bar", 3)]
+    )
+    assert len(digests) == 2
+
+    images = store.images("1")
+    assert [(i.index, i.seed, i.prompt) for i in images] == [
+        (0, 1, "prompt 1"),
+        (2, 3, "prompt 1"),
+    ]
+    assert images[0].output_format == "webp"
+    image = store.open(images[1].digest)
+    assert image.read() == b"bar"
+    image.seek(1)
+    assert image.read() == b"ar"
+    image.close()
+    assert store.open("0" * 64) is None
+
+
+def test_identical_images_are_stored_once(tmp_path):
+    store = ImageStore(tmp_path, max_bytes=1000)
+    (first,) = store.put(message("1"), [response(b"foo")])
+    (second,) = store.put(message("2"), [response(b"foo")])
+    assert first == second
+    assert len(list((tmp_path / "objects").glob("*/*"))) == 1
+
+
+def test_interactions_of_user(tmp_path):
+    store = ImageStore(tmp_path, max_bytes=1000)
+    for i in range(3):
+        store.put(message(str(i)), [response(b"image %d" % i)])
+    store.put(message("other", user_id="other"), [response(b"other")])
+    assert store.interactions("user", limit=2) == ["2", "1"]
+    assert store.interactions("nobody") == []
+
+
+def test_least_recently_accessed_are_evicted(tmp_path):
+    store = ImageStore(tmp_path, max_bytes=250)
+    (first,) = store.put(message("1"), [response(os.urandom(100))])
+    (second,) = store.put(message("2"), [response(os.urandom(100))])
+    store.open(first).close()
+    store.put(message("3"), [response(os.urandom(100))])
+
+    assert store.open(second) is None
+    assert store.images("2") == []
+    assert not store.image_path(second).exists()
+    assert store.open(first) is not None
@@ -0,0 +1,52 @@
+import threading
+import time
+
+from droombot.supervisor import Supervisor
+
+
+def crash(index, heartbeats):
+    raise SystemExit(1)
+
+
+def hang(index, heartbeats):
+    time.sleep(60)
+
+
+def beat(index, heartbeats):
+    while True:
+        heartbeats[index] = time.time()
+        time.sleep(0.05)
+
+
+def supervise(supervisor: Supervisor, until) -> float:
+    thread = threading.Thread(target=supervisor.supervise)
+    thread.start()
+    deadline = time.monotonic() + 10
+    try:
+        while not until() and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        supervisor.stop()
+        thread.join()
+    return time.monotonic()
+
+
+def test_restarts_crashed_processes():
+    supervisor = Supervisor(2, target=crash, check_interval=0.05)
+    supervise(supervisor, lambda: supervisor.restarts >= 2)
+    assert supervisor.restarts >= 2
+
+
+def test_restarts_unresponsive_processes():
+    supervisor = Supervisor(1, target=hang, heartbeat_timeout=0.5, check_interval=0.05)
+    supervise(supervisor, lambda: supervisor.restarts >= 1)
+    assert supervisor.restarts == 1
+
+
+def test_stops_healthy_processes():
+    supervisor = Supervisor(2, target=beat, heartbeat_timeout=5, check_interval=0.05)
+    start = time.monotonic()
+    stopped = supervise(supervisor, lambda: time.monotonic() - start > 1)
+    # healthy processes are not restarted, and stop on SIGTERM
+    assert supervisor.restarts == 0
+    assert stopped - start < 5
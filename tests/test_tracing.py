@@ -0,0 +1,62 @@
+import json
+
+import pytest
+from droombot import tracing
+from droombot.job_queue import decode_job, encode_job
+from droombot.models import PubSubMessage
+
+
+@pytest.fixture
+def spans_file(tmp_path, monkeypatch):
+    pytest.importorskip("opentelemetry.sdk")
+    path = tmp_path / "spans.jsonl"
+    monkeypatch.setattr(tracing, "TRACING_EXPORTER", "file")
+    monkeypatch.setattr(tracing, "TRACING_FILE", str(path))
+    monkeypatch.setattr(tracing, "_provider", None)
+    monkeypatch.setattr(tracing, "_tracer", None)
+    yield path
+    if tracing._provider is not None:
+        tracing._provider.shutdown()
+
+
+def read_spans(path):
+    tracing._provider.force_flush()
+    return {
+        span["name"]: span for span in map(json.loads, path.read_text().splitlines())
+    }
+
+
+def test_tracing_disabled():
+    assert tracing.trace_context() == {}
+    with tracing.span("prompt", interaction_id="1") as span:
+        assert span is None
+        tracing.annotate(outcome="success")
+    with tracing.continue_trace({"traceparent": "invalid"}):
+        pass
+
+
+def test_trace_is_continued_from_job(spans_file):
+    tracing.init_tracing("droombot-test")
+    with tracing.span("prompt", interaction_id="1"):
+        message = PubSubMessage(
+            interaction_id="1",
+            text_prompt="foo",
+            trace_context=tracing.trace_context(),
+        )
+    assert "traceparent" in message.trace_context
+
+    job = decode_job(encode_job(message))
+    with tracing.continue_trace(job.trace_context):
+        with tracing.span("queued", start_time=1_700_000_000.5):
+            pass
+        with tracing.span("run_prompt"):
+            tracing.annotate(cached=True)
+
+    spans = read_spans(spans_file)
+    prompt = spans["prompt"]
+    for name in ("queued", "run_prompt"):
+        assert spans[name]["context"]["trace_id"] == prompt["context"]["trace_id"]
+        assert spans[name]["parent_id"] == prompt["context"]["span_id"]
+    assert spans["queued"]["start_time"].startswith("2023-11-14T22:13:20.5")
+    assert spans["run_prompt"]["attributes"] == {"cached": True}
+    assert prompt["resource"]["attributes"]["service.name"] == "droombot-test"
@@ -0,0 +1,31 @@
+import importlib.metadata
+
+import pytest
+from droombot import version
+
+
+@pytest.fixture(autouse=True)
+def clear_version():
+    version.get_version.cache_clear()
+    yield
+    version.get_version.cache_clear()
+
+
+def test_version_outside_checkout(tmp_path, monkeypatch):
+    # installed from a package, there is no git checkout to describe
+    monkeypatch.setattr(version, "SOURCE_ROOT", tmp_path)
+    assert version.get_version() == importlib.metadata.version("droombot")
+
+
+def test_version_is_computed_once(monkeypatch):
+    calls = []
+
+    def git_revision():
+        calls.append(None)
+        return "abc1234"
+
+    monkeypatch.setattr(version, "_git_revision", git_revision)
+    base_version = importlib.metadata.version("droombot")
+    assert version.get_version() == f"{base_version}-abc1234"
+    assert version.get_version() == f"{base_version}-abc1234"
+    assert len(calls) == 1
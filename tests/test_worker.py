@@ -0,0 +1,355 @@
+import asyncio
+import io
+import time
+
+import fakeredis.aioredis
+import redis.asyncio as redis
+from droombot import worker as worker_module
+from droombot.cancellation import cancel
+from droombot.job_queue import JobQueue
+from droombot.models import FinishReason, PubSubMessage, TextToImageResponse
+from droombot.postprocess import PostprocessSettings
+from droombot.results import fetch_progress, fetch_results
+from droombot.worker import Worker
+from PIL import Image
+
+
+class FakeStabilityClient:
+    """Stand-in for api.StabilityClient"""
+
+    def __init__(self, text_to_image):
+        self.text_to_image = text_to_image
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeTextToImage:
+    """Stand-in for StabilityClient.text_to_image, recording concurrency"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.running = 0
+        self.max_running = 0
+        self.calls = 0
+
+    async def __call__(self, request):
+        self.calls += 1
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        return [
+            TextToImageResponse(
+                image=b"foo", finish_reason=FinishReason.SUCCESS, seed=0
+            )
+        ]
+
+
+def test_worker_bounds_concurrency():
+    fake = FakeTextToImage(delay=0.05)
+
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection)
+        await queue.ensure_group()
+        for i in range(6):
+            await queue.enqueue(
+                PubSubMessage(interaction_id=str(i), text_prompt=f"prompt {i}")
+            )
+
+        worker = Worker(connection, 2, FakeStabilityClient(fake))
+        task = asyncio.create_task(worker.loop())
+        while fake.calls < 6 or fake.running:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+        assert fake.max_running == 2
+        for i in range(6):
+            assert await fetch_results(connection, str(i)) is not None
+        assert (await connection.xpending(queue.stream, queue.group))["pending"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_worker_drain_requeues_cancelled(monkeypatch):
+    fake = FakeTextToImage(delay=10)
+    monkeypatch.setattr(worker_module, "WORKER_DRAIN_TIMEOUT", 0.05)
+
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection)
+        await queue.ensure_group()
+        await queue.enqueue(PubSubMessage(interaction_id="1", text_prompt="x"))
+
+        worker = Worker(connection, 1, FakeStabilityClient(fake))
+        task = asyncio.create_task(worker.loop())
+        while fake.running == 0:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+        # the running prompt was put back in the stream for another worker
+        assert (await connection.xpending(queue.stream, queue.group))["pending"] == 0
+        other = JobQueue(connection, consumer="other")
+        entries = await other.read(10)
+        assert [message for _, message in entries] == [
+            PubSubMessage(interaction_id="1", text_prompt="x")
+        ]
+
+    asyncio.run(scenario())
+
+
+def test_worker_survives_failing_ack(monkeypatch):
+    fake = FakeTextToImage(delay=0)
+    failures = 2
+    ack = JobQueue.ack
+
+    async def failing_ack(self, entry_id):
+        nonlocal failures
+        if failures:
+            failures -= 1
+            raise redis.ConnectionError("connection lost")
+        await ack(self, entry_id)
+
+    monkeypatch.setattr(JobQueue, "ack", failing_ack)
+    monkeypatch.setattr(worker_module, "WORKER_CLAIM_IDLE_TIME", 0.3)
+
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection)
+        await queue.ensure_group()
+        for i in range(4):
+            await queue.enqueue(
+                PubSubMessage(interaction_id=str(i), text_prompt=f"prompt {i}")
+            )
+
+        async def finished():
+            while fake.calls < 4 or fake.running:
+                await asyncio.sleep(0.01)
+
+        worker = Worker(connection, 2, FakeStabilityClient(fake))
+        task = asyncio.create_task(worker.loop())
+        await asyncio.wait_for(finished(), 5)
+        # the consumers carried on
+        for i in range(4):
+            assert await fetch_results(connection, str(i)) is not None
+
+        # the unacknowledged entries are not kept alive, for others to claim
+        await asyncio.sleep(1)
+        other = JobQueue(connection, consumer="other")
+        assert len(await other.claim_stale(300, 10)) == 2
+        worker.stop()
+        await asyncio.wait_for(task, 5)
+
+    asyncio.run(scenario())
+
+
+def test_worker_keeps_held_entries_from_other_workers(monkeypatch):
+    fake = FakeTextToImage(delay=10)
+    monkeypatch.setattr(worker_module, "MAX_PROMPTS_IN_FLIGHT_PER_USER", 1)
+    monkeypatch.setattr(worker_module, "WORKER_CLAIM_IDLE_TIME", 0.3)
+    monkeypatch.setattr(worker_module, "WORKER_DRAIN_TIMEOUT", 0.05)
+
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection)
+        await queue.ensure_group()
+        for i in range(3):
+            await queue.enqueue(
+                PubSubMessage(interaction_id=str(i), text_prompt="x", user_id="1")
+            )
+
+        worker = Worker(connection, 3, FakeStabilityClient(fake))
+        task = asyncio.create_task(worker.loop())
+        while fake.running == 0:
+            await asyncio.sleep(0.01)
+        # one prompt is running, the others are held back by the per-user cap
+        await asyncio.sleep(1)
+        assert fake.running == 1
+
+        other = JobQueue(connection, consumer="other")
+        assert await other.claim_stale(300, 10) == []
+
+        worker.stop()
+        await task
+
+    asyncio.run(scenario())
+
+
+def test_worker_skips_abandoned_prompts():
+    fake = FakeTextToImage(delay=0)
+
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection)
+        await queue.ensure_group()
+        await queue.enqueue(
+            PubSubMessage(interaction_id="1", text_prompt="x", deadline=time.time())
+        )
+        await cancel(connection, "2", ttl=10)
+        await queue.enqueue(PubSubMessage(interaction_id="2", text_prompt="x"))
+        await queue.enqueue(
+            PubSubMessage(
+                interaction_id="3", text_prompt="x", deadline=time.time() + 60
+            )
+        )
+
+        worker = Worker(connection, 1, FakeStabilityClient(fake))
+        task = asyncio.create_task(worker.loop())
+        while await fetch_results(connection, "3") is None:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+        assert fake.calls == 1
+        assert not (await fetch_progress(connection, "1")).started
+        assert not (await fetch_progress(connection, "2")).started
+        assert (await connection.xpending(queue.stream, queue.group))["pending"] == 0
+        # results are kept until the deadline, and a little longer
+        assert 60 < await connection.ttl("interaction:3") <= 60 + 30
+
+    asyncio.run(scenario())
+
+
+def test_worker_stops_cancelled_prompts():
+    fake = FakeTextToImage(delay=10)
+
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection)
+        await queue.ensure_group()
+        await queue.enqueue(PubSubMessage(interaction_id="1", text_prompt="x -s 1"))
+        await queue.enqueue(
+            PubSubMessage(
+                interaction_id="2", text_prompt="x -s 2", deadline=time.time() + 0.5
+            )
+        )
+
+        worker = Worker(connection, 2, FakeStabilityClient(fake))
+        task = asyncio.create_task(worker.loop())
+        while fake.running < 2:
+            await asyncio.sleep(0.01)
+        await cancel(connection, "1", ttl=10)
+        # the second prompt runs past its deadline
+        while fake.running:
+            await asyncio.sleep(0.01)
+        while (await connection.xpending(queue.stream, queue.group))["pending"]:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+        # both prompts were acknowledged, without result
+        assert await fetch_results(connection, "1") is None
+        assert await fetch_results(connection, "2") is None
+        other = JobQueue(connection, consumer="other")
+        assert await other.read(10) == []
+
+    asyncio.run(scenario())
+
+
+def test_worker_fans_out_images():
+    calls = []
+
+    async def fake(request):
+        calls.append(request.seed)
+        if len(calls) == 2:
+            raise ValueError("An error occurred")
+        await asyncio.sleep(0.05)
+        return [
+            TextToImageResponse(
+                image=b"foo", finish_reason=FinishReason.SUCCESS, seed=request.seed
+            )
+        ]
+
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection)
+        await queue.ensure_group()
+        await queue.enqueue(PubSubMessage(interaction_id="1", text_prompt="x -n 3"))
+
+        worker = Worker(connection, 4, FakeStabilityClient(fake))
+        task = asyncio.create_task(worker.loop())
+        while await fetch_results(connection, "1") is None:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+        # all images were requested at once, with distinct seeds
+        assert len(set(calls)) == 3
+        responses = await fetch_results(connection, "1")
+        assert [r.finish_reason for r in responses] == [
+            FinishReason.SUCCESS,
+            FinishReason.ERROR,
+            FinishReason.SUCCESS,
+        ]
+
+    asyncio.run(scenario())
+
+
+def test_worker_stores_error_on_failure():
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection)
+        await queue.ensure_group()
+        # an invalid model can not be run
+        await queue.enqueue(PubSubMessage(interaction_id="1", text_prompt="x -m foo"))
+
+        fake = FakeTextToImage(delay=0)
+        worker = Worker(connection, 1, FakeStabilityClient(fake))
+        task = asyncio.create_task(worker.loop())
+        while await fetch_results(connection, "1") is None:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+        responses = await fetch_results(connection, "1")
+        assert [r.finish_reason for r in responses] == [FinishReason.ERROR]
+        assert fake.calls == 0
+
+    asyncio.run(scenario())
+
+
+def test_worker_postprocesses_images():
+    image = io.BytesIO()
+    Image.new("RGB", (64, 64), "red").save(image, format="png")
+
+    async def fake(request):
+        return [
+            TextToImageResponse(
+                image=image.getvalue(),
+                finish_reason=FinishReason.SUCCESS,
+                seed=request.seed,
+            )
+        ]
+
+    async def scenario():
+        connection = fakeredis.aioredis.FakeRedis()
+        queue = JobQueue(connection)
+        await queue.ensure_group()
+        await queue.enqueue(PubSubMessage(interaction_id="1", text_prompt="x"))
+
+        worker = Worker(
+            connection,
+            1,
+            FakeStabilityClient(fake),
+            PostprocessSettings(output_format="jpeg", thumbnail_size=16),
+        )
+        task = asyncio.create_task(worker.loop())
+        while await fetch_results(connection, "1") is None:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+        (response,) = await fetch_results(connection, "1")
+        assert response.output_format == "jpeg"
+        assert response.image.startswith(b"\xff\xd8")
+        assert response.thumbnail is not None
+
+    asyncio.run(scenario())